@@ -0,0 +1,248 @@
+"""
+Benchmarks for the column store.
+
+Generates synthetic columns and measures, for every column store encoding and
+every value store mode:
+
+* append throughput
+* point lookup latency percentiles
+* scan throughput
+* size on disk
+
+Results are written as one JSON object per line so that runs can be compared
+by a script.
+
+RUNME as 'python -m column_store.benchmark [--rows N] [--output FILE]'
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from glob import glob
+from timeit import default_timer as timer
+
+from column_store.column import Column
+from column_store.rle import RleColumnStore
+from column_store.value_store import ValueStore
+
+STORE_FACTORIES = [RleColumnStore]
+
+VALUE_STORE_MODES = [
+   ("packed", ValueStore.DATA_MODE_PACKED),
+   ("compressed", ValueStore.DATA_MODE_COMPRESSED),
+   ("user", ValueStore.DATA_MODE_USER),
+   ("user_compressed", ValueStore.DATA_MODE_USER_COMPRESSED),
+   ("packed_int", ValueStore.DATA_MODE_PACKED_INT),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def _random_string(rng, min_length, max_length):
+   length = rng.randint(min_length, max_length)
+   return "".join(chr(rng.randint(97, 122)) for _ in range(0, length))
+
+
+def sorted_values(rows, rng):
+   return ["key %08d" % (i / 10) for i in range(0, rows)]
+
+
+def clustered_values(rows, rng):
+   values = []
+   while len(values) < rows:
+      values.extend(["cluster %d" % rng.randint(0, rows / 16)] * rng.randint(1, 64))
+   return values[:rows]
+
+
+def random_values(rows, rng):
+   return ["value %d" % rng.randint(0, max(rows / 4, 1)) for _ in range(0, rows)]
+
+
+def low_cardinality_values(rows, rng):
+   return ["category %d" % rng.randint(0, 7) for _ in range(0, rows)]
+
+
+def high_cardinality_values(rows, rng):
+   return ["unique %d" % i for i in rng.sample(xrange(rows * 10), rows)]
+
+
+def short_string_values(rows, rng):
+   return [_random_string(rng, 4, 8) for _ in range(0, rows)]
+
+
+def long_string_values(rows, rng):
+   return [_random_string(rng, 512, 2048) for _ in range(0, rows)]
+
+
+DATASETS = [
+   ("sorted", sorted_values),
+   ("clustered", clustered_values),
+   ("random", random_values),
+   ("low_cardinality", low_cardinality_values),
+   ("high_cardinality", high_cardinality_values),
+   ("short_strings", short_string_values),
+   ("long_strings", long_string_values),
+]
+
+
+def percentiles(samples):
+   """
+   :returns: A dict of latency percentiles, in microseconds.
+   """
+   if not samples:
+      return {}
+
+   samples = sorted(samples)
+   result = {}
+   for p in PERCENTILES:
+      result["p%d" % p] = samples[min(len(samples) * p / 100, len(samples) - 1)] * 1e6
+   result["max"] = samples[-1] * 1e6
+   return result
+
+
+def _rate(count, elapsed):
+   return count / elapsed if elapsed > 0 else None
+
+
+def _size_on_disk(base_name):
+   return sum(os.path.getsize(f) for f in glob(base_name + ".*"))
+
+
+def bench_column(directory, store_factory, dataset, values, queries, rng):
+   """
+   :synopsis: Benchmarks a column built from 'values', one row per value.
+   """
+   table = os.path.join(directory, "bench")
+   name = "%s_%s" % (store_factory.__name__, dataset)
+   c = Column(table, name, store_factory=store_factory)
+
+   start = timer()
+   for row_id, value in enumerate(values):
+      c.append(row_id, value)
+   c.flush()
+   append_elapsed = timer() - start
+
+   latencies = []
+   for row_id in [rng.randint(0, len(values) - 1) for _ in range(0, queries)]:
+      start = timer()
+      c.get(row_id)
+      latencies.append(timer() - start)
+
+   start = timer()
+   for row_id in range(0, len(values)):
+      c.get(row_id)
+   scan_elapsed = timer() - start
+
+   return {
+      "suite": "column",
+      "store": store_factory.__name__,
+      "dataset": dataset,
+      "rows": len(values),
+      "append_rows_per_sec": _rate(len(values), append_elapsed),
+      "get_latency_us": percentiles(latencies),
+      "scan_rows_per_sec": _rate(len(values), scan_elapsed),
+      "bytes_on_disk": _size_on_disk(c.base_name),
+   }
+
+
+def bench_value_store(directory, mode_name, mode, dataset, values, queries, rng):
+   """
+   :synopsis: Benchmarks a value store holding 'values'.
+   """
+   base_name = os.path.join(directory, "bench.%s_%s" % (mode_name, dataset))
+   if mode == ValueStore.DATA_MODE_PACKED_INT:
+      # Integer columns get the index of each distinct value instead.
+      ids = {}
+      values = [ids.setdefault(v, len(ids)) for v in values]
+      sizes = [0] * len(values)
+   else:
+      sizes = [len(v) for v in values]
+
+   v = ValueStore(base_name, mode=mode)
+   start = timer()
+   offsets = [v.append(value) for value in values]
+   v.flush()
+   append_elapsed = timer() - start
+
+   latencies = []
+   for i in [rng.randint(0, len(values) - 1) for _ in range(0, queries)]:
+      start = timer()
+      v.get(offsets[i], sizes[i])
+      latencies.append(timer() - start)
+
+   start = timer()
+   for i, offset in enumerate(offsets):
+      v.get(offset, sizes[i])
+   scan_elapsed = timer() - start
+
+   return {
+      "suite": "value_store",
+      "store": mode_name,
+      "dataset": dataset,
+      "rows": len(values),
+      "append_rows_per_sec": _rate(len(values), append_elapsed),
+      "get_latency_us": percentiles(latencies),
+      "scan_rows_per_sec": _rate(len(values), scan_elapsed),
+      "bytes_on_disk": _size_on_disk(base_name),
+   }
+
+
+def run(rows=2000, queries=1000, seed=0, datasets=None, directory=None):
+   """
+   :synopsis: Runs every benchmark over every dataset.
+   :param datasets: The names of the datasets to use. Defaults to all of them.
+   :param directory: Where to create the column files. Each run creates a new
+                     subdirectory of it, which is kept afterwards. Defaults to
+                     a temporary directory which is removed afterwards.
+   :returns: A generator of result dicts.
+   """
+   selected = [(n, g) for n, g in DATASETS if datasets is None or n in datasets]
+   owns_directory = directory is None
+   # A fresh directory, so that no column is appended to a previous run's files.
+   directory = tempfile.mkdtemp(prefix="column_store_bench", dir=directory)
+   try:
+      for dataset, generator in selected:
+         values = generator(rows, random.Random(seed))
+         for store_factory in STORE_FACTORIES:
+            yield bench_column(directory, store_factory, dataset, values, queries,
+                               random.Random(seed))
+         for mode_name, mode in VALUE_STORE_MODES:
+            yield bench_value_store(directory, mode_name, mode, dataset, values,
+                                    queries, random.Random(seed))
+   finally:
+      if owns_directory:
+         shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Benchmark the column store.")
+   parser.add_argument("--rows", type=int, default=2000, help="rows per column")
+   parser.add_argument("--queries", type=int, default=1000, help="point lookups per column")
+   parser.add_argument("--seed", type=int, default=0, help="random seed")
+   parser.add_argument("--dataset", action="append", dest="datasets",
+                       choices=[n for n, _ in DATASETS],
+                       help="dataset to run (may be repeated, default all)")
+   parser.add_argument("--dir", dest="directory",
+                       help="directory to create each run's column files in")
+   parser.add_argument("--output", help="file to write results to (default stdout)")
+   args = parser.parse_args(argv)
+   if args.rows < 1:
+      parser.error("--rows must be at least 1")
+
+   out = open(args.output, "w") if args.output else sys.stdout
+   try:
+      for result in run(args.rows, args.queries, args.seed, args.datasets, args.directory):
+         out.write(json.dumps(result, sort_keys=True) + "\n")
+         out.flush()
+   finally:
+      if out is not sys.stdout:
+         out.close()
+
+
+if __name__ == "__main__":
+   main()
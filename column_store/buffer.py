@@ -8,6 +8,7 @@ from column_store.mq import Cache
 from column_store.page import factory
 
 import io
+import os
 
 DEFAULT_BUFFER_SIZE = 1024 * 1024 * 100  # 100mb
 PAGE_SIZE = 4096
@@ -31,12 +32,44 @@ class Manager(object):
       self.filename_base = filename_base
       self.filename_ext = filename_ext
 
+   def file_name(self, file_id):
+      return "%s.%d.%s" % (self.filename_base, file_id, self.filename_ext)
+
    def allocate_file(self):
+      '''
+      :synopsis: Creates a new, empty file. Anything left over under its name
+                 is discarded.
+      :returns: The id of the file.
+      '''
       file_id = len(self.file_handles)
-      file_name = "%s.%d.%s" % (self.filename_base, file_id, self.filename_ext)
-      self.file_handles.append(io.open(file_name, "a+b", buffering=0))
+      self.file_handles.append(io.open(self.file_name(file_id), "w+b", buffering=0))
       return file_id
 
+   def open_file(self, file_id):
+      '''
+      :synopsis: Opens an existing file that was allocated by an earlier
+                 manager with the same file names.
+      '''
+      while len(self.file_handles) <= file_id:
+         self.file_handles.append(None)
+      self.file_handles[file_id] = io.open(self.file_name(file_id), "r+b", buffering=0)
+
+   def release_file(self, file_id):
+      '''
+      :synopsis: Drops the cached pages of a file, without writing them, and
+                 deletes the file.
+      '''
+      for key in [k for k, _ in self.cache.iteritems() if k[1] == file_id]:
+         self.cache.remove(key)
+      self.file_handles[file_id].close()
+      self.file_handles[file_id] = None
+      os.unlink(self.file_name(file_id))
+
+   def write_page_uncached(self, page_id, file_id, data):
+      f = self.file_handles[file_id]
+      f.seek(page_id)
+      f.write(data)
+
    def read_page_uncached(self, page_id, file_id):
       f = self.file_handles[file_id]
       f.seek(page_id)
@@ -61,3 +94,13 @@ class Manager(object):
    def evict_page(self, key, page):
       if page.is_dirty():
          page.persist(self, key[0], key[1])
+
+   def close(self):
+      '''
+      :synopsis: Writes the dirty pages and closes every file.
+      '''
+      self.flush()
+      for f in self.file_handles:
+         if f is not None:
+            f.close()
+      self.file_handles = []
@@ -1,22 +1,143 @@
+import bisect
+import os
+
+from durability import DURABILITY_NONE, DURABILITY_GROUP_COMMIT, \
+                       DURABILITY_PER_FLUSH, default_group_commit, sync_file
 from map import Map
+from metadata import ColumnMetadata, MetadataError
 from value_store import ValueStore
 from rle import RleColumnStore
+from stats import ColumnStats
 
 
 class Column(object):
-   def __init__(self, table_name, column_name, store_factory=RleColumnStore):
+   def __init__(self, table_name, column_name, store_factory=RleColumnStore,
+                durability=DURABILITY_NONE, group_commit=None):
+      """
+      :param durability: One of the DURABILITY_* modes from
+                         column_store.durability.
+      :param group_commit: The GroupCommit to join in DURABILITY_GROUP_COMMIT
+                           mode. By default all columns share one.
+      """
       self.base_name = "%s.%s" % (table_name, column_name)
+      self.durability = durability
+      self.group_commit = group_commit or default_group_commit()
+      self.metadata_filename = self.base_name + ".meta"
+      self.metadata = self._load_metadata()
+      m = self.metadata
+      if m is not None and m.encoding != store_factory.__name__:
+         raise ValueError("column '%s' is stored as %s, not %s" % \
+                          (self.base_name, m.encoding, store_factory.__name__))
+
       self.store = store_factory(self.base_name)
-      self.store_map = Map(self.base_name + ".store")
-      self.values = ValueStore(self.base_name)
-      self.value_map = Map(self.base_name + '.value')
+      self.store_map = Map(self.base_name + ".store", m.tuple_count if m else None)
+      if m is None:
+         self.values = ValueStore(self.base_name)
+      else:
+         self.values = ValueStore(self.base_name, m.value_mode, m.compression_level,
+                                  header_known=True)
+      self.value_map = Map(self.base_name + '.value', m.value_count if m else None)
+
+      # A durable column is rolled back to its last commit.
+      if m is not None and durability != DURABILITY_NONE:
+         self._truncate_to_commit(m)
+
+      # The metadata is missing or the column was modified after it was last
+      # flushed. Either way we have to rediscover its state from the files.
+      if m is None or m.file_sizes != self._file_sizes():
+         self.store_map.recount()
+         self.value_map.recount()
+         self.metadata = self._rebuild_metadata(store_factory, m)
+
+      self.statistics = self.metadata.stats
 
       self.previous_value = None
       self.previous_value_offset = None
 
+   def _files(self):
+      """
+      :returns: The column's file objects, in the order that the metadata
+                records their sizes.
+      """
+      return [self.values.f, self.value_map.f, self.store.f, self.store_map.f]
+
+   def _file_sizes(self):
+      return [os.fstat(f.fileno()).st_size for f in self._files()]
+
+   def _truncate_to_commit(self, m):
+      """
+      :synopsis: Discards anything that was appended to the column files after
+                 the commit described by 'm'.
+      """
+      for f, size in zip(self._files(), m.file_sizes):
+         if os.fstat(f.fileno()).st_size > size:
+            f.truncate(size)
+
+   def _load_metadata(self):
+      if not os.path.exists(self.metadata_filename):
+         return None
+
+      try:
+         return ColumnMetadata.load(self.metadata_filename)
+      except MetadataError:
+         return None
+
+   def _rebuild_metadata(self, store_factory, previous):
+      """
+      :synopsis: Recreates the column metadata by scanning the column. This is
+                 only needed for columns that were not flushed before they were
+                 closed.
+      """
+      m = ColumnMetadata(store_factory.__name__, self.values.mode,
+                         self.values.compression_level)
+      m.value_count = self.value_map.count()
+      # Nulls are not stored, so the only record of them is in the metadata.
+      if previous is not None:
+         m.stats.null_count = previous.stats.null_count
+         m.stats.row_count = previous.stats.null_count
+      flushed_row_id = previous.last_row_id if previous is not None else None
+
+      previous_value_idx = None
+      new_rows = 0
+      for i in range(0, self.store_map.count()):
+         value_idx, start_row_id, row_count = self._get_tuple_at_index(i)
+         m.add_tuple(start_row_id)
+         m.add_row(start_row_id)
+         if row_count:
+            m.add_row(start_row_id + row_count)
+         value = self._get_value_at_index(value_idx)
+         for j in range(0, row_count + 1):
+            m.stats.add(value, j > 0 or value_idx == previous_value_idx)
+         previous_value_idx = value_idx
+         if flushed_row_id is not None:
+            new_rows += max(0, start_row_id + row_count - max(start_row_id - 1, flushed_row_id))
+
+      # Rows are appended with consecutive ids, so any id after the last one
+      # recorded at the flush that has no tuple in the store was a null.
+      if flushed_row_id is not None and m.last_row_id is not None and \
+         m.row_ordered and m.last_row_id > flushed_row_id:
+         nulls = m.last_row_id - flushed_row_id - new_rows
+         m.stats.null_count += nulls
+         m.stats.row_count += nulls
+      if flushed_row_id is not None and (m.last_row_id is None or m.last_row_id < flushed_row_id):
+         m.last_row_id = flushed_row_id
+
+      return m
+
    def append(self, row_id, value):
-      if value == self.previous_value:
+      # Nulls are not stored. A row with no entry in the store reads back as
+      # None, so all we need to do is count it and record its id.
+      if value is None:
+         self.statistics.add_null()
+         self.metadata.add_row(row_id)
+         return
+
+      repeated = value == self.previous_value
+      self.statistics.add(value, repeated)
+      self.metadata.add_row(row_id)
+      if repeated:
          if self.store.merge(self.previous_value_offset, row_id):
+            self.metadata.merge_tuple(row_id)
             return
 
       # Find the matching value, or create a new value entry
@@ -34,6 +155,7 @@ class Column(object):
       # Append a new column tuple
       s_offset = self.store.append(value_index, row_id, 0)
       self.store_map.append(s_offset)
+      self.metadata.add_tuple(row_id)
 
       self.previous_value = value
       self.previous_value_offset = s_offset
@@ -67,8 +189,12 @@ class Column(object):
       return None
 
    def _get_binary_search(self, row_id):
-      min_index = 0
-      max_index = self.store_map.count() - 1
+      # Use the block directory to narrow the search down to a single block.
+      block = bisect.bisect_right(self.metadata.blocks, row_id) - 1
+      if block < 0:
+         return None
+
+      min_index, max_index = self.metadata.block_range(block)
 
       while True:
          # We have gone all the way down, the row must not exist.
@@ -87,14 +213,52 @@ class Column(object):
             min_index = center + 1
 
    def get(self, row_id):
-      if self.store.is_row_ordered():
+      if self.store.is_row_ordered() and self.metadata.row_ordered:
          return self._get_binary_search(row_id)
 
       return self._get_linear_search(row_id)
 
+   def count(self):
+      """
+      :returns: The number of rows in the column, including nulls.
+      """
+      return self.statistics.row_count
+
+   def stats(self):
+      """
+      :synopsis: Returns the column statistics. They are maintained on every
+                 append, so this never scans the column.
+      """
+      return self.statistics
+
+   def _sync_data(self):
+      """
+      :synopsis: fsyncs the column files, each before any file that refers to
+                 it.
+      """
+      for f in self._files():
+         sync_file(f)
+
+      # The last tuple is part of the commit now. Merging into it would
+      # rewrite committed data in place, which a crash could tear.
+      self.previous_value = None
+      self.previous_value_offset = None
+
+   def _write_metadata(self, sync=False):
+      self.metadata.value_count = self.value_map.count()
+      self.metadata.file_sizes = self._file_sizes()
+      self.metadata.save(self.metadata_filename, sync)
+
    def flush(self):
-      self.store_map.flush()
-      self.store.flush()
-      self.value_map.flush()
       self.values.flush()
+      self.value_map.flush()
+      self.store.flush()
+      self.store_map.flush()
 
+      if self.durability == DURABILITY_GROUP_COMMIT:
+         self.group_commit.commit(self)
+      elif self.durability == DURABILITY_PER_FLUSH:
+         self._sync_data()
+         self._write_metadata(sync=True)
+      else:
+         self._write_metadata()
@@ -0,0 +1,142 @@
+"""
+Durability modes for columns.
+
+DURABILITY_NONE
+   flush() hands the data to the operating system and rewrites the column
+   metadata, but nothing is fsynced. This is the fastest mode, and a crash may
+   lose or tear anything written since the operating system last wrote back.
+
+DURABILITY_PER_FLUSH
+   Every flush() performs a full sync pass over the column before returning.
+
+DURABILITY_GROUP_COMMIT
+   flush() joins a group commit. Flushes from many callers that arrive close
+   together are made durable by a single sync pass, so each caller pays for a
+   fraction of the fsyncs.
+
+A sync pass fsyncs the column's files in dependency order: values, value map,
+column store, store map. Every file is therefore synced before any file that
+refers to it. Only then is the column metadata written, and the metadata is
+what acts as the commit marker: it records the size of every file at the
+commit, and when a durable column is opened the files are truncated back to
+those sizes so anything that was not committed is discarded.
+"""
+
+import os
+import threading
+import time
+
+DURABILITY_NONE = 0
+DURABILITY_GROUP_COMMIT = 1
+DURABILITY_PER_FLUSH = 2
+
+
+def sync_file(f):
+   f.flush()
+   os.fsync(f.fileno())
+
+
+def sync_directory(filename):
+   """
+   :synopsis: fsyncs the directory containing 'filename' so that a rename
+              into it is durable.
+   """
+   fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+   try:
+      os.fsync(fd)
+   finally:
+      os.close(fd)
+
+
+class GroupCommit(object):
+   """
+   :synopsis: Batches the commits of many callers into one sync pass.
+
+   The first caller to arrive when no commit is running becomes the leader. It
+   waits up to 'window' seconds (or until 'max_batch' columns are waiting) for
+   other callers to join, then syncs every waiting column: first the data files
+   of all columns in order, then the metadata of each. Callers that arrive
+   while a commit is running wait for the next batch.
+   """
+   def __init__(self, window=0.002, max_batch=64):
+      self.window = window
+      self.max_batch = max_batch
+      self.cond = threading.Condition(threading.Lock())
+      self.pending = []
+      self.collecting = 1
+      self.completed = 0
+      self.committing = False
+      self.errors = {}
+
+   def commit(self, column):
+      """
+      :synopsis: Makes the column durable. Returns once a sync pass that
+                 included this column has completed.
+      """
+      with self.cond:
+         if not any(c is column for c in self.pending):
+            self.pending.append(column)
+         batch = self.collecting
+         if len(self.pending) >= self.max_batch:
+            self.cond.notify_all()
+
+         while self.completed < batch:
+            if not self.committing:
+               self.committing = True
+               self._lead()
+            else:
+               self.cond.wait()
+
+         error = self.errors.get(batch)
+         if error is not None:
+            raise error
+
+   def _lead(self):
+      """
+      Runs a commit as the leader. Called with the lock held; the lock is
+      released while the files are synced.
+      """
+      deadline = time.time() + self.window
+      while len(self.pending) < self.max_batch:
+         remaining = deadline - time.time()
+         if remaining <= 0:
+            break
+         self.cond.wait(remaining)
+
+      batch, columns = self.collecting, self.pending
+      self.collecting += 1
+      self.pending = []
+
+      self.cond.release()
+      try:
+         try:
+            for c in columns:
+               c._sync_data()
+            for c in columns:
+               c._write_metadata(sync=True)
+         except Exception as e:
+            error = e
+         else:
+            error = None
+      finally:
+         self.cond.acquire()
+
+      if error is not None:
+         # Every caller waiting on this batch gets the error.
+         self.errors[batch] = error
+         for b in [b for b in self.errors if b < batch - 1024]:
+            del self.errors[b]
+      self.completed = batch
+      self.committing = False
+      self.cond.notify_all()
+
+
+_default_group_commit = GroupCommit()
+
+
+def default_group_commit():
+   """
+   :returns: The group commit shared by all columns that do not ask for their
+             own.
+   """
+   return _default_group_commit
@@ -0,0 +1,467 @@
+"""
+An FD-tree, an index that is written sequentially. See res/fdtree.
+
+The newest entries are kept in memory, in the head tree L0. Below it are the
+levels L1 to Ln. Each level is a sorted run of pages that is written once,
+from start to end, and never changed. Level i holds up to
+head_capacity * k^i entries, so there are about log_k(N) levels.
+
+Insertions and deletions go to the head tree. Once it is full it is merged
+with the levels below it: the first level Lj that can hold the entries of L0
+to Lj is found, and L0 to Lj are merged into a new Lj. If no level can, they
+are merged into a new last level. A merge reads its inputs and writes its
+output sequentially. An update is an insertion, and the newer entry hides the
+older ones. A deletion is a tombstone that hides the older entries of its
+key, and it is dropped once it is merged into the last level.
+
+Fences
+------
+
+Every page of Li+1 has an external fence in Li. The fence holds the lowest
+key the page covers and the page's number. A lookup reads one page per level.
+It searches the page of Li for the key, and then follows the fence with the
+greatest key not above it into Li+1. Every page of Li needs such a fence. A
+page that does not start with one gets an internal fence, which is a copy of
+the fence before it with the key of the page's first item. The head tree
+keeps the fences into L1 in memory.
+
+A merge into Lj leaves L1 to Lj-1 without entries. They are rewritten with
+only fences, each to the pages of the level below. Lookups still read one
+page per level.
+
+Each level is one file of a column_store.buffer.Manager, and its pages are
+read through the manager's cache. A page is:
+
++-------------+----------------------------------+
+| item count  | items ...                        |
+| <H          |                                  |
++-------------+----------------------------------+
+
+Each item is a key, a type and a value. The value of a fence is the number of
+the page it points to:
+
++-----+------+-------+
+| key | type | value |
+| <Q  | <B   | <Q    |
++-----+------+-------+
+
+Durability
+----------
+
+The levels, and the fences into L1, are recorded in a metadata file. The file
+is replaced atomically once the files written by a merge are durable. flush()
+merges the head tree into the levels, so entries are only durable once
+flush() or close() returns.
+"""
+
+import bisect
+import heapq
+import os
+import struct
+import zlib
+
+from cStringIO import StringIO
+
+from buffer import Manager, PAGE_SIZE
+from durability import sync_directory, sync_file
+from page import Page
+from util import varint
+
+# item types, in the order that items with the same key are stored
+FENCE = 0
+INTERNAL_FENCE = 1
+ENTRY = 2
+TOMBSTONE = 3
+
+# item count
+run_page_header_fmt = "<H"
+# key, item type, value
+item_fmt = "<QBQ"
+item_struct = struct.Struct(item_fmt)
+# file id, page count, entry count
+level_fmt = "<QQQ"
+crc_fmt = "<I"
+
+DEFAULT_K = 8
+DEFAULT_HEAD_CAPACITY = 4096
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+class FDTreeError(Exception):
+   def __init__(self, msg):
+      Exception.__init__(self, msg)
+
+
+class RunPage(Page):
+   """
+   :synopsis: A page of a level. It is decoded once, when it is read.
+   """
+   def __init__(self, page_id, file_id, data):
+      Page.__init__(self, page_id, file_id, data)
+      # The entries and tombstones, as (key, type, value), in key order.
+      self.items = []
+      # The fences, as (key, type, page), in key order.
+      self.fences = []
+      count = struct.unpack_from(run_page_header_fmt, data)[0]
+      offset = struct.calcsize(run_page_header_fmt)
+      for i in range(0, count):
+         item = item_struct.unpack_from(data, offset + i * item_struct.size)
+         if item[1] in (FENCE, INTERNAL_FENCE):
+            self.fences.append(item)
+         else:
+            self.items.append(item)
+      self.keys = [item[0] for item in self.items]
+      self.fence_keys = [fence[0] for fence in self.fences]
+
+   @staticmethod
+   def capacity(page_size):
+      return (page_size - struct.calcsize(run_page_header_fmt)) / item_struct.size
+
+   def find(self, key):
+      """
+      :returns: The (type, value) of 'key' on this page, or None.
+      """
+      i = bisect.bisect_left(self.keys, key)
+      if i < len(self.keys) and self.keys[i] == key:
+         return self.items[i][1:]
+      return None
+
+   def child(self, key):
+      """
+      :returns: The page of the next level that would hold 'key'.
+      """
+      return self.fences[bisect.bisect_right(self.fence_keys, key) - 1][2]
+
+
+class Level(object):
+   __slots__ = ["file_id", "page_count", "entry_count"]
+   def __init__(self, file_id, page_count, entry_count):
+      self.file_id = file_id
+      self.page_count = page_count
+      self.entry_count = entry_count
+
+
+class LevelWriter(object):
+   """
+   :synopsis: Writes a new level sequentially, a page at a time.
+   """
+   __slots__ = ["mgr", "file_id", "capacity", "items", "page_count", "entry_count",
+                "los", "child"]
+   def __init__(self, mgr):
+      self.mgr = mgr
+      self.file_id = mgr.allocate_file()
+      self.capacity = RunPage.capacity(mgr.page_size)
+      # The packed items of the page being filled.
+      self.items = []
+      self.page_count = 0
+      self.entry_count = 0
+      # The lowest key that each page covers.
+      self.los = []
+      # The page the last fence points to, or None.
+      self.child = None
+
+   def add(self, key, item_type, value):
+      """
+      :synopsis: Appends an item. Items must be added in key order, and a
+                 fence before the entries with the same key.
+      """
+      if len(self.items) == self.capacity:
+         self._write_page()
+      if not self.items:
+         self.los.append(key if self.page_count else 0)
+         if item_type != FENCE and self.child is not None:
+            self.items.append(item_struct.pack(self.los[-1], INTERNAL_FENCE, self.child))
+      if item_type == FENCE:
+         self.child = value
+      else:
+         self.entry_count += 1
+      self.items.append(item_struct.pack(key, item_type, value))
+
+   def _write_page(self):
+      data = struct.pack(run_page_header_fmt, len(self.items)) + "".join(self.items)
+      data += "\x00" * (self.mgr.page_size - len(data))
+      self.mgr.write_page_uncached(self.page_count * self.mgr.page_size, self.file_id, data)
+      self.page_count += 1
+      self.items = []
+
+   def finish(self):
+      """
+      :synopsis: Writes the last page and makes the level durable. A level
+                 always has at least one page.
+      :returns: The Level.
+      """
+      if not self.page_count and not self.items:
+         self.los.append(0)
+      if self.items or not self.page_count:
+         self._write_page()
+      sync_file(self.mgr.file_handles[self.file_id])
+      return Level(self.file_id, self.page_count, self.entry_count)
+
+
+def _ranked(items, rank):
+   for key, item_type, value in items:
+      yield key, rank, item_type, value
+
+
+def _merge_items(sources, drop_tombstones):
+   """
+   :synopsis: Merges sorted item sources, the newest first. Only the newest
+              item of each key is kept.
+   """
+   previous = None
+   for key, _, item_type, value in heapq.merge(*[_ranked(s, r) for r, s in enumerate(sources)]):
+      if key == previous:
+         continue
+      previous = key
+      if item_type == TOMBSTONE and drop_tombstones:
+         continue
+      yield key, item_type, value
+
+
+class FDTree(object):
+   """
+   :synopsis: An index of 64-bit integer keys to 64-bit integer values.
+
+   The k and head_capacity of an existing tree are kept from when it was
+   created.
+   """
+   magic = "CQLF"
+   version = 1
+
+   __slots__ = ["filename_base", "metadata_filename", "k", "head_capacity", "mgr", "head",
+                "fence_keys", "levels"]
+   def __init__(self, filename_base, k=DEFAULT_K, head_capacity=DEFAULT_HEAD_CAPACITY,
+                buffer_size=DEFAULT_BUFFER_SIZE, page_size=PAGE_SIZE):
+      """
+      :param filename_base: The level files are named filename_base.N.fdt, and
+                            the metadata file filename_base.meta.
+      :param k: The size ratio of adjacent levels.
+      :param head_capacity: The number of entries the head tree holds before
+                            it is merged into the levels.
+      :param buffer_size: The size of the page cache in bytes.
+      """
+      self.filename_base = filename_base
+      self.metadata_filename = filename_base + ".meta"
+      self.k = k
+      self.head_capacity = head_capacity
+      self.mgr = Manager(size=buffer_size, page_size=page_size, page_factory=RunPage,
+                         filename_base=filename_base, filename_ext="fdt")
+      # The head tree, key -> (type, value).
+      self.head = {}
+      # The lowest key of each page of L1.
+      self.fence_keys = []
+      self.levels = []
+      if os.path.exists(self.metadata_filename):
+         self._load()
+
+   def _capacity(self, i):
+      """
+      :returns: The number of entries that self.levels[i] can hold.
+      """
+      return self.head_capacity * self.k ** (i + 1)
+
+   def _load(self):
+      with open(self.metadata_filename, "rb") as f:
+         data = f.read()
+      crc_size = struct.calcsize(crc_fmt)
+      body = data[:-crc_size]
+      if len(data) < len(self.magic) + crc_size or not body.startswith(self.magic):
+         raise FDTreeError("not an FD-tree metadata file")
+      if struct.unpack(crc_fmt, data[-crc_size:])[0] != zlib.crc32(body) & 0xffffffff:
+         raise FDTreeError("FD-tree metadata checksum mismatch")
+
+      f = StringIO(body)
+      f.seek(len(self.magic))
+      version = varint.decode_stream(f)
+      if version != self.version:
+         raise FDTreeError("unsupported FD-tree metadata version %d" % version)
+      if varint.decode_stream(f) != self.mgr.page_size:
+         raise FDTreeError("FD-tree page size mismatch")
+      self.k = varint.decode_stream(f)
+      self.head_capacity = varint.decode_stream(f)
+      for _ in range(0, varint.decode_stream(f)):
+         level = Level(*struct.unpack(level_fmt, f.read(struct.calcsize(level_fmt))))
+         self.mgr.open_file(level.file_id)
+         self.levels.append(level)
+      count = varint.decode_stream(f)
+      self.fence_keys = list(struct.unpack("<%dQ" % count, f.read(count * 8)))
+
+   def _save(self):
+      """
+      :synopsis: Atomically replaces the metadata file.
+      """
+      f = StringIO()
+      f.write(self.magic)
+      varint.encode_stream(self.version, f)
+      varint.encode_stream(self.mgr.page_size, f)
+      varint.encode_stream(self.k, f)
+      varint.encode_stream(self.head_capacity, f)
+      varint.encode_stream(len(self.levels), f)
+      for level in self.levels:
+         f.write(struct.pack(level_fmt, level.file_id, level.page_count, level.entry_count))
+      varint.encode_stream(len(self.fence_keys), f)
+      f.write(struct.pack("<%dQ" % len(self.fence_keys), *self.fence_keys))
+      data = f.getvalue()
+      data += struct.pack(crc_fmt, zlib.crc32(data) & 0xffffffff)
+
+      tmp_filename = self.metadata_filename + ".tmp"
+      with open(tmp_filename, "wb") as f:
+         f.write(data)
+         sync_file(f)
+      os.rename(tmp_filename, self.metadata_filename)
+      sync_directory(self.metadata_filename)
+
+   def _page(self, level, page):
+      return self.mgr.read_page(page * self.mgr.page_size, level.file_id)
+
+   def _scan(self, level):
+      """
+      :returns: A generator of the pages of a level, read in order without
+                going through the cache.
+      """
+      for page in xrange(0, level.page_count):
+         data = self.mgr.read_page_uncached(page * self.mgr.page_size, level.file_id)
+         yield RunPage(page, level.file_id, data)
+
+   def _level_items(self, level):
+      for p in self._scan(level):
+         for item in p.items:
+            yield item
+
+   def _level_fences(self, level):
+      """
+      :returns: A generator of the (key, page) of the external fences of a
+                level.
+      """
+      for p in self._scan(level):
+         for key, fence_type, page in p.fences:
+            if fence_type == FENCE:
+               yield key, page
+
+   def _write_level(self, items, fences):
+      """
+      :synopsis: Writes a new level from sorted items and sorted fences.
+      :returns: The Level and the lowest key of each of its pages.
+      """
+      writer = LevelWriter(self.mgr)
+      fences = iter(fences)
+      fence = next(fences, None)
+      for key, item_type, value in items:
+         while fence is not None and fence[0] <= key:
+            writer.add(fence[0], FENCE, fence[1])
+            fence = next(fences, None)
+         writer.add(key, item_type, value)
+      while fence is not None:
+         writer.add(fence[0], FENCE, fence[1])
+         fence = next(fences, None)
+      return writer.finish(), writer.los
+
+   def _merge(self):
+      """
+      :synopsis: Merges the head tree into the first level that has room for
+                 it and the levels above, and rewrites those levels with only
+                 fences.
+      """
+      total = len(self.head)
+      j = 0
+      while j < len(self.levels):
+         total += self.levels[j].entry_count
+         if total <= self._capacity(j):
+            break
+         j += 1
+
+      sources = [sorted((key, t, v) for key, (t, v) in self.head.iteritems())]
+      sources.extend(self._level_items(level) for level in self.levels[:j + 1])
+      items = _merge_items(sources, drop_tombstones=j >= len(self.levels) - 1)
+      fences = self._level_fences(self.levels[j]) if j + 1 < len(self.levels) else ()
+      level, los = self._write_level(items, fences)
+
+      new_levels = [level]
+      for _ in range(0, j):
+         level, los = self._write_level((), [(lo, page) for page, lo in enumerate(los)])
+         new_levels.insert(0, level)
+
+      old_levels = self.levels[:j + 1]
+      self.levels = new_levels + self.levels[j + 1:]
+      self.fence_keys = los
+      self.head = {}
+      self._save()
+      for level in old_levels:
+         self.mgr.release_file(level.file_id)
+
+   def _search(self, key):
+      """
+      :returns: The (type, value) of the newest item of 'key' in the levels,
+                or None.
+      """
+      if not self.levels:
+         return None
+      page = bisect.bisect_right(self.fence_keys, key) - 1
+      for i, level in enumerate(self.levels):
+         p = self._page(level, page)
+         item = p.find(key)
+         if item is not None:
+            return item
+         if i + 1 < len(self.levels):
+            page = p.child(key)
+      return None
+
+   def get(self, key, default=None):
+      item = self.head.get(key)
+      if item is None:
+         item = self._search(key)
+      if item is None or item[0] == TOMBSTONE:
+         return default
+      return item[1]
+
+   def set(self, key, value):
+      self.head[key] = (ENTRY, value)
+      if len(self.head) >= self.head_capacity:
+         self._merge()
+
+   def delete(self, key):
+      """
+      :synopsis: Removes 'key'. It is not an error if there is no such key.
+      """
+      self.head[key] = (TOMBSTONE, 0)
+      if len(self.head) >= self.head_capacity:
+         self._merge()
+
+   def _level_range(self, level, page, lo, hi):
+      for page in xrange(page, level.page_count):
+         for key, item_type, value in self._page(level, page).items:
+            if key < lo:
+               continue
+            if hi is not None and key >= hi:
+               return
+            yield key, item_type, value
+
+   def range(self, lo=None, hi=None):
+      """
+      :synopsis: Iterates over the keys from 'lo' up to but not including 'hi',
+                 in order. Either bound may be None to leave that side open.
+                 The tree must not be changed while the iteration runs.
+      :returns: A generator of (key, value) pairs.
+      """
+      lo = lo or 0
+      sources = [sorted((key, t, v) for key, (t, v) in self.head.iteritems()
+                        if key >= lo and (hi is None or key < hi))]
+      page = bisect.bisect_right(self.fence_keys, lo) - 1
+      for i, level in enumerate(self.levels):
+         sources.append(self._level_range(level, page, lo, hi))
+         if i + 1 < len(self.levels):
+            page = self._page(level, page).child(lo)
+      for key, _, value in _merge_items(sources, drop_tombstones=True):
+         yield key, value
+
+   def flush(self):
+      """
+      :synopsis: Merges the head tree into the levels, which makes every entry
+                 durable.
+      """
+      if self.head:
+         self._merge()
+
+   def close(self):
+      self.flush()
+      self.mgr.close()
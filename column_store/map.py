@@ -17,15 +17,32 @@ class Map(object):
    fmt = "<Q"
    fmt_size = struct.calcsize(fmt)
 
-   __slots__ = ["filename", "f"]
-
-   def __init__(self, base_name):
+   __slots__ = ["filename", "f", "size"]
+
+   def __init__(self, base_name, count=None):
+      """
+      :param base_name: The name of the map, without extension.
+      :param count: The number of entries in the map, if the caller knows it.
+                    Otherwise it is taken from the size of the file.
+      """
       self.filename = base_name + ".map"
       self.f = self.f = open(self.filename, "r+b") if os.path.exists(self.filename) else open(self.filename, "w+b")
+      if count is None:
+         self.recount()
+      else:
+         self.size = count
+
+   def recount(self):
+      """
+      :synopsis: Recomputes the number of entries from the size of the file.
+      """
+      self.f.seek(0, 2)
+      self.size = self.f.tell() / self.fmt_size
 
    def append(self, offset):
-      self.f.seek(0, 2)
+      self.f.seek(self.fmt_size * self.size)
       self.f.write(struct.pack(self.fmt, offset))
+      self.size += 1
 
    def delete(self, index):
       self.f.seek(self.fmt_size * index)
@@ -40,9 +57,7 @@ class Map(object):
       return struct.unpack(self.fmt, self.f.read(self.fmt_size))[0]
 
    def count(self):
-      self.f.seek(0, 2)
-      offset = self.f.tell()
-      return offset / self.fmt_size
+      return self.size
 
    def flush(self):
       self.f.flush()
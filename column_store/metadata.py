@@ -0,0 +1,199 @@
+"""
+Per-column metadata.
+
+Everything that would otherwise have to be rediscovered by scanning a column's
+files when it is opened is kept in a small metadata file next to them. The file
+is rewritten atomically on every flush, so it always describes the column as of
+the last flush. The sizes of the column's files are recorded as well; if they
+no longer match, the column was modified after its last flush and the metadata
+must be rebuilt.
+
++------------------------------------+
+| magic "CQLM"                       |
++------------------------------------+
+| version                   (varint) |
++------------------------------------+
+| encoding              (varint+str) |
++------------------------------------+
+| value mode, compression   (varint) |
++------------------------------------+
+| row ordered, last row id  (varint) |
++------------------------------------+
+| tuple count, value count  (varint) |
++------------------------------------+
+| file size * 4             (varint) |
++------------------------------------+
+| block size, block count   (varint) |
++------------------------------------+
+| block start row id * n    (varint) |
++------------------------------------+
+| statistics            (varint+str) |
++------------------------------------+
+| crc32                         (<I) |
++------------------------------------+
+"""
+
+import os
+import struct
+import zlib
+
+from cStringIO import StringIO
+
+from durability import sync_directory, sync_file
+from stats import ColumnStats
+from util import varint
+
+crc_fmt = "<I"
+
+# The order of the column files in file_sizes.
+FILE_VALUES = 0
+FILE_VALUE_MAP = 1
+FILE_STORE = 2
+FILE_STORE_MAP = 3
+FILE_COUNT = 4
+
+
+class MetadataError(Exception):
+   def __init__(self, msg):
+      Exception.__init__(self, msg)
+
+
+def _encode_string(s, f):
+   varint.encode_stream(len(s), f)
+   f.write(s)
+
+
+def _decode_string(f):
+   return f.read(varint.decode_stream(f))
+
+
+class ColumnMetadata(object):
+   """
+   :synopsis: The metadata of a single column.
+
+   The block directory holds the starting row id of every block_size'th tuple in
+   the column store. When the column is row ordered, a lookup can bisect the
+   directory in memory and then only has to binary search a single block of the
+   store.
+   """
+   magic = "CQLM"
+   version = 1
+   block_size = 256
+
+   __slots__ = ["encoding", "value_mode", "compression_level", "row_ordered",
+                "last_row_id", "tuple_count", "value_count", "file_sizes",
+                "blocks", "stats"]
+
+   def __init__(self, encoding, value_mode, compression_level):
+      self.encoding = encoding
+      self.value_mode = value_mode
+      self.compression_level = compression_level
+      self.row_ordered = True
+      self.last_row_id = None
+      self.tuple_count = 0
+      self.value_count = 0
+      self.file_sizes = [0] * FILE_COUNT
+      self.blocks = []
+      self.stats = ColumnStats()
+
+   def add_row(self, row_id):
+      """
+      :synopsis: Records that 'row_id' has been appended to the column.
+      """
+      if self.last_row_id is not None and row_id <= self.last_row_id:
+         self.row_ordered = False
+      self.last_row_id = row_id if self.last_row_id is None else max(row_id, self.last_row_id)
+
+   def add_tuple(self, start_row_id):
+      """
+      :synopsis: Records that a new tuple was appended to the store.
+      """
+      if self.tuple_count % self.block_size == 0:
+         self.blocks.append(start_row_id)
+      self.tuple_count += 1
+
+   def merge_tuple(self, row_id):
+      """
+      :synopsis: Records that 'row_id' was merged into the last tuple in the
+                 store, which may have moved the tuple's starting row id.
+      """
+      if (self.tuple_count - 1) % self.block_size == 0:
+         self.blocks[-1] = min(self.blocks[-1], row_id)
+
+   def block_range(self, block):
+      """
+      :returns: The first and last tuple index in 'block'.
+      """
+      first = block * self.block_size
+      return first, min(first + self.block_size, self.tuple_count) - 1
+
+   def dumps(self):
+      f = StringIO()
+      f.write(self.magic)
+      varint.encode_stream(self.version, f)
+      _encode_string(self.encoding, f)
+      varint.encode_stream(self.value_mode, f)
+      varint.encode_stream(self.compression_level, f)
+      varint.encode_stream(1 if self.row_ordered else 0, f)
+      # Row ids start at zero or above, so -1 is free to mean "no rows".
+      varint.encode_stream(-1 if self.last_row_id is None else self.last_row_id, f)
+      varint.encode_stream(self.tuple_count, f)
+      varint.encode_stream(self.value_count, f)
+      for size in self.file_sizes:
+         varint.encode_stream(size, f)
+      varint.encode_stream(self.block_size, f)
+      varint.encode_stream(len(self.blocks), f)
+      for row_id in self.blocks:
+         varint.encode_stream(row_id, f)
+      _encode_string(self.stats.dumps(), f)
+
+      data = f.getvalue()
+      return data + struct.pack(crc_fmt, zlib.crc32(data) & 0xffffffff)
+
+   @classmethod
+   def loads(cls, data):
+      crc_size = struct.calcsize(crc_fmt)
+      body = data[:-crc_size]
+      if len(data) < len(cls.magic) + crc_size or not body.startswith(cls.magic):
+         raise MetadataError("not a column metadata file")
+      if struct.unpack(crc_fmt, data[-crc_size:])[0] != zlib.crc32(body) & 0xffffffff:
+         raise MetadataError("column metadata checksum mismatch")
+
+      f = StringIO(body)
+      f.seek(len(cls.magic))
+      version = varint.decode_stream(f)
+      if version != cls.version:
+         raise MetadataError("unsupported column metadata version %d" % version)
+
+      m = cls(_decode_string(f), varint.decode_stream(f), varint.decode_stream(f))
+      m.row_ordered = varint.decode_stream(f) == 1
+      last_row_id = varint.decode_stream(f)
+      m.last_row_id = None if last_row_id < 0 else last_row_id
+      m.tuple_count = varint.decode_stream(f)
+      m.value_count = varint.decode_stream(f)
+      m.file_sizes = [varint.decode_stream(f) for _ in range(0, FILE_COUNT)]
+      if varint.decode_stream(f) != cls.block_size:
+         raise MetadataError("column metadata block size mismatch")
+      m.blocks = [varint.decode_stream(f) for _ in range(0, varint.decode_stream(f))]
+      m.stats = ColumnStats.loads(_decode_string(f))
+      return m
+
+   def save(self, filename, sync=False):
+      """
+      :synopsis: Atomically replaces 'filename' with this metadata.
+      :param sync: If True the new file is fsynced before it replaces the old
+                   one, and the rename itself is made durable.
+      """
+      tmp_filename = filename + ".tmp"
+      with open(tmp_filename, "wb") as f:
+         f.write(self.dumps())
+         if sync:
+            sync_file(f)
+      os.rename(tmp_filename, filename)
+      if sync:
+         sync_directory(filename)
+
+   @classmethod
+   def load(cls, filename):
+      with open(filename, "rb") as f:
+         return cls.loads(f.read())
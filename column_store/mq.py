@@ -40,29 +40,63 @@ class Cache(object):
       for i, q in enumerate(self.queues):
          # If we are over capacity, or if a block has expired, move it to the
          # next level down.
-         if len(q) > self.capacity or (len(q) and q[q.keys()[0]] < self.current_time):
-            key, value = q.popitem(False)
-            level_down = i - 1
-            # If we are not at the very bottom, then just move it down a level
-            if level_down >= 0:
-               self.queues[level_down][key] = value
-            # Otherwise we must evict the value. Inform the user.
-            else:
-               if self.on_evict:
-                  self.on_evict(key, self.cache[key][1])
-               del self.cache[key]
-               # Save the access count for this block. That way, if we
-               # load it again before we run out of history space, we
-               # can automatically promote it into the right level.
-               self.history[key] = value[1]
-               # If we are over-capcity then remove the oldest entry.
-               if len(self.history) > self.capacity * 2:
-                  self.history.popitem(False)
+         if len(q) > self.capacity or (len(q) and q[next(iter(q))] < self.current_time):
+            self._demote(i)
+
+      # The capacity bounds the whole cache, not just each queue. Blocks are
+      # taken from the lowest queue that has any.
+      while len(self.cache) > self.capacity:
+         self._demote(next(i for i, q in enumerate(self.queues) if q))
+
+   def _demote(self, i):
+      """
+      :synopsis: Moves the least recently used block in queue 'i' down a level,
+                 or evicts it if 'i' is the bottom queue.
+      """
+      key, value = self.queues[i].popitem(False)
+      level_down = i - 1
+      # If we are not at the very bottom, then just move it down a level
+      if level_down >= 0:
+         self.queues[level_down][key] = value
+         self.cache[key] = (level_down, self.cache[key][1])
+      # Otherwise we must evict the value. Inform the user.
+      else:
+         if self.on_evict:
+            self.on_evict(key, self.cache[key][1])
+         del self.cache[key]
+         # Save the access count for this block. That way, if we
+         # load it again before we run out of history space, we
+         # can automatically promote it into the right level.
+         self.history[key] = value[1]
+         # If we are over-capcity then remove the oldest entry.
+         if len(self.history) > self.capacity * 2:
+            self.history.popitem(False)
 
    def iteritems(self):
-      for k, v in self.cache.iteritems():
+      for k, (_, v) in self.cache.iteritems():
          yield (k, v)
 
+   def __len__(self):
+      return len(self.cache)
+
+   def remove(self, key):
+      """
+      :synopsis: Drops 'key' from the cache without calling the eviction
+                 handler.
+      :returns: The value that was stored with 'key', or None.
+      """
+      level, value = self.cache.pop(key, (None, None))
+      if level is not None:
+         del self.queues[level][key]
+      return value
+
+   def peek(self, key):
+      """
+      :synopsis: Returns the value stored with 'key', or None, without counting
+                 it as an access.
+      """
+      return self.cache.get(key, (None, None))[1]
+
    def get(self, key, default=None):
       """
       :synopsis: Tries to return the value associated with 'key'. If the
@@ -80,13 +114,13 @@ class Cache(object):
             self.put(key, default)
          return default
 
-      _, access_count = self.queues[level][key]
+      # Re-inserting the block makes it the most recently used in its queue.
+      _, access_count = self.queues[level].pop(key)
       expire_time = self.current_time + self.life_time
       access_count += 1
 
       requested_level = int(min(math.log(access_count, 2), self.queue_count - 1))
       if requested_level > level:
-         del self.queues[level][key]
          level = requested_level
          self.cache[key] = (level, value)
 
@@ -104,7 +138,10 @@ class Cache(object):
       many accesses it had. We use this to promote a frequently accessed block
       into a higher level than a brand new block.
       """
-      access_count = self.history.get(key, 1)
+      if key in self.cache:
+         _, access_count = self.queues[self.cache[key][0]].pop(key)
+      else:
+         access_count = self.history.get(key, 1)
       level = min(int(math.log(access_count, 2)), self.queue_count - 1)
       self.queues[level][key] = (self.current_time + self.life_time, access_count)
       self.cache[key] = (level, value)
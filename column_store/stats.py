@@ -0,0 +1,317 @@
+"""
+Column statistics that are maintained incrementally as rows are appended.
+
+The statistics are intended for selectivity estimation. None of them require a
+scan of the column: the distinct count comes from a HyperLogLog sketch, and the
+equi-depth histogram is rebuilt from a fixed-size reservoir sample of the
+non-null rows. Both are bounded in size no matter how large the column gets.
+"""
+
+import bisect
+import hashlib
+import math
+import random
+import struct
+
+from cStringIO import StringIO
+
+from util import varint
+
+TYPE_STR = 0
+TYPE_INT = 1
+TYPE_FLOAT = 2
+TYPE_UNICODE = 3
+
+float_fmt = "<d"
+
+
+def _hash64(value):
+   if not isinstance(value, str):
+      value = repr(value)
+   return struct.unpack_from("<Q", hashlib.md5(value).digest())[0]
+
+
+def _encode_value(value, f):
+   if isinstance(value, str):
+      f.write(chr(TYPE_STR))
+      varint.encode_stream(len(value), f)
+      f.write(value)
+   elif isinstance(value, unicode):
+      value = value.encode("utf-8")
+      f.write(chr(TYPE_UNICODE))
+      varint.encode_stream(len(value), f)
+      f.write(value)
+   elif isinstance(value, float):
+      f.write(chr(TYPE_FLOAT))
+      f.write(struct.pack(float_fmt, value))
+   else:
+      f.write(chr(TYPE_INT))
+      varint.encode_stream(value, f)
+
+
+def _decode_value(f):
+   value_type = ord(f.read(1))
+   if value_type == TYPE_INT:
+      return varint.decode_stream(f)
+   if value_type == TYPE_FLOAT:
+      return struct.unpack(float_fmt, f.read(struct.calcsize(float_fmt)))[0]
+
+   value = f.read(varint.decode_stream(f))
+   if value_type == TYPE_UNICODE:
+      return value.decode("utf-8")
+   return value
+
+
+class HyperLogLog(object):
+   """
+   :synopsis: Estimates the number of distinct values that have been added.
+
+   Uses 2^precision one-byte registers. The default precision of 12 uses 4k of
+   memory and has a standard error of about 1.6%.
+   """
+   __slots__ = ["precision", "registers", "estimate"]
+
+   def __init__(self, precision=12, registers=None):
+      self.precision = precision
+      self.registers = registers if registers is not None else bytearray(1 << precision)
+      self.estimate = None
+
+   def add(self, value):
+      """
+      :synopsis: Adds a value to the sketch.
+      :returns: True if the sketch changed.
+      """
+      h = _hash64(value)
+      remaining_bits = 64 - self.precision
+      index = h >> remaining_bits
+      w = h & ((1 << remaining_bits) - 1)
+      rank = remaining_bits - w.bit_length() + 1
+      if rank <= self.registers[index]:
+         return False
+
+      self.registers[index] = rank
+      self.estimate = None
+      return True
+
+   def count(self):
+      """
+      :synopsis: Returns the estimated distinct count. The estimate is cached
+                 until the sketch changes.
+      """
+      if self.estimate is not None:
+         return self.estimate
+
+      m = len(self.registers)
+      alpha = 0.7213 / (1.0 + 1.079 / m)
+      total = 0.0
+      zeros = 0
+      for r in self.registers:
+         total += 1.0 / (1 << r)
+         if r == 0:
+            zeros += 1
+
+      estimate = alpha * m * m / total
+      # Small range correction: linear counting is much more accurate while
+      # many registers are still empty.
+      if estimate <= 2.5 * m and zeros:
+         estimate = m * math.log(float(m) / zeros)
+
+      self.estimate = int(round(estimate))
+      return self.estimate
+
+
+class Histogram(object):
+   """
+   :synopsis: An equi-depth histogram.
+
+   'bounds' holds bucket_count + 1 sorted values. Bucket i covers the range
+   (bounds[i], bounds[i + 1]] and holds roughly the same number of rows as every
+   other bucket. A value that appears in many rows will appear as several
+   consecutive bounds.
+   """
+   __slots__ = ["bounds"]
+
+   def __init__(self, bounds=None):
+      self.bounds = bounds or []
+
+   @classmethod
+   def from_sample(cls, sample, bucket_count):
+      if not sample:
+         return cls()
+
+      values = sorted(sample)
+      buckets = min(bucket_count, len(values))
+      last = len(values) - 1
+      bounds = [values[(i * last) / buckets] for i in range(0, buckets + 1)]
+      return cls(bounds)
+
+   def bucket_count(self):
+      return max(len(self.bounds) - 1, 0)
+
+   def range_selectivity(self, lo=None, hi=None):
+      """
+      :synopsis: Estimates the fraction of non-null rows in [lo, hi]. Either
+                 bound may be None to leave that side of the range open.
+      """
+      if self.bucket_count() == 0:
+         return 0.0
+
+      below = 0.0 if lo is None else self._fraction_below(lo)
+      at_or_below = 1.0 if hi is None else self._fraction_at_or_below(hi)
+      return max(at_or_below - below, 0.0)
+
+   def equality_selectivity(self, value):
+      """
+      :synopsis: Estimates the fraction of non-null rows equal to 'value' from
+                 the number of buckets the value spans. Values which do not span
+                 a bucket boundary return 0.0; the caller should fall back to the
+                 distinct count for those.
+      """
+      buckets = self.bucket_count()
+      if buckets == 0:
+         return 0.0
+
+      spanned = bisect.bisect_right(self.bounds, value) - bisect.bisect_left(self.bounds, value)
+      return max(spanned - 1, 0) / float(buckets)
+
+   def _fraction_below(self, value):
+      # We cannot interpolate between arbitrary values, so a value that falls
+      # inside a bucket is assumed to split it in half.
+      i = bisect.bisect_left(self.bounds, value)
+      if i == 0:
+         return 0.0
+      if i == len(self.bounds):
+         return 1.0
+      return (i - 0.5) / self.bucket_count()
+
+   def _fraction_at_or_below(self, value):
+      i = bisect.bisect_right(self.bounds, value)
+      if i == 0:
+         return 0.0
+      if i == len(self.bounds):
+         return 1.0
+      if self.bounds[i - 1] == value:
+         return float(i - 1) / self.bucket_count()
+      return (i - 0.5) / self.bucket_count()
+
+
+class ColumnStats(object):
+   """
+   :synopsis: Statistics for a single column: row count, null count, distinct
+   count estimate and an equi-depth histogram.
+
+   add() and add_null() are O(1). The histogram is rebuilt from the reservoir
+   sample only when it is requested after the sample has changed, so its cost
+   is bounded by the sample size rather than the row count.
+   """
+   version = 1
+   sample_size = 1024
+   bucket_count = 32
+
+   __slots__ = ["row_count", "null_count", "sketch", "sample", "histogram_cache",
+                "random"]
+
+   def __init__(self, precision=12):
+      self.row_count = 0
+      self.null_count = 0
+      self.sketch = HyperLogLog(precision)
+      self.sample = []
+      self.histogram_cache = None
+      self.random = random.Random(0)
+
+   def add(self, value, repeated=False):
+      """
+      :synopsis: Records a non-null value.
+      :param value: The value being appended.
+      :param repeated: True if value is known to be identical to the previous
+                       value. A repeated value cannot change the sketch.
+      """
+      self.row_count += 1
+      if not repeated:
+         self.sketch.add(value)
+
+      # Reservoir sampling over the non-null rows.
+      if len(self.sample) < self.sample_size:
+         self.sample.append(value)
+         self.histogram_cache = None
+      else:
+         i = self.random.randint(0, self.row_count - self.null_count - 1)
+         if i < self.sample_size:
+            self.sample[i] = value
+            self.histogram_cache = None
+
+   def add_null(self):
+      self.row_count += 1
+      self.null_count += 1
+
+   @property
+   def distinct_count(self):
+      return self.sketch.count()
+
+   @property
+   def histogram(self):
+      if self.histogram_cache is None:
+         self.histogram_cache = Histogram.from_sample(self.sample, self.bucket_count)
+      return self.histogram_cache
+
+   def null_fraction(self):
+      if self.row_count == 0:
+         return 0.0
+      return float(self.null_count) / self.row_count
+
+   def equality_selectivity(self, value):
+      """
+      :synopsis: Estimates the fraction of all rows equal to 'value'.
+      """
+      if value is None:
+         return self.null_fraction()
+
+      h = self.histogram
+      if not h.bounds or value < h.bounds[0] or value > h.bounds[-1]:
+         return 0.0
+
+      estimate = h.equality_selectivity(value)
+      distinct = self.distinct_count
+      if distinct:
+         estimate = max(estimate, 1.0 / distinct)
+      return estimate * (1.0 - self.null_fraction())
+
+   def range_selectivity(self, lo=None, hi=None):
+      """
+      :synopsis: Estimates the fraction of all rows in [lo, hi].
+      """
+      return self.histogram.range_selectivity(lo, hi) * (1.0 - self.null_fraction())
+
+   def dumps(self):
+      """
+      :synopsis: Serializes the statistics into a string.
+      """
+      f = StringIO()
+      varint.encode_stream(self.version, f)
+      varint.encode_stream(self.row_count, f)
+      varint.encode_stream(self.null_count, f)
+      varint.encode_stream(self.sketch.precision, f)
+      f.write(str(self.sketch.registers))
+      varint.encode_stream(len(self.sample), f)
+      for value in self.sample:
+         _encode_value(value, f)
+      return f.getvalue()
+
+   @classmethod
+   def loads(cls, data):
+      """
+      :synopsis: Creates statistics from a string written by dumps().
+      """
+      f = StringIO(data)
+      version = varint.decode_stream(f)
+      if version != cls.version:
+         raise ValueError("unsupported column statistics version %d" % version)
+
+      s = cls()
+      s.row_count = varint.decode_stream(f)
+      s.null_count = varint.decode_stream(f)
+      precision = varint.decode_stream(f)
+      s.sketch = HyperLogLog(precision, bytearray(f.read(1 << precision)))
+      s.sample = [_decode_value(f) for _ in range(0, varint.decode_stream(f))]
+      s.random = random.Random(s.row_count)
+      return s
@@ -7,6 +7,11 @@ from test_value_store import TestValueStore
 from test_column import TestColumn
 from test_mq_cache import TestMqCache
 from test_buffer import TestBuffer
+from test_stats import TestStats
+from test_metadata import TestMetadata
+from test_durability import TestDurability
+from test_benchmark import TestBenchmark
+from test_fdtree import TestFDTree
 #from test_page import TestPage
 
 class TestPass(unittest.TestCase):
@@ -0,0 +1,25 @@
+import unittest
+
+class TestBenchmark(unittest.TestCase):
+   def test_can_run(self):
+      from column_store import benchmark
+      results = list(benchmark.run(rows=50, queries=10, datasets=["sorted", "long_strings"]))
+      expected = 2 * (len(benchmark.STORE_FACTORIES) + len(benchmark.VALUE_STORE_MODES))
+      self.assertEqual(len(results), expected)
+      for r in results:
+         self.assertEqual(r["rows"], 50)
+         self.assertTrue(r["bytes_on_disk"] > 0)
+         self.assertTrue("p99" in r["get_latency_us"])
+
+   def test_runs_do_not_share_files(self):
+      import shutil
+      import tempfile
+      from column_store import benchmark
+      directory = tempfile.mkdtemp()
+      try:
+         first, second = [[r["bytes_on_disk"] for r in
+                           benchmark.run(rows=50, queries=10, datasets=["sorted"],
+                                         directory=directory)] for _ in range(0, 2)]
+         self.assertEqual(first, second)
+      finally:
+         shutil.rmtree(directory)
@@ -0,0 +1,80 @@
+import os
+import threading
+import unittest
+
+from glob import glob
+
+class TestDurability(unittest.TestCase):
+   def setUp(self):
+      files = glob("test_table.test_durable*")
+      for f in files:
+         os.unlink(f)
+
+   def test_per_flush(self):
+      from column_store.column import Column
+      from column_store.durability import DURABILITY_PER_FLUSH
+      c = Column("test_table", "test_durable", durability=DURABILITY_PER_FLUSH)
+      for row_id in range(1, 10):
+         c.append(row_id, "value %d" % row_id)
+      c.flush()
+      del c
+
+      c = Column("test_table", "test_durable", durability=DURABILITY_PER_FLUSH)
+      self.assertEqual(c.get(9), "value 9")
+
+   def test_recovery_truncates_to_commit(self):
+      from column_store.column import Column
+      from column_store.durability import DURABILITY_PER_FLUSH
+      c = Column("test_table", "test_durable", durability=DURABILITY_PER_FLUSH)
+      c.append(1, "committed")
+      c.append(2, "committed")
+      c.flush()
+      sizes = c._file_sizes()
+
+      # Simulate a crash after more data reached the files, but before the
+      # next commit.
+      c.append(3, "committed")
+      c.append(4, "lost")
+      for f in c._files():
+         f.flush()
+      del c
+
+      c = Column("test_table", "test_durable", durability=DURABILITY_PER_FLUSH)
+      self.assertEqual(c._file_sizes(), sizes)
+      self.assertEqual(c.get(2), "committed")
+      self.assertEqual(c.get(3), None)
+      self.assertEqual(c.get(4), None)
+
+      c.append(3, "after")
+      self.assertEqual(c.get(2), "committed")
+      self.assertEqual(c.get(3), "after")
+
+   def test_group_commit(self):
+      from column_store.column import Column
+      from column_store.durability import DURABILITY_GROUP_COMMIT, GroupCommit
+      gc = GroupCommit(window=0.01)
+      columns = [Column("test_table", "test_durable%d" % i,
+                        durability=DURABILITY_GROUP_COMMIT, group_commit=gc)
+                 for i in range(0, 8)]
+
+      def writer(c):
+         for row_id in range(1, 50):
+            c.append(row_id, "value %d" % row_id)
+            if row_id % 10 == 0:
+               c.flush()
+         c.flush()
+
+      threads = [threading.Thread(target=writer, args=(c,)) for c in columns]
+      for t in threads:
+         t.start()
+      for t in threads:
+         t.join()
+
+      # Fewer sync passes than flushes were needed.
+      self.assertTrue(gc.completed < 8 * 5, gc.completed)
+      del columns
+
+      for i in range(0, 8):
+         c = Column("test_table", "test_durable%d" % i,
+                    durability=DURABILITY_GROUP_COMMIT, group_commit=gc)
+         self.assertEqual(c.get(49), "value 49")
@@ -0,0 +1,78 @@
+import os
+import random
+import unittest
+
+from glob import glob
+
+class TestFDTree(unittest.TestCase):
+   filename_base = "test_fdtree"
+
+   def setUp(self):
+      for filename in glob(self.filename_base + ".*"):
+         os.unlink(filename)
+
+   def tearDown(self):
+      self.setUp()
+
+   def _tree(self, **options):
+      from column_store.fdtree import FDTree
+      return FDTree(self.filename_base, page_size=256, buffer_size=256 * 8, **options)
+
+   def test_set_and_get(self):
+      t = self._tree(k=3, head_capacity=16)
+      for key in range(0, 2000):
+         t.set(key * 7 % 2000, key)
+      self.assertTrue(len(t.levels) > 2)
+      for key in range(0, 2000):
+         self.assertEqual(t.get(key * 7 % 2000), key)
+      self.assertEqual(t.get(2000), None)
+      self.assertEqual(t.get(2000, "missing"), "missing")
+
+   def test_updates_and_deletes(self):
+      t = self._tree(k=2, head_capacity=8)
+      rng = random.Random(0)
+      expected = {}
+      for _ in range(0, 5000):
+         key = rng.randint(0, 500)
+         if rng.random() < 0.3:
+            t.delete(key)
+            expected.pop(key, None)
+         else:
+            t.set(key, rng.randint(0, 2 ** 64 - 1))
+            expected[key] = t.get(key)
+      for key in range(0, 501):
+         self.assertEqual(t.get(key), expected.get(key))
+      self.assertEqual(list(t.range()), sorted(expected.items()))
+      self.assertEqual(list(t.range(100, 200)),
+                       sorted((k, v) for k, v in expected.items() if 100 <= k < 200))
+
+   def test_lookup_reads_one_page_per_level(self):
+      t = self._tree(k=3, head_capacity=16)
+      for key in range(0, 3000):
+         t.set(key, key)
+      t.close()
+
+      t = self._tree()
+      reads = []
+      read_page_uncached = t.mgr.read_page_uncached
+      def counting(page_id, file_id):
+         reads.append(file_id)
+         return read_page_uncached(page_id, file_id)
+      t.mgr.read_page_uncached = counting
+      self.assertEqual(t.get(1234), 1234)
+      self.assertEqual(len(reads), len(t.levels))
+
+   def test_reopen(self):
+      t = self._tree(k=4, head_capacity=32)
+      for key in range(0, 1000):
+         t.set(key, key + 1)
+      t.delete(10)
+      t.close()
+
+      t = self._tree()
+      self.assertEqual((t.k, t.head_capacity), (4, 32))
+      self.assertEqual(t.get(10), None)
+      for key in range(11, 1000):
+         self.assertEqual(t.get(key), key + 1)
+      # Only the files of the current levels are left.
+      self.assertEqual(len(glob(self.filename_base + ".*.fdt")), len(t.levels))
@@ -0,0 +1,113 @@
+import os
+import unittest
+
+from glob import glob
+
+class TestMetadata(unittest.TestCase):
+   def setUp(self):
+      files = glob("test_table.test_meta.*")
+      for f in files:
+         os.unlink(f)
+
+   def _fill(self, c, rows):
+      # Alternate values so that every row becomes its own tuple.
+      for row_id in range(1, rows + 1):
+         c.append(row_id, "value %d" % (row_id % 2))
+
+   def test_metadata_persists(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_meta")
+      self._fill(c, 600)
+      c.flush()
+      del c
+
+      c = Column("test_table", "test_meta")
+      self.assertEqual(c.metadata.tuple_count, 600)
+      self.assertEqual(c.metadata.value_count, 2)
+      self.assertEqual(c.metadata.last_row_id, 600)
+      self.assertTrue(c.metadata.row_ordered)
+      self.assertEqual(len(c.metadata.blocks), 3)
+      self.assertEqual(c.count(), 600)
+      for row_id in (1, 256, 257, 513, 600):
+         self.assertEqual(c.get(row_id), "value %d" % (row_id % 2))
+      self.assertEqual(c.get(601), None)
+
+   def test_metadata_rebuilt_when_not_flushed(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_meta")
+      self._fill(c, 100)
+      c.flush()
+      c.append(101, None)
+      c.append(102, "value 0")
+      c.append(103, "value 0")
+      c.store.flush()
+      c.store_map.flush()
+      del c
+
+      c = Column("test_table", "test_meta")
+      self.assertEqual(c.metadata.tuple_count, 101)
+      self.assertEqual(c.metadata.last_row_id, 103)
+      self.assertEqual(c.stats().row_count, 103)
+      self.assertEqual(c.stats().null_count, 1)
+      self.assertEqual(c.get(103), "value 0")
+
+   def test_flushed_trailing_null_counted_once(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_meta")
+      self._fill(c, 100)
+      c.append(101, None)
+      c.flush()
+      c.append(102, "value 0")
+      c.store.flush()
+      c.store_map.flush()
+      del c
+
+      c = Column("test_table", "test_meta")
+      self.assertEqual(c.metadata.last_row_id, 102)
+      self.assertEqual(c.stats().row_count, 102)
+      self.assertEqual(c.stats().null_count, 1)
+
+   def test_out_of_order_rows(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_meta")
+      c.append(10, "a")
+      c.append(5, "b")
+      c.append(20, "c")
+      self.assertFalse(c.metadata.row_ordered)
+      self.assertEqual(c.get(5), "b")
+      self.assertEqual(c.get(10), "a")
+      c.flush()
+      del c
+
+      c = Column("test_table", "test_meta")
+      self.assertFalse(c.metadata.row_ordered)
+      self.assertEqual(c.get(20), "c")
+
+   def test_corrupt_metadata_is_rebuilt(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_meta")
+      self._fill(c, 10)
+      c.flush()
+      del c
+
+      with open("test_table.test_meta.meta", "r+b") as f:
+         f.seek(8)
+         f.write("\xff")
+
+      c = Column("test_table", "test_meta")
+      self.assertEqual(c.metadata.tuple_count, 10)
+      self.assertEqual(c.get(10), "value 0")
+
+   def test_encoding_mismatch(self):
+      from column_store.column import Column
+      from column_store.rle import RleColumnStore
+
+      class OtherStore(RleColumnStore):
+         pass
+
+      c = Column("test_table", "test_meta")
+      c.append(1, "a")
+      c.flush()
+      del c
+
+      self.assertRaises(ValueError, Column, "test_table", "test_meta", OtherStore)
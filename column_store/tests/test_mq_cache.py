@@ -85,3 +85,51 @@ class TestMqCache(unittest.TestCase):
 
 
 
+   def test_capacity_bounds_every_queue(self):
+      from column_store.mq import Cache
+      c = Cache(capacity=32, queue_count=4)
+      for i in range(0, 256):
+         c.put(i, i)
+         c.get(i)
+         c.get(i)
+         self.assertTrue(len(c) <= 32)
+
+   def test_get_after_demotion(self):
+      from column_store.mq import Cache
+      c = Cache(capacity=8, queue_count=4)
+      for i in range(0, 8):
+         c.put(i, i)
+         c.get(i)
+      self.assertEqual(8, len(c.queues[1]))
+      # The new blocks are the least recently used ones in the bottom queue,
+      # so they are the ones evicted.
+      for i in range(8, 16):
+         c.put(i, i)
+      self.assertTrue(len(c) <= 8)
+      for i in range(0, 8):
+         self.assertEqual(i, c.get(i))
+
+      # A block moved down a level is still found there.
+      for i in range(0, 4):
+         c._demote(1)
+      self.assertEqual(4, len(c.queues[0]))
+      for i in range(0, 8):
+         self.assertEqual(i, c.get(i))
+      self.assertTrue(len(c) <= 8)
+
+   def test_remove(self):
+      from column_store.mq import Cache
+      c = Cache(capacity=16)
+      c.put(1, "one")
+      self.assertEqual(c.remove(1), "one")
+      self.assertEqual(c.get(1), None)
+      self.assertEqual(c.remove(1), None)
+
+   def test_peek(self):
+      from column_store.mq import Cache
+      c = Cache(capacity=16)
+      c.put(1, "one")
+      access_count = c.queues[c.cache[1][0]][1][1]
+      self.assertEqual(c.peek(1), "one")
+      self.assertEqual(c.queues[c.cache[1][0]][1][1], access_count)
+      self.assertEqual(c.peek(2), None)
@@ -0,0 +1,68 @@
+import os
+import unittest
+
+from glob import glob
+
+class TestStats(unittest.TestCase):
+   def setUp(self):
+      files = glob("test_table.test_stats.*")
+      for f in files:
+         os.unlink(f)
+
+   def test_distinct_count(self):
+      from column_store.stats import HyperLogLog
+      h = HyperLogLog()
+      for i in range(0, 20000):
+         h.add("value %d" % i)
+         h.add("value %d" % i)
+      self.assertTrue(abs(h.count() - 20000) < 20000 * 0.05, h.count())
+
+   def test_histogram_selectivity(self):
+      from column_store.stats import ColumnStats
+      s = ColumnStats()
+      for i in range(0, 10000):
+         s.add(i)
+      self.assertAlmostEqual(s.range_selectivity(0, 4999), 0.5, delta=0.1)
+      self.assertAlmostEqual(s.range_selectivity(lo=9000), 0.1, delta=0.05)
+      self.assertEqual(s.range_selectivity(20000, 30000), 0.0)
+      self.assertEqual(s.equality_selectivity(-1), 0.0)
+
+   def test_skewed_equality_selectivity(self):
+      from column_store.stats import ColumnStats
+      s = ColumnStats()
+      for i in range(0, 1000):
+         s.add("common" if i % 2 else "rare %d" % i)
+      self.assertAlmostEqual(s.equality_selectivity("common"), 0.5, delta=0.1)
+
+   def test_column_stats(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_stats")
+      row_id = 1
+      for i in range(0, 10):
+         for _ in range(0, 10):
+            c.append(row_id, "value %d" % i)
+            row_id += 1
+      c.append(row_id, None)
+
+      s = c.stats()
+      self.assertEqual(s.row_count, 101)
+      self.assertEqual(s.null_count, 1)
+      self.assertEqual(s.distinct_count, 10)
+      self.assertEqual(c.get(row_id), None)
+
+   def test_stats_persist(self):
+      from column_store.column import Column
+      c = Column("test_table", "test_stats")
+      for row_id in range(1, 100):
+         c.append(row_id, "value %d" % row_id)
+      c.append(100, None)
+      c.flush()
+      bounds = c.stats().histogram.bounds
+      del c
+
+      c = Column("test_table", "test_stats")
+      s = c.stats()
+      self.assertEqual(s.row_count, 100)
+      self.assertEqual(s.null_count, 1)
+      self.assertEqual(s.distinct_count, 99)
+      self.assertEqual(s.histogram.bounds, bounds)
@@ -71,8 +71,26 @@ class TestValueStore(unittest.TestCase):
       for i, o in enumerate(ol):
          self.assertEqual(v.get(o), i)
 
+   def test_can_get_view(self):
+      from column_store.value_store import ValueStore
+      v = ValueStore(self.filename)
+      o = v.append("this is a test 123")
+      self.assertEqual(str(v.get_view(o)), "this is a test 123")
 
+      # Values appended after the file was mapped are visible too.
+      ol = [v.append("value %d" % i) for i in range(0, 1000)]
+      for i, o in enumerate(ol):
+         self.assertEqual(str(v.get_view(o)), "value %d" % i)
 
+   def test_can_get_user_view(self):
+      from column_store.value_store import ValueStore
+      test_string = "this is a test 123"
+      v = ValueStore(self.filename, mode=ValueStore.DATA_MODE_USER)
+      o = v.append(test_string)
+      self.assertEqual(str(v.get_view(o, size=len(test_string))), test_string)
 
-
-
+   def test_compressed_view_fails(self):
+      from column_store.value_store import ValueStore
+      v = ValueStore(self.filename, mode=ValueStore.DATA_MODE_COMPRESSED)
+      o = v.append("this is a test 123")
+      self.assertRaises(ValueError, v.get_view, o)
@@ -4,6 +4,7 @@ Created on May 16, 2013
 @author: christopher
 '''
 
+import mmap
 import os
 import struct
 import zlib
@@ -41,11 +42,25 @@ class ValueStore(object):
    DATA_MODE_USER_COMPRESSED = 4
    DATA_MODE_PACKED_INT = 5
 
-   __slots__ = ["filename", "f", "mode", "compression_level"]
+   __slots__ = ["filename", "f", "mode", "compression_level", "map", "view"]
 
-   def __init__(self, base_name, mode=1, compression_level=zlib.Z_BEST_SPEED):
+   def __init__(self, base_name, mode=1, compression_level=zlib.Z_BEST_SPEED, header_known=False):
+      """
+      :param header_known: True if the caller already knows the mode and
+                           compression level of an existing store (from column
+                           metadata, for example). The header is then not read.
+      """
       self.filename = base_name + ".values"
-      self.f = self._load_existing() if os.path.exists(self.filename) else self._initialize(mode, compression_level)
+      self.map = None
+      self.view = None
+      if not os.path.exists(self.filename):
+         self.f = self._initialize(mode, compression_level)
+      elif header_known:
+         self.f = open(self.filename, "r+b")
+         self.mode = mode
+         self.compression_level = compression_level
+      else:
+         self.f = self._load_existing()
 
    def _load_existing(self):
       f = open(self.filename, "r+b")
@@ -101,5 +116,46 @@ class ValueStore(object):
 
       return value
 
+   def _mapping(self, end):
+      """
+      :synopsis: Returns an mmap of the values file that covers at least the
+                 first 'end' bytes, remapping the file if it has grown.
+      """
+      if self.map is None or len(self.map) < end:
+         self.f.flush()
+         # Views handed out earlier keep the old mapping alive, so it is left
+         # for the garbage collector rather than closed.
+         self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+         try:
+            self.view = memoryview(self.map)
+         except TypeError:
+            # Python 2 mmaps only support the old buffer interface.
+            self.view = None
+      return self.map
+
+   def get_view(self, offset, size=0):
+      """
+      :synopsis: Like get(), but returns a read-only view of the value in the
+                 values file instead of a copy of it.
+      :param offset: The offset returned by append().
+      :param size: The size of the value, for DATA_MODE_USER.
+      :returns: A memoryview (or a buffer where mmaps do not support
+                memoryview) that is valid for as long as it is referenced.
+
+      Only the uncompressed byte modes, DATA_MODE_PACKED and DATA_MODE_USER,
+      support views.
+      """
+      if self.mode not in (self.DATA_MODE_PACKED, self.DATA_MODE_USER):
+         raise ValueError("value store mode %d does not support views" % self.mode)
+
+      m = self._mapping(offset + 1)
+      if self.mode == self.DATA_MODE_PACKED:
+         size, offset = varint.decode_from(m, offset)
+      m = self._mapping(offset + size)
+
+      if self.view is not None:
+         return self.view[offset:offset + size]
+      return buffer(m, offset, size)
+
    def flush(self):
       self.f.flush()
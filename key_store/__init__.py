@@ -3,9 +3,35 @@ The key_store package implements an atomic key/value storage facility. The
 values are compressed where that makes sense. Updates and inserts are performed 
 atomically and conform to ACID semantics.
 
-They key store itself is not thread safe. You must arrange for thread safety
-yourself. They key store data file cannot be used by concurrent processes. The
-assumption is that only one thread is accessing the file at any one time.
+The key store has a single writer. Only one thread may change a data file, or
+read it directly, at any one time. Any number of other threads can read the
+file at the same time through snapshots, which see the file as of a commit and
+never wait for the writer. A data file opened as shared can also be read
+by other processes, which see it as of the writer's last checkpoint.
+
+There are two storage engines with the same get/set/delete interface: the
+extendible hash of datafile.DataFile, and the log-structured merge tree of
+lsm.LSMStore, which suits tables that are mostly written. open_store() picks
+one by name, so a table can change engine without changing its code.
 """
 __version__ = 1.0
 
+# The storage engines that open_store() knows.
+ENGINES = ("hash", "lsm")
+
+
+def open_store(filename, engine="hash", **options):
+   """
+   :synopsis: Opens a key store.
+   :param engine: "hash" for a datafile.DataFile, or "lsm" for an
+                  lsm.LSMStore.
+   :param options: Passed to the engine.
+   """
+   if engine == "hash":
+      from key_store.datafile import DataFile
+      return DataFile(filename, **options)
+   if engine == "lsm":
+      from key_store.lsm import LSMStore
+      return LSMStore(filename, **options)
+   raise ValueError("unknown storage engine %r" % (engine,))
+
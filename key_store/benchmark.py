@@ -0,0 +1,372 @@
+"""
+A workload driver for the key store, modelled on the FD-tree test harness in
+res/fdtree.
+
+The driver loads a store with 'cardinality' entries, keys 0 to cardinality - 1,
+and then runs a mix of searches, insertions, deletions and updates on random
+keys in the same range, in the proportions given by the ratio. The entries and
+the queries only depend on the seed, so every store sees the same workload.
+The entries and queries can also be read from files in the harness' formats:
+
+load file
+   Whitespace separated 'key ptr' pairs, in key order.
+
+query file
+   One query per line: 's key', 'i key ptr', 'd key' or 'u key ptr'.
+
+A value is the entry's ptr packed as 4 bytes. For every store the driver
+reports the load and query throughput, the latency percentiles of each kind of
+query, the I/O the process did, and the size of the files. I/O counts come
+from /proc/self/io and are None where it is not available.
+
+Results are written as one JSON object per line, like column_store.benchmark.
+
+RUNME as 'python -m key_store.benchmark -c 100K -n 100K -r 80 20 0 0 [-b 16M]'
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+
+from glob import glob
+from timeit import default_timer as timer
+
+from column_store.benchmark import percentiles
+from column_store.fdtree import FDTree
+from key_store.datafile import DataFile
+from key_store.lsm import LSMStore
+from key_store.partition import PartitionedStore
+
+SEARCH, INSERT, DELETE, UPDATE = "s", "i", "d", "u"
+QUERY_TYPES = (SEARCH, INSERT, DELETE, UPDATE)
+QUERY_NAMES = {
+   SEARCH: "search",
+   INSERT: "insert",
+   DELETE: "delete",
+   UPDATE: "update",
+}
+
+# ptr
+value_fmt = "<I"
+
+# The entries are loaded in batches of this many.
+LOAD_BATCH = 1024
+
+
+def open_datafile(base_name, buffer_size):
+   return DataFile(base_name + ".db", cache_size=buffer_size)
+
+
+def open_lsm(base_name, buffer_size):
+   return LSMStore(base_name + ".lsm", cache_size=buffer_size)
+
+
+def open_partitioned(base_name, buffer_size, partitions=4):
+   return PartitionedStore(base_name + ".db", partitions=partitions,
+                           cache_size=max(buffer_size / partitions, 1))
+
+
+class FDTreeStore(object):
+   """
+   :synopsis: Holds the workload's ptrs in a column_store.fdtree.FDTree, which
+              stores integers rather than strings.
+   """
+   __slots__ = ["tree"]
+   def __init__(self, base_name, buffer_size):
+      self.tree = FDTree(base_name, buffer_size=buffer_size)
+
+   def get(self, key, default=None):
+      ptr = self.tree.get(key)
+      return default if ptr is None else struct.pack(value_fmt, ptr)
+
+   def set(self, key, value):
+      self.tree.set(key, struct.unpack(value_fmt, value)[0])
+
+   def set_many(self, items):
+      for key, value in items:
+         self.set(key, value)
+
+   def delete(self, key):
+      self.tree.delete(key)
+
+   def checkpoint(self):
+      self.tree.flush()
+
+   def close(self):
+      self.tree.close()
+
+
+# The stores that can be benchmarked. Each is opened with the base name of its
+# files and the size of its buffer pool, and must have the methods of a
+# DataFile that the driver uses: set_many(), get(), set(), delete(),
+# checkpoint() and close().
+STORES = [
+   ("datafile", open_datafile),
+   ("partitioned", open_partitioned),
+   ("lsm", open_lsm),
+   ("fdtree", FDTreeStore),
+]
+
+
+def parse_size(text):
+   """
+   :synopsis: Parses a count or size with an optional K, M or G suffix, in
+              powers of 1024, as the harness does.
+   """
+   text = text.strip().upper()
+   scale = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}.get(text[-1:], 1)
+   if scale != 1:
+      text = text[:-1]
+   return int(text) * scale
+
+
+def _ptr(rng):
+   return rng.randint(1, 1024)
+
+
+def generate_entries(cardinality, rng):
+   """
+   :returns: A generator of the (key, ptr) entries to load, in key order.
+   """
+   for key in xrange(0, cardinality):
+      yield key, _ptr(rng)
+
+
+def generate_queries(cardinality, count, ratio, rng):
+   """
+   :param ratio: The percentage of searches, insertions, deletions and
+                 updates.
+   :returns: A list of queries, as tuples of the query type, the key, and for
+             insertions and updates the ptr.
+   """
+   search, insert, delete, _ = ratio
+   queries = []
+   for _ in xrange(0, count):
+      choice = rng.randint(0, 99)
+      key = rng.randint(0, max(cardinality - 1, 0))
+      if choice < search:
+         queries.append((SEARCH, key))
+      elif choice < search + insert:
+         queries.append((INSERT, key, _ptr(rng)))
+      elif choice < search + insert + delete:
+         queries.append((DELETE, key))
+      else:
+         queries.append((UPDATE, key, _ptr(rng)))
+   return queries
+
+
+def read_entries(filename):
+   """
+   :returns: A generator of the (key, ptr) entries in a load file.
+   """
+   with open(filename) as f:
+      fields = f.read().split()
+   for i in xrange(0, len(fields) - 1, 2):
+      yield int(fields[i]), int(fields[i + 1])
+
+
+def read_queries(filename):
+   """
+   :returns: The queries in a query file, as generate_queries() returns them.
+   :raises ValueError: If the file holds an unknown query type.
+   """
+   with open(filename) as f:
+      fields = f.read().split()
+   queries = []
+   i = 0
+   while i < len(fields):
+      query_type = fields[i]
+      if query_type in (SEARCH, DELETE):
+         queries.append((query_type, int(fields[i + 1])))
+         i += 2
+      elif query_type in (INSERT, UPDATE):
+         queries.append((query_type, int(fields[i + 1]), int(fields[i + 2])))
+         i += 3
+      else:
+         raise ValueError("unknown query type %r in %s" % (query_type, filename))
+   return queries
+
+
+def io_counters():
+   """
+   :returns: A dict of the read and write calls and bytes of this process so
+             far, or None if the system does not report them.
+   """
+   try:
+      with open("/proc/self/io") as f:
+         fields = dict(line.split(":") for line in f if ":" in line)
+   except IOError:
+      return None
+   return {
+      "read_calls": int(fields["syscr"]),
+      "write_calls": int(fields["syscw"]),
+      "read_bytes": int(fields["read_bytes"]),
+      "write_bytes": int(fields["write_bytes"]),
+   }
+
+
+def _io_since(before):
+   after = io_counters()
+   if before is None or after is None:
+      return None
+   return dict((k, after[k] - before[k]) for k in after)
+
+
+def _rate(count, elapsed):
+   return count / elapsed if elapsed > 0 else None
+
+
+def _size_on_disk(base_name):
+   return sum(os.path.getsize(f) for f in glob(base_name + ".*"))
+
+
+def _batches(entries):
+   batch = []
+   for key, ptr in entries:
+      batch.append((key, struct.pack(value_fmt, ptr)))
+      if len(batch) == LOAD_BATCH:
+         yield batch
+         batch = []
+   if batch:
+      yield batch
+
+
+def bench_store(directory, name, opener, entries, queries, buffer_size):
+   """
+   :synopsis: Loads 'entries' into a new store, checkpoints it, and runs
+              'queries' against it.
+   """
+   base_name = os.path.join(directory, name)
+   store = opener(base_name, buffer_size)
+
+   io = io_counters()
+   start = timer()
+   loaded = 0
+   for batch in _batches(entries):
+      store.set_many(batch)
+      loaded += len(batch)
+   store.checkpoint()
+   load_elapsed = timer() - start
+   load_io = _io_since(io)
+
+   latencies = dict((t, []) for t in QUERY_TYPES)
+   found = 0
+   io = io_counters()
+   start = timer()
+   for query in queries:
+      query_type, key = query[0], query[1]
+      query_start = timer()
+      if query_type == SEARCH:
+         found += store.get(key) is not None
+      elif query_type == DELETE:
+         store.delete(key)
+      else:
+         store.set(key, struct.pack(value_fmt, query[2]))
+      latencies[query_type].append(timer() - query_start)
+   store.checkpoint()
+   query_elapsed = timer() - start
+   query_io = _io_since(io)
+   store.close()
+
+   result = {
+      "suite": "key_store",
+      "store": name,
+      "cardinality": loaded,
+      "buffer_size": buffer_size,
+      "load_entries_per_sec": _rate(loaded, load_elapsed),
+      "load_io": load_io,
+      "queries": len(queries),
+      "queries_per_sec": _rate(len(queries), query_elapsed),
+      "query_io": query_io,
+      "searches_found": found,
+      "bytes_on_disk": _size_on_disk(base_name),
+   }
+   for query_type in QUERY_TYPES:
+      result["%s_count" % QUERY_NAMES[query_type]] = len(latencies[query_type])
+      result["%s_latency_us" % QUERY_NAMES[query_type]] = percentiles(latencies[query_type])
+   return result
+
+
+def run(cardinality=10000, queries=10000, ratio=(50, 50, 0, 0), buffer_size=16 << 20,
+        seed=0, stores=None, directory=None, loadfile=None, queryfile=None):
+   """
+   :synopsis: Runs the same workload against every store.
+   :param ratio: The percentage of searches, insertions, deletions and
+                 updates. They must add up to 100.
+   :param stores: The names of the stores to run. Defaults to all of them.
+   :param directory: Where to create the store files. Each run creates a new
+                     subdirectory of it, which is kept afterwards. Defaults to
+                     a temporary directory which is removed afterwards.
+   :param loadfile: A load file to take the entries from instead of
+                    generating 'cardinality' of them.
+   :param queryfile: A query file to take the queries from instead of
+                     generating 'queries' of them.
+   :returns: A generator of result dicts.
+   """
+   if sum(ratio) != 100:
+      raise ValueError("the query ratio %r does not add up to 100" % (ratio,))
+   selected = [(n, o) for n, o in STORES if stores is None or n in stores]
+   owns_directory = directory is None
+   # A fresh directory, so that no store is loaded into a previous run's files.
+   directory = tempfile.mkdtemp(prefix="key_store_bench", dir=directory)
+   try:
+      if queryfile:
+         workload = read_queries(queryfile)
+      else:
+         # The queries use their own generator, so they are the same whether
+         # the entries are generated or loaded.
+         workload = generate_queries(cardinality, queries, ratio, random.Random(seed + 1))
+      for name, opener in selected:
+         if loadfile:
+            entries = read_entries(loadfile)
+         else:
+            entries = generate_entries(cardinality, random.Random(seed))
+         yield bench_store(directory, name, opener, entries, workload, buffer_size)
+   finally:
+      if owns_directory:
+         shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Run a workload against the key stores.")
+   parser.add_argument("-c", "--cardinality", type=parse_size, default=10000,
+                       help="entries to load; ignored with --loadfile")
+   parser.add_argument("-n", "--nquery", type=parse_size, default=10000,
+                       help="queries to run; ignored with --queryfile")
+   parser.add_argument("-b", "--buffer", type=parse_size, default=16 << 20,
+                       help="buffer pool size (default 16M)")
+   parser.add_argument("-r", "--ratio", type=int, nargs=4, default=[50, 50, 0, 0],
+                       metavar=("SEARCH", "INSERT", "DELETE", "UPDATE"),
+                       help="percentage of each query type (default 50 50 0 0)")
+   parser.add_argument("-f", "--loadfile", help="file of entries to load")
+   parser.add_argument("-q", "--queryfile", help="file of queries to run")
+   parser.add_argument("-s", "--store", action="append", dest="stores",
+                       choices=[n for n, _ in STORES],
+                       help="store to run (may be repeated, default all)")
+   parser.add_argument("--seed", type=int, default=0, help="random seed")
+   parser.add_argument("-p", "--path", dest="directory",
+                       help="directory to create each run's store files in")
+   parser.add_argument("--output", help="file to write results to (default stdout)")
+   args = parser.parse_args(argv)
+   if sum(args.ratio) != 100:
+      parser.error("the query ratio must add up to 100")
+
+   out = open(args.output, "w") if args.output else sys.stdout
+   try:
+      for result in run(args.cardinality, args.nquery, tuple(args.ratio), args.buffer,
+                        args.seed, args.stores, args.directory, args.loadfile,
+                        args.queryfile):
+         out.write(json.dumps(result, sort_keys=True) + "\n")
+         out.flush()
+   finally:
+      if out is not sys.stdout:
+         out.close()
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,74 @@
+"""
+Value compression.
+
+Every stored value records the codec it was compressed with, so the codec a
+data file uses can be changed at any time and old values still read back. A
+value is stored uncompressed when compressing it does not make it smaller.
+
+CODEC_NONE
+   The value is stored as it is.
+
+CODEC_LZ4
+   An LZ4 block from util.lz4, preceded by the uncompressed length:
+
+   +--------+---------------+
+   | length | lz4 block ... |
+   | <I     |               |
+   +--------+---------------+
+
+CODEC_ZLIB
+   A zlib stream. Values that util.lz4 fails to compress fall back to zlib.
+"""
+
+import struct
+import zlib
+
+from util.lz4 import Compressor, Decompressor, LZ4Exception
+
+CODEC_NONE = 0
+CODEC_LZ4 = 1
+CODEC_ZLIB = 2
+
+# The codecs that a data file can be asked to compress with.
+CODECS = {
+   "lz4": CODEC_LZ4,
+   "zlib": CODEC_ZLIB,
+}
+
+# uncompressed length
+lz4_header_fmt = "<I"
+
+_compressor = Compressor()
+_decompressor = Decompressor()
+
+
+def compress(value, codec):
+   """
+   :synopsis: Compresses a value.
+   :returns: The codec that was used and the compressed value. The codec is
+             CODEC_NONE, and the value unchanged, if compression did not help.
+   """
+   if codec == CODEC_LZ4:
+      try:
+         data = struct.pack(lz4_header_fmt, len(value)) + str(_compressor.compress(value))
+      except LZ4Exception:
+         codec = CODEC_ZLIB
+   if codec == CODEC_ZLIB:
+      data = zlib.compress(value, zlib.Z_BEST_SPEED)
+   if codec == CODEC_NONE or len(data) >= len(value):
+      return CODEC_NONE, value
+   return codec, data
+
+
+def decompress(codec, data):
+   """
+   :synopsis: Reverses compress().
+   """
+   if codec == CODEC_NONE:
+      return data
+   if codec == CODEC_LZ4:
+      length = struct.unpack_from(lz4_header_fmt, data)[0]
+      return str(_decompressor.decompress(data[struct.calcsize(lz4_header_fmt):], length))
+   if codec == CODEC_ZLIB:
+      return zlib.decompress(data)
+   raise ValueError("unknown codec %d" % codec)
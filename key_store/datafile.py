@@ -3,22 +3,137 @@ Data file theory of operation
 =============================
 
 The structure of the data file is quite straightforward. There are two files:
-one file is the actual data content, the other file is the write-ahead log. All
-operations are first journaled, and then later written to disk. The journal
-itself only contains metadata operations. The actual data is always written to
-a free spot in a data page. In the case of updates, the data is written to a
-new empty area, and the old area is deallocated. This way data can never be
-lost one we commit to a write.
-
-The datafile has a header on the first page which indicates how many virtual
-pages exist in the datafile. There is also a directory that has an entry for each
-virtual page. The directory provides a mapping from virtual pages to actual
-disk pages, and is the mechanism by which the extensible hashing algorithm is
-implemented.
-
-The first 32 bytes of the header are composed of an sha256 digest of the
-directory and the directory entry count. After that is the free extent count,
-a list of start/end ranges that indicate free _page_ ranges.
+one file is the actual data content, the other file is the write-ahead log.
+Every change is first appended to the log, and the log is committed before the
+change is considered durable. The pages of the data file are only written at a
+checkpoint, after which the log is truncated.
+
+The data file is a sequence of fixed-size pages. The first page holds the
+header. Every other page is allocated from the free extent list, or from the
+end of the file when the list has nothing suitable.
+
+The keys are stored with extendible hashing. The directory has 2^global_depth
+entries, each of which is the number of a key page. A key is hashed, and the
+low global_depth bits of the hash select its directory entry. Every key page
+records its own local depth: the number of low hash bits that all of its keys
+share. 2^(global_depth - local_depth) directory entries point to the same key
+page.
+
+The entries of a key page are sorted by key. A lookup in a page that has just
+been read binary searches the raw page, and the page is only decoded when it
+is modified.
+
+Every key page also carries a Bloom filter of its keys, stored between the
+page header and the entries. The filters of the pages that have been read stay
+in memory after the pages are evicted, so a get() of a missing key usually
+does not have to read the key page again. Deleting a key leaves its bits set
+until the page is next written, when the filter is rebuilt from the keys.
+
+When a key page fills up it is split. Its local depth is increased by one, the
+keys whose hash has the new bit set move to a new page, and half of the
+directory entries that pointed to the old page are repointed at the new one. If
+the local depth of the page was already equal to the global depth, the
+directory is doubled first. Only the one page that overflowed is rehashed.
+
+Values
+------
+
+Key pages hold value pointers rather than values. A value pointer is the
+number of a data page and a slot on that page, so a get() of a small value
+reads one key page and one data page. Data pages are slotted: the slot
+directory follows the page header, and the value records are packed from the
+end of the page towards it. Removing a value frees its slot, and the page is
+compacted when a new record does not fit in the contiguous free space but does
+fit in the total free space. A data page that becomes empty is released.
+
+Values larger than a quarter of a page are written to a chain of overflow
+pages, and the data page only records the first page of the chain and the
+length of the value.
+
+A data file can be asked to compress the values above a given size. The first
+byte of every value record holds the codec of the value in its high bits, and
+whether the value is inline or in overflow pages in its low bits. Values that
+do not get smaller are stored uncompressed. See compression.py.
+
+Ordered index
+-------------
+
+A data file may also keep its keys in a B+tree, so that they can be iterated
+in order. The tree pages are allocated like every other page, and the header
+records the root page. The leaves are chained in key order, and the tree only
+holds keys: the value of each key is found through the hash. Pages are split
+when they overflow but are never merged, so deleting keys can leave empty
+leaves behind.
+
+Compaction
+----------
+
+Released pages are reused, but the file never shrinks by itself. compact()
+moves the live pages out of the end of the file a few key pages at a time, so
+it can run between other operations. A compaction pass picks a limit: the
+number of pages the live pages would fill if there were no free pages. It then
+visits every key page. A value stored at or above the limit is stored again,
+and a key page at or above the limit is copied to a new page and the
+directory is repointed at the copy. While a pass runs, new pages are allocated
+below the limit whenever there is room. The pages of the ordered index are not
+moved.
+
+Sharing
+-------
+
+A data file opened with shared=True can be read by other processes, through
+reader.Reader, while one process writes it. The writer holds an fcntl lock for
+as long as the file is open. Readers map the file and only see what the last
+checkpoint wrote, so the writer keeps its dirty pages in memory until the next
+checkpoint instead of writing them back when they are evicted, and it
+checkpoints early when they would fill the cache. A checkpoint keeps readers
+out while it writes. See lock.py.
+
+Logging
+-------
+
+Every page records the LSN of the last log record that changed it. Changes to
+a single key are logged as the key and its new value pointer, and a stored
+value is logged as its data page record. Overflow pages are logged as page
+images. A split is logged as the complete images of the two key pages
+involved, followed by the directory change. Changes to the directory and to
+the free extent list are logged logically.
+
+When the file is opened, the committed log records newer than the last
+checkpoint are replayed. A page record is only applied if the page on disk is
+older than the record, so replay is idempotent. The records are applied in
+order, and the file is checkpointed once replay is done.
+
+Checkpoints
+-----------
+
+At a checkpoint the free extent list and the directory are written as a
+metadata snapshot to newly allocated pages, never over the previous snapshot.
+The header page has two header slots, one at the start of the page and one
+halfway through it. A checkpoint writes the slot that was not used last, so a
+crash while writing either the snapshot or the header leaves the previous
+checkpoint intact. When the file is opened, the valid slot with the newest
+checkpoint is used.
+
+checkpoint(background=True) starts a fuzzy checkpoint, which does not stall
+the writer. It commits, and notes the pages that are dirty and the LSN of the
+commit, the redo point. A background thread then writes those pages in page
+order while the writer carries on. Every page that was dirty is committed, and
+the writer only ever changes a copy of a committed page, so the thread writes
+a page that does not change under it. A page is skipped if it has been written
+back or released in the meantime. Once every page is written, the next commit
+writes a metadata snapshot whose checkpoint LSN is the redo point, and
+discards the log records up to it. The header records both the redo point
+and the LSN the snapshot reflects, and replay starts at the redo point but
+only applies the directory and extent records that are newer than the
+snapshot.
+
+Once the snapshot has been allocated, the free pages at the end of the file
+are removed from the free list and the page count is lowered. The file is only
+truncated once the new header is durable.
+
+Each header slot starts with a sha256 signature, computed over the rest of the
+header and the metadata snapshot. The rest of the header is:
 
 0                       8
 +-----------------------+
@@ -30,40 +145,209 @@ a list of start/end ranges that indicate free _page_ ranges.
 +-----------------------+
 | sig                   |
 +-----------------------+
-| directory_entry_count |
+| version | depth       |
 +-----------------------+
-| entry 0               |
+| page_count            |
 +-----------------------+
-| ..entry n..           |
+| checkpoint_lsn        |
 +-----------------------+
-| free_extent_count     |
+| metadata_page         |
 +-----------------------+
-| entry 0               |
+| metadata_page_count   |
 +-----------------------+
-| ..entry n..           |
+| metadata_length       |
 +-----------------------+
+| index_root            |
++-----------------------+
+| metadata_lsn          |
++-----------------------+
+
+The metadata snapshot is the free extent list, padded to a whole number of
+pages, followed by the directory.
 
 """
 
 import array
+import bisect
+import contextlib
 import hashlib
 import os
 import struct
+import threading
+
+from cStringIO import StringIO
+
+from column_store.mq import Cache
+from compression import CODECS, CODEC_NONE, compress, decompress
+from lock import FileLock
+from util.skiplist import SortedSet
+from wal import WriteAheadLog
+
+format_version = 7
 
-# signature + directory entry count
-header_read_fmt = "<32sQ"
-# directory entry count + directory
-header_write_fmt = "<Q%ss"
-# extent header
+# signature
+signature_fmt = "<32s"
+# format version, global depth, page count, checkpoint lsn, metadata page,
+# metadata page count, metadata length, index root page, metadata lsn
+header_fmt = "<IIQQQQQQQ"
+# number of free extents
 extent_header_fmt = "<Q"
 # extent entry
 extent_fmt = "<QQ"
+# page lsn + local depth + entry count, followed by the bloom filter
+key_page_header_fmt = "<QII"
 # key value + data pointer
 key_fmt = "<QQ"
-# number of bytes in value
-value_header_fmt = "<I"
-# the actual value
-value_fmt = "<%ss"
+key_struct = struct.Struct(key_fmt)
+# page lsn + slot count + offset of the lowest record on the page
+data_page_header_fmt = "<QHH"
+# record offset + record length, an offset of zero marks a free slot
+slot_fmt = "<HH"
+# page lsn + next page in the chain + number of bytes on this page
+overflow_page_header_fmt = "<QQI"
+# first overflow page + number of bytes in value
+overflow_value_fmt = "<QI"
+# page lsn + leaf flag + key count + next leaf (leaf) or first child (node)
+index_page_header_fmt = "<QBHQ"
+# key in a leaf
+index_leaf_fmt = "<Q"
+# key + child page in a node
+index_node_fmt = "<QQ"
+# every page type starts with its lsn
+page_lsn_fmt = "<Q"
+
+# the low bits of the first byte of every value record, the high bits hold
+# the codec of the value
+VALUE_INLINE = 0
+VALUE_OVERFLOW = 1
+VALUE_STORAGE_MASK = 0x0f
+CODEC_SHIFT = 4
+
+# a value pointer holds the data page number and the slot on that page
+SLOT_BITS = 16
+
+# log record types and their payloads
+REC_KEY_SET = 1
+REC_KEY_DELETE = 2
+REC_KEY_PAGE = 3
+REC_DIRECTORY_DOUBLE = 4
+REC_DIRECTORY_SPLIT = 5
+REC_ALLOCATE = 6
+REC_RELEASE = 7
+REC_DATA_PAGE = 8
+REC_VALUE_PUT = 9
+REC_VALUE_REMOVE = 10
+REC_OVERFLOW_PAGE = 11
+REC_INDEX_PAGE = 12
+REC_INDEX_INSERT = 13
+REC_INDEX_DELETE = 14
+REC_INDEX_ROOT = 15
+REC_DIRECTORY_MOVE = 16
+# the records that the metadata snapshot reflects
+METADATA_RECORDS = frozenset([REC_DIRECTORY_DOUBLE, REC_DIRECTORY_SPLIT, REC_DIRECTORY_MOVE,
+                              REC_ALLOCATE, REC_INDEX_ROOT])
+# the records that change a single page
+PAGE_RECORDS = frozenset([REC_KEY_SET, REC_KEY_DELETE, REC_KEY_PAGE, REC_DATA_PAGE,
+                          REC_VALUE_PUT, REC_VALUE_REMOVE, REC_OVERFLOW_PAGE,
+                          REC_INDEX_PAGE, REC_INDEX_INSERT, REC_INDEX_DELETE])
+# the page that every page record starts with
+page_number_fmt = "<Q"
+# page, key, value pointer
+key_set_fmt = "<QQQ"
+# page, key
+key_delete_fmt = "<QQ"
+# page, followed by the page image
+page_image_fmt = "<Q"
+# page, slot, followed by the value record for REC_VALUE_PUT
+value_record_fmt = "<QH"
+# page
+data_page_fmt = "<Q"
+# page, key, child page (zero in a leaf)
+index_insert_fmt = "<QQQ"
+# page, key
+index_delete_fmt = "<QQ"
+# root page
+index_root_fmt = "<Q"
+# directory index, split bit, new page
+directory_split_fmt = "<QQQ"
+# directory index, entry stride, new page
+directory_move_fmt = "<QQQ"
+
+MASK64 = (1 << 64) - 1
+
+# the number of bits of a key page's bloom filter that each key sets
+BLOOM_PROBES = 6
+# mixed into the key so the filter does not reuse the bits that chose the page
+BLOOM_SEED = 0x9e3779b97f4a7c15
+
+def key_hash(key):
+   """
+   :synopsis: Mixes the bits of a 64-bit key. The mix is a bijection, so two
+              distinct keys never have the same hash and a page split always
+              makes progress eventually.
+   """
+   h = key & MASK64
+   h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+   h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & MASK64
+   return h ^ (h >> 31)
+
+def bloom_probes(key, bits):
+   """
+   :returns: The bits of a bloom filter of 'bits' bits that 'key' sets.
+   """
+   h = key_hash(key ^ BLOOM_SEED)
+   h1, h2 = h & 0xffffffff, (h >> 32) | 1
+   return [(h1 + i * h2) % bits for i in range(0, BLOOM_PROBES)]
+
+def bloom_add(f, key):
+   for b in bloom_probes(key, len(f) * 8):
+      f[b >> 3] |= 1 << (b & 7)
+
+def bloom_contains(f, key):
+   """
+   :returns: False if 'key' was never added to the filter 'f'. True means
+             that it may have been.
+   """
+   for b in bloom_probes(key, len(f) * 8):
+      if not f[b >> 3] & (1 << (b & 7)):
+         return False
+   return True
+
+def read_header(d, page_size, slot):
+   """
+   :synopsis: Reads and verifies one of the two header slots of a data file.
+   :returns: A tuple of the header fields and the metadata snapshot, or None
+             if the slot does not hold a valid header.
+   """
+   d.seek(slot * (page_size / 2))
+   header_size = struct.calcsize(signature_fmt) + struct.calcsize(header_fmt)
+   data = d.read(header_size)
+   if len(data) < header_size:
+      return None
+   fields = struct.unpack(signature_fmt + header_fmt[1:], data)
+   signature, version, _, _, _, metadata_page, _, metadata_length, _, _ = fields
+   if version != format_version:
+      return None
+
+   d.seek(page_size * metadata_page)
+   metadata = d.read(metadata_length)
+   m = hashlib.sha256()
+   m.update(data[struct.calcsize(signature_fmt):])
+   m.update(metadata)
+   if m.digest() != signature:
+      return None
+   return fields[1:], metadata
+
+def read_newest_header(d, page_size):
+   """
+   :returns: The header and metadata snapshot of the most recent checkpoint,
+             and the slot they were read from.
+   """
+   headers = [(read_header(d, page_size, slot), slot) for slot in (0, 1)]
+   headers = [(h, slot) for h, slot in headers if h is not None]
+   if not headers:
+      raise IntegrityError()
+   return max(headers, key=lambda h: h[0][0][8])
 
 class IntegrityError(Exception):
    def __init__(self):
@@ -76,25 +360,99 @@ class KeyPage(object):
    synopsis: Maintains a key page.
 
    The key page does not contain values. Rather, it contains 64-bit value
-   pointers.
+   pointers. The page starts with a small header holding the local depth of
+   the page and the number of entries on it, followed by a bloom filter of the
+   keys on the page. The entries are sorted by key.
+
+   A page read from disk is not decoded. get() binary searches the entries in
+   the raw page, and the entries are only decoded into 'keys' when the page
+   is first modified.
    """
-   __slots__ = ["dirty", "keys", "undo_keys", "page_size", "max_entries"]
-   def __init__(self, d, page_size):
+   __slots__ = ["dirty", "keys", "undo_keys", "page_size", "max_entries", "depth", "lsn",
+                "count", "data", "version", "filter"]
+   def __init__(self, d, page_size, depth=0):
+      """
+      :param d: A file object positioned at the start of the page, or None to
+                create an empty page.
+      :param page_size: The size of the page in bytes.
+      :param depth: The local depth of a new, empty page.
+      """
+      header_size = KeyPage.entries_offset(page_size)
       entry_size = struct.calcsize(key_fmt)
 
       self.dirty = False
       self.keys = {}
       self.undo_keys = {}
       self.page_size = page_size
-      self.max_entries = self.page_size / entry_size
-      for _ in range(0, self.max_entries):
-         data = d.read(entry_size)
-         if len(data) < entry_size:
-            break
-         k, v = struct.unpack(key_fmt, data)
-         if k == 0 and v == 0:
-            break
+      self.max_entries = (self.page_size - header_size) / entry_size
+      self.depth = depth
+      self.lsn = 0
+      self.count = 0
+      self.data = None
+      self.version = 0
+      self.filter = bytearray(KeyPage.filter_size(page_size))
+      if d is None:
+         return
+
+      data = d.read(page_size)
+      if len(data) < header_size:
+         return
+      self.lsn, self.depth, count = struct.unpack_from(key_page_header_fmt, data)
+      self.count = min(count, self.max_entries, (len(data) - header_size) / entry_size)
+      self.data = data
+      self.keys = None
+      self.filter[:] = data[struct.calcsize(key_page_header_fmt):header_size]
+
+   @staticmethod
+   def filter_size(page_size):
+      """
+      :returns: The size of the bloom filter on a page, in bytes. A sixteenth
+                of the page gives about eight bits per key.
+      """
+      return page_size / 16
+
+   @staticmethod
+   def entries_offset(page_size):
+      return struct.calcsize(key_page_header_fmt) + KeyPage.filter_size(page_size)
+
+   def copy(self):
+      kp = KeyPage(None, self.page_size, self.depth)
+      kp.dirty = self.dirty
+      kp.lsn = self.lsn
+      kp.count = self.count
+      kp.data = self.data
+      kp.keys = None if self.keys is None else dict(self.keys)
+      kp.filter[:] = self.filter
+      return kp
+
+   def decode(self):
+      """
+      :synopsis: Decodes the entries of the raw page into 'keys'.
+      """
+      if self.keys is not None:
+         return
+
+      self.keys = {}
+      offset = KeyPage.entries_offset(self.page_size)
+      for _ in range(0, self.count):
+         k, v = key_struct.unpack_from(self.data, offset)
          self.keys[k] = v
+         offset += key_struct.size
+      self.data = None
+
+   def __len__(self):
+      return self.count if self.keys is None else len(self.keys)
+
+   def items(self):
+      """
+      :returns: A list of the (key, value pointer) pairs on the page. The page
+                is not decoded.
+      """
+      if self.keys is not None:
+         return self.keys.items()
+      offset = KeyPage.entries_offset(self.page_size)
+      return [key_struct.unpack_from(self.data, offset + i * key_struct.size)
+              for i in range(0, self.count)]
 
    def get(self, key, default=None):
       """
@@ -106,7 +464,22 @@ class KeyPage(object):
       The key is the actual user's key, however the value is merely a pointer
       to the value data somewhere in the data file.
       """
-      return self.keys.get(key, default)
+      if self.keys is not None:
+         return self.keys.get(key, default)
+
+      # Binary search the raw page. Only the keys that are probed are unpacked.
+      header_size = KeyPage.entries_offset(self.page_size)
+      lo, hi = 0, self.count
+      while lo < hi:
+         mid = (lo + hi) / 2
+         k, v = key_struct.unpack_from(self.data, header_size + mid * key_struct.size)
+         if k < key:
+            lo = mid + 1
+         elif k > key:
+            hi = mid
+         else:
+            return v
+      return default
 
    def set(self, key, value):
       """
@@ -120,6 +493,7 @@ class KeyPage(object):
       saved before we write the new value.
       """
 
+      self.decode()
       old_value = self.keys.get(key)
       if old_value == None and len(self.keys) >= self.max_entries:
          return False
@@ -128,8 +502,10 @@ class KeyPage(object):
          self.undo_keys[key] = old_value
 
       if value == None:
-         del self.keys[key]
+         self.keys.pop(key, None)
       else:
+         if old_value == None:
+            bloom_add(self.filter, key)
          self.keys[key] = value
 
       self.dirty = True
@@ -139,6 +515,25 @@ class KeyPage(object):
    def delete(self, key):
       self.set(key, None)
 
+   def may_contain(self, key):
+      """
+      :returns: False if the key is certainly not on the page.
+      """
+      return bloom_contains(self.filter, key)
+
+   def rebuild_filter(self):
+      """
+      :synopsis: Recomputes the bloom filter from the keys, dropping the bits
+                 of deleted keys. The filter is changed in place, in one step,
+                 because a fuzzy checkpoint may rebuild it while the writer
+                 reads it.
+      """
+      self.decode()
+      f = bytearray(len(self.filter))
+      for k in self.keys:
+         bloom_add(f, k)
+      self.filter[:] = f
+
    def commit(self):
       """
       :synopsis: Commits to the new state.
@@ -156,6 +551,22 @@ class KeyPage(object):
          else:
             self.keys[k] = v
 
+   def image(self):
+      """
+      :synopsis: Returns the on-disk representation of the page.
+      """
+      header = struct.pack(key_page_header_fmt, self.lsn, self.depth, len(self))
+      if self.keys is None:
+         start = KeyPage.entries_offset(self.page_size)
+         data = header + str(self.filter) + self.data[start:start + self.count * key_struct.size]
+      else:
+         self.rebuild_filter()
+         data = [header, str(self.filter)]
+         for k in sorted(self.keys):
+            data.append(key_struct.pack(k, self.keys[k]))
+         data = "".join(data)
+      return data + "\x00" * (self.page_size - len(data))
+
    def flush(self, d):
       """
       :synopsis: Writes the key page to disk. The file object must be positioned
@@ -166,14 +577,7 @@ class KeyPage(object):
       :notes: A flush implicitly causes a commit operation to be performed.
       """
       self.commit()
-      bytes_to_clear = self.page_size
-      for k, v in self.keys.iteritems():
-         data = struct.pack(key_fmt, k, v)
-         d.write(data)
-         bytes_to_clear -= len(data)
-
-      if bytes_to_clear > 0:
-         d.write("\x00" * bytes_to_clear)
+      d.write(self.image())
       self.dirty = False
 
 class Extent(object):
@@ -183,159 +587,570 @@ class Extent(object):
       self.end = end
 
    def __lt__(self, o):
-      if o.start < self.start:
-         return True
-
-      if o.start > self.start:
-         return False
+      if self.start != o.start:
+         return self.start < o.start
 
-      return o.end < self.end
+      return self.end < o.end
 
    def __gt__(self, o):
-      if o.start > self.start:
-         return True
-
-      if o.start < self.start:
-         return False
+      if self.start != o.start:
+         return self.start > o.start
 
-      return o.end > self.end
+      return self.end > o.end
 
    def __eq__(self, o):
       return self.start == o.start and\
              self.end == o.end
 
-   def merge(self, o):
-      merged = False
-      # Extend left
-      if o.start <= self.start and\
-         o.end <= self.end:
-         self.start = min(o.start, self.start)
-         merged = True
-
-      # Extend right
-      if o.start >= self.start and\
-         o.end >= self.end:
-         self.end = max(o.end, self.end)
-         merged = True
-
-      # Early out, we know complete containment
-      # is not a possibility if merge is true.
-      if merged:
-         return True
+   def size(self):
+      return self.end - self.start + 1
 
-      # Complete containment
-      if o.start >= self.start and\
-         o.end <= self.end:
-         merged = True
+   def merge(self, o):
+      """
+      :synopsis: Merges 'o' into this extent if the two overlap or are adjacent.
+                 Extents include their end page.
+      :returns: True if 'o' was merged.
+      """
+      if o.start > self.end + 1 or o.end + 1 < self.start:
+         return False
 
-      return merged
+      self.start = min(o.start, self.start)
+      self.end = max(o.end, self.end)
+      return True
 
 
 class FreePage(object):
    """
-   :synopsis: Manages a list of extents that are free in the data file. The
-   extents are stored in ascending order, and are merged when possible.
+   :synopsis: Manages the extents that are free in the data file.
+
+   The extents are indexed twice: by start page, to find the neighbours of a
+   released extent so they can be merged with it, and by size, to find the
+   smallest extent that satisfies an allocation. Both indexes are skip lists
+   (util.skiplist), so every lookup and update is O(log n) in the number of
+   free extents.
+
+   The free list is stored as an extent count followed by the extents. It
+   spills onto as many pages as it needs, so no free space is ever lost to a
+   full free list.
    """
-   __slots__ = ["extents", "page_size", "dirty", "max_entries"]
+   __slots__ = ["starts", "ends", "sizes", "free_pages", "page_size", "dirty"]
    def __init__(self, d, page_size):
-      entry_size = struct.calcsize(extent_fmt)
-      self.extents = []
+      """
+      :param d: A file object positioned at the start of the free list, or
+                None to create an empty free list.
+      :param page_size: The size of a page in bytes.
+      """
+      # The start page of every extent.
+      self.starts = SortedSet()
+      # The end page of every extent, by start page.
+      self.ends = {}
+      # (size, start) of every extent.
+      self.sizes = SortedSet()
+      self.free_pages = 0
       self.dirty = False
       self.page_size = page_size
-      self.max_entries = self.page_size / entry_size
-      for _ in range(0, self.max_entries):
-         data = d.read(entry_size)
-         if len(data) < entry_size:
-            break
-         s, e = struct.unpack(extent_fmt, data)
-         if s == 0 and e == 0:
-            break
-         self.extents.append(Extent(s, e))
+      if d is None:
+         return
+
+      header_size = struct.calcsize(extent_header_fmt)
+      entry_size = struct.calcsize(extent_fmt)
+      data = d.read(header_size)
+      if len(data) < header_size:
+         return
+      count = struct.unpack(extent_header_fmt, data)[0]
+      data = d.read(count * entry_size)
+      for i in range(0, len(data) / entry_size):
+         self._add(*struct.unpack_from(extent_fmt, data, i * entry_size))
+
+      # Skip the unused space on the last page.
+      d.read(self.size() - header_size - len(data))
+
+   def __len__(self):
+      return len(self.starts)
 
-      self.extents.sort()
+   def extents(self):
+      """
+      :returns: The free extents in ascending order.
+      """
+      return [Extent(start, self.ends[start]) for start in self.starts]
+
+   def size(self):
+      """
+      :returns: The number of bytes flush() will write.
+      """
+      data_size = struct.calcsize(extent_header_fmt) + len(self) * struct.calcsize(extent_fmt)
+      return (data_size + self.page_size - 1) / self.page_size * self.page_size
+
+   def _add(self, start, end):
+      self.starts.add(start)
+      self.ends[start] = end
+      self.sizes.add((end - start + 1, start))
+      self.free_pages += end - start + 1
+
+   def _remove(self, start):
+      end = self.ends.pop(start)
+      self.starts.remove(start)
+      self.sizes.remove((end - start + 1, start))
+      self.free_pages -= end - start + 1
+      return end
+
+   def pages(self):
+      """
+      :returns: The number of free pages.
+      """
+      return self.free_pages
 
-   def acquire(self, count):
+   def acquire(self, count, below=None):
       """
-      :synopsis: Acquires an extent.
+      :synopsis: Acquires an extent. The smallest free extent that is large
+                 enough is used, and the lowest one if several are.
       :param count: The number of pages desired.
+      :param below: If given, only pages before this one are used.
       :returns: A page number that has the requested range free,
                 or None on error.
       """
+      found = None
+      for size, start in self.sizes.iter_from((count, -1)):
+         if below is None or start + count <= below:
+            found = size, start
+            break
+      if found is None:
+         return None
+
+      size, start = found
+      end = self._remove(start)
+      if size > count:
+         self._add(start + count, end)
       self.dirty = True
-      for i, e in enumerate(self.extents):
-         if e.end - e.start > count:
-            v = e.start
-            e.start += count
-            return v
+      return start
 
-         if e.end - e.start == count:
-            v = e.start
-            self.extents.pop(i)
-            return v
+   def take(self, start, count):
+      """
+      :synopsis: Removes the pages [start, start + count) from the free pool,
+                 wherever they are. This replays an allocation made earlier.
+      """
+      end = start + count - 1
+      s = self.starts.floor(start)
+      if s is None:
+         s = self.starts.ceiling(start)
+      while s is not None and s <= end:
+         e = self.ends[s]
+         if e >= start:
+            self._remove(s)
+            if s < start:
+               self._add(s, start - 1)
+            if e > end:
+               self._add(end + 1, e)
+         s = self.starts.ceiling(s + 1)
+      self.dirty = True
 
-      return None
+   def tail(self, page_count):
+      """
+      :param page_count: The number of pages in the file.
+      :returns: The first page of the free extent that ends the file, or
+                'page_count' if the last page is in use.
+      """
+      last = self.starts.last()
+      if last is not None and self.ends[last] == page_count - 1:
+         return last
+      return page_count
+
+   def trim(self, page_count):
+      """
+      :synopsis: Removes the free extent that ends the file, if there is one.
+      :param page_count: The number of pages in the file.
+      :returns: The number of pages left in the file.
+      """
+      start = self.tail(page_count)
+      if start < page_count:
+         self._remove(start)
+         self.dirty = True
+      return start
 
    def release(self, e):
       """
-      :synopsis: Releases an extent back into the free pool.
+      :synopsis: Releases an extent back into the free pool, merging it with
+                 the free extents on either side of it.
       :param e: The extent to release.
-      :returns: True if the release worked, False otherwise.
+      :returns: True.
+      """
+      start, end = e.start, e.end
+      before = self.starts.floor(start - 1)
+      if before is not None and self.ends[before] + 1 >= start:
+         start = before
+         end = max(end, self._remove(before))
+      after = self.starts.ceiling(start)
+      while after is not None and after <= end + 1:
+         end = max(end, self._remove(after))
+         after = self.starts.ceiling(after)
+
+      self._add(start, end)
+      self.dirty = True
+      return True
+
+   def flush(self, d):
+      """
+      :synopsis: Writes the free list to disk. The file object must be
+                 positioned where the data should be written. Unused space on
+                 the last page will be cleared.
+      :param d: A file object.
+      """
+      data = [struct.pack(extent_header_fmt, len(self))]
+      for start in self.starts:
+         data.append(struct.pack(extent_fmt, start, self.ends[start]))
+      data = "".join(data)
+      d.write(data + "\x00" * (self.size() - len(data)))
+      self.dirty = False
+
+class DataPage(object):
+   """
+   :synopsis: A slotted page holding value records.
+
+   The slot directory follows the page header and grows towards the end of
+   the page, while the records are packed from the end of the page towards the
+   start. A value pointer names a slot rather than an offset, so the records
+   can be moved around the page to compact it without changing any pointers.
+   Page sizes must be below 64k.
+   """
+   __slots__ = ["dirty", "lsn", "page_size", "slots", "used", "data_start", "data", "version"]
+   def __init__(self, d, page_size):
+      """
+      :param d: A file object positioned at the start of the page, or None to
+                create an empty page.
+      :param page_size: The size of the page in bytes.
+      """
+      self.dirty = False
+      self.lsn = 0
+      self.page_size = page_size
+      self.slots = []
+      self.used = 0
+      self.data_start = page_size
+      self.data = bytearray(page_size)
+      self.version = 0
+      if d is None:
+         return
+
+      data = d.read(page_size)
+      if len(data) < struct.calcsize(data_page_header_fmt):
+         return
+      self.data[:len(data)] = data
+      self.lsn, count, self.data_start = struct.unpack_from(data_page_header_fmt, data)
+      offset = struct.calcsize(data_page_header_fmt)
+      slot_size = struct.calcsize(slot_fmt)
+      for i in range(0, count):
+         start, length = struct.unpack_from(slot_fmt, data, offset + i * slot_size)
+         self.slots.append((start, length) if start else None)
+         self.used += length
+
+   def copy(self):
+      dp = DataPage(None, self.page_size)
+      dp.dirty = self.dirty
+      dp.lsn = self.lsn
+      dp.slots = self.slots[:]
+      dp.used = self.used
+      dp.data_start = self.data_start
+      dp.data = bytearray(self.data)
+      return dp
+
+   def _directory_end(self, slot_count):
+      return struct.calcsize(data_page_header_fmt) + slot_count * struct.calcsize(slot_fmt)
+
+   def free_space(self):
+      """
+      :returns: The size of the largest record that insert() would accept,
+                once the page has been compacted.
+      """
+      slot_count = len(self.slots)
+      if None not in self.slots:
+         slot_count += 1
+      return max(self.page_size - self._directory_end(slot_count) - self.used, 0)
+
+   def is_empty(self):
+      return not self.slots
+
+   def get(self, slot):
+      start, length = self.slots[slot]
+      return str(self.data[start:start + length])
 
-      :notes: The free pool may run out of space for free extents. That is, the
-      pool may be so fragmented that there is not enough space to hold all of
-      the free ranges. Fragmentation is dealt with on each release by trying to
-      merge blocks. However, it may become fragmented simply due to certain
-      acquire and release patterns. release() tries very hard to make space in
-      the free pool, but may need to give up.
+   def insert(self, record):
       """
+      :synopsis: Stores a record in a free slot.
+      :returns: The slot number, or None if the record does not fit.
+      """
+      if len(record) > self.free_space():
+         return None
+
+      try:
+         slot = self.slots.index(None)
+      except ValueError:
+         slot = len(self.slots)
+      self.put(slot, record)
+      return slot
+
+   def put(self, slot, record):
+      """
+      :synopsis: Stores a record in the given slot, which must be free. The page
+                 is compacted if the free space is fragmented.
+      """
+      slot_count = max(len(self.slots), slot + 1)
+      if self.data_start - self._directory_end(slot_count) < len(record):
+         self.compact()
+         if self.data_start - self._directory_end(slot_count) < len(record):
+            raise IntegrityError()
+
+      self.slots.extend([None] * (slot_count - len(self.slots)))
+      self.data_start -= len(record)
+      self.data[self.data_start:self.data_start + len(record)] = record
+      self.slots[slot] = (self.data_start, len(record))
+      self.used += len(record)
       self.dirty = True
-      for o in self.extents:
-         if o.merge(e):
-            return True
-         if o > e:
-            break
 
-      if len(self.extents) >= self.max_entries:
-         if self.defragment() == False:
-            return False
+   def remove(self, slot):
+      """
+      :synopsis: Frees a slot. The space of the record is reclaimed by the next
+                 compaction.
+      """
+      self.used -= self.slots[slot][1]
+      self.slots[slot] = None
+      while self.slots and self.slots[-1] is None:
+         self.slots.pop()
+      if not self.slots:
+         self.data_start = self.page_size
+      self.dirty = True
 
-      self.extents.append(e)
-      self.extents.sort()
-      return True
+   def compact(self):
+      """
+      :synopsis: Moves the records together at the end of the page, so that all
+                 of the free space is in one piece.
+      """
+      end = self.page_size
+      data = bytearray(self.page_size)
+      for i, s in enumerate(self.slots):
+         if s is None:
+            continue
+         start, length = s
+         end -= length
+         data[end:end + length] = self.data[start:start + length]
+         self.slots[i] = (end, length)
+      self.data = data
+      self.data_start = end
+      self.dirty = True
 
-   def defragment(self):
+   def image(self):
       """
-      :synopsis: Tries to defragment the free pool by creating a new free pool
-                 and then releasing the old free pool into the new free pool one
-                 extent at a time.
-      :returns: True if space was recovered by the defragmentation process.
+      :synopsis: Returns the on-disk representation of the page.
       """
-      old_extents = self.extents
-      self.extents = []
-      space_recovered = False
-      for e in old_extents:
-         if self.release(e):
-            space_recovered = True
+      header = [struct.pack(data_page_header_fmt, self.lsn, len(self.slots), self.data_start)]
+      for s in self.slots:
+         header.append(struct.pack(slot_fmt, *(s or (0, 0))))
+      header = "".join(header)
+      self.data[:len(header)] = header
+      return str(self.data)
 
-      return space_recovered
+   def flush(self, d):
+      """
+      :synopsis: Writes the data page to disk. The file object must be
+                 positioned where the data should be written.
+      """
+      d.write(self.image())
+      self.dirty = False
+
+class OverflowPage(object):
+   """
+   :synopsis: One page of a value that is too large to be stored in a data
+   page. The pages of a value are chained together, and the last page has no
+   next page.
+   """
+   __slots__ = ["dirty", "lsn", "page_size", "next_page", "data", "version"]
+   def __init__(self, d, page_size, data="", next_page=0):
+      self.dirty = False
+      self.lsn = 0
+      self.version = 0
+      self.page_size = page_size
+      self.next_page = next_page
+      self.data = data
+      if d is None:
+         return
+
+      header_size = struct.calcsize(overflow_page_header_fmt)
+      header = d.read(header_size)
+      if len(header) < header_size:
+         return
+      self.lsn, self.next_page, length = struct.unpack(overflow_page_header_fmt, header)
+      self.data = d.read(min(length, self.capacity(page_size)))
+
+   def copy(self):
+      op = OverflowPage(None, self.page_size, self.data, self.next_page)
+      op.dirty = self.dirty
+      op.lsn = self.lsn
+      return op
+
+   @staticmethod
+   def capacity(page_size):
+      return page_size - struct.calcsize(overflow_page_header_fmt)
+
+   def image(self):
+      """
+      :synopsis: Returns the header and the data of the page, without the
+                 unused space at the end.
+      """
+      return struct.pack(overflow_page_header_fmt, self.lsn, self.next_page,
+                         len(self.data)) + self.data
 
    def flush(self, d):
+      data = self.image()
+      d.write(data + "\x00" * (self.page_size - len(data)))
+      self.dirty = False
+
+class IndexPage(object):
+   """
+   :synopsis: A page of the ordered index, which is a B+tree of the keys.
+
+   Leaves hold sorted keys and are chained together in key order. Nodes hold
+   sorted separator keys and one more child than they have keys: child i holds
+   the keys below key i, and child i + 1 the keys at or above it. The index
+   only holds keys; their values are found through the hash.
+   """
+   __slots__ = ["dirty", "lsn", "version", "page_size", "leaf", "keys", "children",
+                "next_page"]
+   def __init__(self, d, page_size, leaf=True):
       """
-      :synopsis: Writes the free page to disk. The file object must be positioned
-                where the data should be written. Unused space on the page will
-                be cleared.
-      :param d: A file object.
+      :param d: A file object positioned at the start of the page, or None to
+                create an empty page.
+      :param page_size: The size of the page in bytes.
+      :param leaf: Whether a new page is a leaf.
+      """
+      self.dirty = False
+      self.lsn = 0
+      self.version = 0
+      self.page_size = page_size
+      self.leaf = leaf
+      self.keys = []
+      self.children = [] if leaf else [0]
+      self.next_page = 0
+      if d is None:
+         return
+
+      data = d.read(page_size)
+      header_size = struct.calcsize(index_page_header_fmt)
+      if len(data) < header_size:
+         return
+      self.lsn, leaf, count, self.next_page = struct.unpack_from(index_page_header_fmt, data)
+      self.leaf = leaf == 1
+      if self.leaf:
+         self.keys = list(struct.unpack_from("<%dQ" % count, data, header_size))
+      else:
+         entries = struct.unpack_from("<%dQ" % (count * 2), data, header_size)
+         self.keys = list(entries[0::2])
+         self.children = [self.next_page] + list(entries[1::2])
+
+   def copy(self):
+      p = IndexPage(None, self.page_size, self.leaf)
+      p.dirty = self.dirty
+      p.lsn = self.lsn
+      p.keys = self.keys[:]
+      p.children = self.children[:]
+      p.next_page = self.next_page
+      return p
+
+   def capacity(self):
+      entry_fmt = index_leaf_fmt if self.leaf else index_node_fmt
+      return (self.page_size - struct.calcsize(index_page_header_fmt)) / struct.calcsize(entry_fmt)
+
+   def child(self, key):
+      """
+      :returns: The child page that 'key' belongs in.
+      """
+      return self.children[bisect.bisect_right(self.keys, key)]
+
+   def insert(self, key, child=0):
+      """
+      :synopsis: Adds a key to a leaf, or a separator key and the child to its
+                 right to a node. The page may hold more keys than fit on disk
+                 until it is split.
+      :returns: False if the key was already there.
       """
-      bytes_to_clear = self.page_size
-      for e in self.extents:
-         data = struct.pack(extent_fmt, e.start, e.end)
-         d.write(data)
-         bytes_to_clear -= len(data)
+      i = bisect.bisect_left(self.keys, key)
+      if i < len(self.keys) and self.keys[i] == key:
+         return False
+      self.keys.insert(i, key)
+      if not self.leaf:
+         self.children.insert(i + 1, child)
+      self.dirty = True
+      return True
 
-      if bytes_to_clear > 0:
-         d.write("\x00" * bytes_to_clear)
+   def remove(self, key):
+      """
+      :returns: False if the key was not there.
+      """
+      i = bisect.bisect_left(self.keys, key)
+      if i == len(self.keys) or self.keys[i] != key:
+         return False
+      del self.keys[i]
+      self.dirty = True
+      return True
+
+   def split(self):
+      """
+      :synopsis: Moves the upper half of the page to a new page.
+      :returns: The separator key and the new page. The caller chains a new
+                leaf in and links the new page from the parent.
+      """
+      right = IndexPage(None, self.page_size, self.leaf)
+      mid = len(self.keys) / 2
+      if self.leaf:
+         right.keys = self.keys[mid:]
+         separator = right.keys[0]
+         del self.keys[mid:]
+      else:
+         separator = self.keys[mid]
+         right.keys = self.keys[mid + 1:]
+         right.children = self.children[mid + 1:]
+         del self.keys[mid:]
+         del self.children[mid + 1:]
+      self.dirty = right.dirty = True
+      return separator, right
+
+   def image(self):
+      """
+      :synopsis: Returns the page header and entries, without the unused space
+                 at the end.
+      """
+      if self.leaf:
+         header = struct.pack(index_page_header_fmt, self.lsn, 1, len(self.keys), self.next_page)
+         return header + struct.pack("<%dQ" % len(self.keys), *self.keys)
+
+      header = struct.pack(index_page_header_fmt, self.lsn, 0, len(self.keys), self.children[0])
+      entries = [None] * (len(self.keys) * 2)
+      entries[0::2] = self.keys
+      entries[1::2] = self.children[1:]
+      return header + struct.pack("<%dQ" % len(entries), *entries)
+
+   def flush(self, d):
+      data = self.image()
+      d.write(data + "\x00" * (self.page_size - len(data)))
       self.dirty = False
 
+def read_value(pointer, fetch):
+   """
+   :synopsis: Reads the value that 'pointer' points at.
+   :param fetch: The function that returns a page given its number and its
+                 class.
+   """
+   dp = fetch(pointer >> SLOT_BITS, DataPage)
+   record = dp.get(pointer & ((1 << SLOT_BITS) - 1))
+   codec = ord(record[0]) >> CODEC_SHIFT
+   if ord(record[0]) & VALUE_STORAGE_MASK == VALUE_INLINE:
+      return decompress(codec, record[1:])
+
+   page, length = struct.unpack(overflow_value_fmt, record[1:])
+   data = []
+   while page:
+      op = fetch(page, OverflowPage)
+      data.append(op.data)
+      page = op.next_page
+   return decompress(codec, "".join(data))
+
 class DataFile(object):
    """
    :synopsis: Manages the data file header and large-scale operations of the data file.
@@ -343,14 +1158,89 @@ class DataFile(object):
    A datafile is a disk-based hash, with certain elements kept in memory for fast access. The elements
    can be paged out of memory one flushed to disk, which means that we don't have to take up a lot of
    RAM in order to store a lot of data.
+
+   Changes are durable once they have been committed. A commit happens
+   automatically after every 'group_commit' operations, and when commit(),
+   checkpoint() or close() is called.
+
+   Pages are read on demand into an MQ cache that holds at most 'cache_size'
+   bytes of pages. Dirty pages evicted from the cache are written back as soon
+   as the log records that changed them have been committed. The bloom filter
+   of every key page that has been read is kept after the page is evicted.
+
+   A DataFile has a single writer: get() and the methods that change the file
+   must all be called from one thread. Other threads read through snapshots,
+   which see the file as of the last commit before they were taken. Other
+   processes can read a shared file, see reader.Reader.
+
+   Every commit publishes a new version. The writer never changes a page that
+   a snapshot may be reading: the first time a page is changed after a commit,
+   the writer changes a copy, and the previous version of the page is kept
+   until no open snapshot is older than the copy. The directory is copied the
+   same way. A latch protects the cache and the data file handle, and is only
+   held while a page is looked up or read.
    """
-   __slots__ = [ "file_size_limit", "page_size", "mask", "cache", "d", "l", "a", "e" ]
-   def __init__(self, filename, page_size=8192, file_size_limit=100 * 1024 * 1024):
+   __slots__ = [ "file_size_limit", "page_size", "depth", "page_count", "checkpoint_lsn",
+                 "metadata_page", "metadata_pages", "header_slot", "group_commit",
+                 "uncommitted", "cache", "evicted", "space", "wal", "d", "l", "a", "e",
+                 "latch", "root", "versions", "page_versions", "snapshots", "index_root",
+                 "filters", "codec", "compress_threshold", "compaction", "lock",
+                 "metadata_lsn", "fuzzy" ]
+   def __init__(self, filename, page_size=8192, file_size_limit=100 * 1024 * 1024,
+                group_commit=128, cache_size=32 * 1024 * 1024, ordered_index=False,
+                compression=None, compress_threshold=256, shared=False):
+      """
+      :param file_size_limit: The size at which a partition.PartitionedStore
+                              starts a new data file. A data file on its own
+                              can grow past it.
+      :param ordered_index: If True, the keys are also kept in a B+tree so they
+                            can be iterated in order with range(). The index
+                            is built when an existing file without one is
+                            opened. A file that has an index always keeps it.
+      :param compression: "lz4" or "zlib" to compress the values that are
+                          stored from now on, or None to store them as they
+                          are. Values are read back whatever their codec.
+      :param compress_threshold: Values shorter than this are never
+                                 compressed.
+      :param shared: If True, other processes can read the file with a
+                     reader.Reader while this one writes it. They see the
+                     file as of the last checkpoint. Only one process can
+                     open a shared file for writing.
+      """
       self.page_size = page_size
+      self.codec = CODEC_NONE if compression is None else CODECS[compression]
+      self.compress_threshold = compress_threshold
       self.file_size_limit = file_size_limit
-      self.cache = {}
+      self.group_commit = group_commit
+      self.uncommitted = 0
+      self.cache = Cache(on_evict=self._evict_page, capacity=max(cache_size / page_size, 1))
+      self.evicted = {}
+      self.space = {}
+      # The bloom filter of the current version of each key page seen so far.
+      self.filters = {}
+      # The limit, next directory entry and visited key pages of the running
+      # compaction pass, or None.
+      self.compaction = None
+      # The running fuzzy checkpoint, or None.
+      self.fuzzy = None
       self.a = array.array("L")
       self.e = None
+      self.latch = threading.RLock()
+      # The last committed version, and its directory and global depth.
+      self.root = (0, None, 0, 0)
+      # The root page of the ordered index, or 0 if there is none.
+      self.index_root = 0
+      # The previous versions of pages, as (page, superseding version) lists.
+      self.versions = {}
+      # The versions of pages that were evicted after they were changed.
+      self.page_versions = {}
+      # The number of open snapshots of each version.
+      self.snapshots = {}
+      # The locks shared with reader processes, or None.
+      self.lock = None
+      if shared:
+         self.lock = FileLock(filename + ".lock")
+         self.lock.acquire_writer()
 
       if not os.path.exists(filename):
          self.d = open(filename, "w+b")
@@ -358,89 +1248,1138 @@ class DataFile(object):
          self._create()
       else:
          self.d = open(filename, "r+b")
-         self.l = open(filename + ".wal", "r+b")
+         self.l = open(filename + ".wal", "r+b") if os.path.exists(filename + ".wal") \
+                  else open(filename + ".wal", "w+b")
          self._load()
 
-      self.mask = (1 << (len(self.a))) - 1
+      if ordered_index and not self.index_root:
+         self._build_index()
 
-   def _create_header(self):
+   def _create_metadata(self):
+      """
+      :synopsis: Serializes the free extents and the directory.
       """
-      :synopsis: Generates a signature and header blob from the directory.
+      free = StringIO()
+      self.e.flush(free)
+      return free.getvalue() + self.a.tostring()
+
+   def _create_header(self, metadata, metadata_page, metadata_pages):
       """
-      directory = self.a.tostring()
-      header = struct.pack(header_write_fmt % len(directory), len(self.a), directory)
+      :synopsis: Generates a signature and header blob for a metadata snapshot.
+      """
+      header = struct.pack(header_fmt, format_version, self.depth, self.page_count,
+                           self.checkpoint_lsn, metadata_page, metadata_pages,
+                           len(metadata), self.index_root, self.metadata_lsn)
       m = hashlib.sha256()
       m.update(header)
+      m.update(metadata)
       return (m.digest(), header)
 
-   def _load_index_pages(self):
+   def _log(self, record_type, payload=""):
+      return self.wal.append(record_type, payload)
+
+   def _allocate_pages(self, count, log=True):
+      """
+      :synopsis: Allocates 'count' contiguous pages.
+      :returns: The number of the first page.
+      """
+      start = None
+      if self.compaction is not None:
+         start = self.e.acquire(count, self.compaction[0])
+      if start is None:
+         start = self.e.acquire(count)
+      if start is None:
+         start = self.page_count
+         self.page_count += count
+      if log:
+         self._log(REC_ALLOCATE, struct.pack(extent_fmt, start, count))
+      return start
+
+   def _release_pages(self, start, count, log=True):
+      """
+      :synopsis: Returns 'count' pages starting at 'start' to the free pool.
+      """
+      self.e.release(Extent(start, start + count - 1))
+      if log:
+         self._log(REC_RELEASE, struct.pack(extent_fmt, start, count))
+
+   def _flush_pages(self):
+      """
+      :synopsis: Writes the dirty pages.
+      """
+      with self.latch:
+         for k, v in self.cache.iteritems():
+            if v.dirty:
+               self._write_page(k, v)
+         for k, v in self.evicted.iteritems():
+            if v.dirty:
+               self._write_page(k, v)
+            self._forget_page(k, v)
+         self.evicted = {}
+
+   def _write_page(self, page, p):
+      with self.latch:
+         self.d.seek(self.page_size * page)
+         p.flush(self.d)
+
+   def _write_checkpoint_page(self, page, p):
+      """
+      :synopsis: Writes a page for a fuzzy checkpoint, unless it has been
+                 written back or released since the checkpoint began. Called
+                 from the checkpoint's thread.
+      """
+      with self.latch:
+         current = self.cache.peek(page)
+         if current is None:
+            current = self.evicted.get(page)
+         # A newer version that is dirty has not been written back, so the
+         # page on disk is older than 'p'.
+         if p.dirty and (current is p or (current is not None and current.dirty)):
+            self._write_page(page, p)
+
+   def _forget_page(self, page, p):
       """
-      :synopsis: Loads the index pages.
+      :synopsis: Remembers the version of a page that leaves memory, so that it
+                 gets the same version when it is read back.
       """
-      for v in self.a:
-         self.d.seek(self.page_size * v)
-         self.cache[v] = KeyPage(self.d, self.page_size)
+      if p.version:
+         self.page_versions[page] = p.version
 
-   def _flush_index_pages(self):
+   def _evict_page(self, page, p):
       """
-      :synopsis: Writes the dirty index pages.
+      :synopsis: Called by the cache when it evicts a page. The page is only
+                 set aside here, because the operation that caused the
+                 eviction may still be using it. See _write_back().
       """
-      for k, v in self.cache:
-         if v.dirty:
-            self.d.seek(self.page_size * k)
-            v.flush()
+      self.evicted[page] = p
 
-   def _flush_extents_page(self):
+   def _write_back(self):
       """
-      :synopsis: Writes the extents page.
+      :synopsis: Writes the evicted pages that are dirty. A page can only be
+                 written once every log record that changed it is durable, so
+                 pages with newer changes wait for the next commit.
+
+      When the file is shared, readers in other processes must only see the
+      pages written by a checkpoint, so dirty pages wait for the next
+      checkpoint instead. See _spill().
+      """
+      durable_lsn = self.wal.durable_lsn
+      with self.latch:
+         for page, p in self.evicted.items():
+            if p.dirty and (p.lsn > durable_lsn or self.lock is not None):
+               continue
+            if p.dirty:
+               self._write_page(page, p)
+            self._forget_page(page, p)
+            del self.evicted[page]
+
+   def _flush_metadata(self):
+      """
+      :synopsis: Writes a new metadata snapshot and switches the header to it.
+
+      The snapshot is always written to newly allocated pages, and the pages
+      of the previous snapshot are only released once the new one has been
+      allocated. Until the header is written the previous snapshot remains
+      intact, so a crash at any point leaves one complete snapshot.
       """
-      self.d.seek(self.page_size * 1)
-      self.e.flush(self.d)
+      # Allocating the snapshot and releasing the previous one adds at most
+      # one extent to the free list.
+      size = self.e.size() + self.page_size + len(self.a) * self.a.itemsize
+      pages = (size + self.page_size - 1) / self.page_size
+      page = self._allocate_pages(pages, log=False)
+      if self.metadata_pages:
+         self._release_pages(self.metadata_page, self.metadata_pages, log=False)
+      self.metadata_page, self.metadata_pages = page, pages
+      self.page_count = self.e.trim(self.page_count)
+      self.metadata_lsn = self.wal.next_lsn - 1
+
+      metadata = self._create_metadata()
+      with self.latch:
+         self.d.seek(self.page_size * page)
+         self.d.write(metadata)
+      self._sync()
+
+      signature, header = self._create_header(metadata, page, pages)
+      self.header_slot = 1 - self.header_slot
+      with self.latch:
+         self.d.seek(self.header_slot * (self.page_size / 2))
+         self.d.write(signature)
+         self.d.write(header)
+      self._sync()
+
+      # The pages past the end are free in both header slots' snapshots, or
+      # were only used by the previous snapshot.
+      with self.latch:
+         if os.fstat(self.d.fileno()).st_size > self.page_count * self.page_size:
+            self.d.truncate(self.page_count * self.page_size)
+
+   def _sync(self):
+      self.d.flush()
+      os.fsync(self.d.fileno())
 
    def _create(self):
       """
       :synopsis: Initializes the database file with a default directory.
       """
-      self.a.append(2)
-      self.a.append(3)
-      signature, header = self._create_header()
-      self.d.seek(0)
-      # print "signature=%d, header=%d" % (len(signature), len(header))
-      self.d.write(signature)
-      self.d.write(header)
-      self.d.flush()
-
-      self._load_index_pages()
+      # The header page comes first.
+      self.page_count = 1
+      self.checkpoint_lsn = self.metadata_lsn = 0
+      self.metadata_page = self.metadata_pages = 0
+      self.header_slot = 1
+      self.wal = WriteAheadLog(self.l)
+      self.e = FreePage(None, self.page_size)
+      self.depth = 1
+      for _ in range(0, 1 << self.depth):
+         page = self._allocate_pages(1, log=False)
+         self.a.append(page)
+         kp = self._cache_page(page, KeyPage(None, self.page_size, self.depth))
+         kp.dirty = True
+
+      self.checkpoint()
+      self._publish()
 
    def _load(self):
       """
-      :synopsis: Loads the database header and directory.
+      :synopsis: Loads the newest valid metadata snapshot and replays the log.
+      """
+      (fields, metadata), self.header_slot = read_newest_header(self.d, self.page_size)
+      _, self.depth, self.page_count, self.checkpoint_lsn, self.metadata_page, \
+         self.metadata_pages, _, self.index_root, self.metadata_lsn = fields
+
+      metadata = StringIO(metadata)
+      self.e = FreePage(metadata, self.page_size)
+      self.a.fromstring(metadata.read())
+      self.wal = WriteAheadLog(self.l, self.metadata_lsn + 1)
+
+      if self._replay():
+         self.checkpoint()
+      else:
+         self.wal.truncate()
+      self._publish()
+
+   def _replay(self):
+      """
+      :synopsis: Applies the committed log records that are not yet reflected
+                 in the data file.
+      :returns: True if any record was applied.
+
+      Page records are applied if the page is older than the record. Directory
+      and extent records are applied if the metadata snapshot is older than
+      the record. The two differ after a fuzzy checkpoint.
+
+      A fuzzy checkpoint does not write the pages that are released while it
+      runs, so the records of a page before its last release are skipped.
+      Whatever uses the page next starts with a record that creates it.
+      """
+      released = {}
+      for r in self.wal.records():
+         if r.lsn > self.checkpoint_lsn and r.record_type == REC_RELEASE:
+            start, count = struct.unpack(extent_fmt, r.payload)
+            for page in range(start, start + count):
+               released[page] = r.lsn
+
+      replayed = False
+      for r in self.wal.records():
+         if r.lsn <= self.checkpoint_lsn:
+            continue
+         replayed = True
+         if r.lsn <= self.metadata_lsn and r.record_type in METADATA_RECORDS:
+            continue
+         if r.record_type in PAGE_RECORDS and \
+            released.get(struct.unpack_from(page_number_fmt, r.payload)[0], 0) > r.lsn:
+            continue
+
+         if r.record_type == REC_KEY_SET:
+            page, key, pointer = struct.unpack(key_set_fmt, r.payload)
+            if self._page_lsn(page) < r.lsn:
+               kp = self._key_page(page)
+               kp.set(key, pointer)
+               kp.lsn = r.lsn
+         elif r.record_type == REC_KEY_DELETE:
+            page, key = struct.unpack(key_delete_fmt, r.payload)
+            if self._page_lsn(page) < r.lsn:
+               kp = self._key_page(page)
+               kp.delete(key)
+               kp.lsn = r.lsn
+         elif r.record_type in (REC_KEY_PAGE, REC_OVERFLOW_PAGE, REC_INDEX_PAGE):
+            page = struct.unpack_from(page_image_fmt, r.payload)[0]
+            if self._page_lsn(page) < r.lsn:
+               cls = { REC_KEY_PAGE : KeyPage,
+                       REC_OVERFLOW_PAGE : OverflowPage,
+                       REC_INDEX_PAGE : IndexPage }[r.record_type]
+               p = cls(StringIO(r.payload[struct.calcsize(page_image_fmt):]), self.page_size)
+               p.lsn = r.lsn
+               p.dirty = True
+               self._cache_page(page, p)
+         elif r.record_type == REC_DATA_PAGE:
+            page = struct.unpack(data_page_fmt, r.payload)[0]
+            if self._page_lsn(page) < r.lsn:
+               dp = self._cache_page(page, DataPage(None, self.page_size))
+               dp.lsn = r.lsn
+               dp.dirty = True
+         elif r.record_type in (REC_VALUE_PUT, REC_VALUE_REMOVE):
+            page, slot = struct.unpack_from(value_record_fmt, r.payload)
+            if self._page_lsn(page) < r.lsn:
+               dp = self._data_page(page)
+               if r.record_type == REC_VALUE_PUT:
+                  dp.put(slot, r.payload[struct.calcsize(value_record_fmt):])
+               else:
+                  dp.remove(slot)
+               dp.lsn = r.lsn
+         elif r.record_type in (REC_INDEX_INSERT, REC_INDEX_DELETE):
+            if r.record_type == REC_INDEX_INSERT:
+               page, key, child = struct.unpack(index_insert_fmt, r.payload)
+            else:
+               page, key = struct.unpack(index_delete_fmt, r.payload)
+            if self._page_lsn(page) < r.lsn:
+               p = self._page(page, IndexPage)
+               if r.record_type == REC_INDEX_INSERT:
+                  p.insert(key, child)
+               else:
+                  p.remove(key)
+               p.lsn = r.lsn
+         elif r.record_type == REC_INDEX_ROOT:
+            self.index_root = struct.unpack(index_root_fmt, r.payload)[0]
+         elif r.record_type == REC_DIRECTORY_DOUBLE:
+            self._double_directory()
+         elif r.record_type == REC_DIRECTORY_SPLIT:
+            self._repoint_directory(*struct.unpack(directory_split_fmt, r.payload))
+         elif r.record_type == REC_DIRECTORY_MOVE:
+            self._move_directory(*struct.unpack(directory_move_fmt, r.payload))
+         elif r.record_type == REC_ALLOCATE:
+            start, count = struct.unpack(extent_fmt, r.payload)
+            self.e.take(start, count)
+            self.page_count = max(self.page_count, start + count)
+         elif r.record_type == REC_RELEASE:
+            start, count = struct.unpack(extent_fmt, r.payload)
+            if r.lsn > self.metadata_lsn:
+               self._release_pages(start, count, log=False)
+            for page in range(start, start + count):
+               self._drop_page(page)
+         else:
+            raise IntegrityError()
+
+         self._write_back()
+
+      return replayed
+
+   def _page_lsn(self, page):
+      """
+      :returns: The lsn of a page, without caring what kind of page it is.
+      """
+      if page >= self.page_count:
+         # The page was released, and trimmed by the metadata snapshot, after
+         # the record being replayed. It has nothing to redo.
+         return MASK64
+      p = self.cache.get(page)
+      if p is None:
+         p = self.evicted.get(page)
+      if p is not None:
+         return p.lsn
+      self.d.seek(self.page_size * page)
+      data = self.d.read(struct.calcsize(page_lsn_fmt))
+      if len(data) < struct.calcsize(page_lsn_fmt):
+         return 0
+      return struct.unpack(page_lsn_fmt, data)[0]
+
+   def _page(self, page, cls):
+      """
+      :synopsis: Returns a page through the cache, reading it from the data
+                 file on a miss.
+      """
+      with self.latch:
+         p = self.cache.get(page)
+         if p is None:
+            p = self.evicted.pop(page, None)
+            if p is None:
+               self.d.seek(self.page_size * page)
+               p = cls(self.d, self.page_size)
+               p.version = self.page_versions.get(page, 0)
+            self._put_page(page, p)
+         return p
+
+   def _put_page(self, page, p):
+      """
+      :synopsis: Makes 'p' the current version of 'page' in the cache.
+      """
+      self.cache.put(page, p)
+      if isinstance(p, KeyPage):
+         self.filters[page] = p.filter
+
+   def _supersede(self, page, p, version):
+      """
+      :synopsis: Keeps 'p' for the snapshots that are older than 'version',
+                 unless 'p' was only created in 'version'.
+      """
+      if p is not None and p.version < version:
+         self.versions.setdefault(page, []).append((p, version))
+
+   def _writable(self, page, cls):
+      """
+      :synopsis: Returns the current version of a page for the writer to
+                 change, copying it first if it belongs to a committed version.
+      """
+      version = self.root[0] + 1
+      p = self._page(page, cls)
+      if p.version < version:
+         with self.latch:
+            self._supersede(page, p, version)
+            p = p.copy()
+            p.version = version
+            self._put_page(page, p)
+      return p
+
+   def _cache_page(self, page, p):
+      """
+      :synopsis: Makes 'p' the cached copy of 'page', replacing any other.
+      """
+      version = self.root[0] + 1
+      with self.latch:
+         self._supersede(page, self._remove_page(page), version)
+         p.version = version
+         self._put_page(page, p)
+      return p
+
+   def _drop_page(self, page):
+      """
+      :synopsis: Forgets a page that has been released.
+      """
+      version = self.root[0] + 1
+      with self.latch:
+         self._supersede(page, self._remove_page(page), version)
+      self.space.pop(page, None)
+      self.filters.pop(page, None)
+
+   def _remove_page(self, page):
+      """
+      :synopsis: Removes a page from memory, without writing it.
+      :returns: The page, or None if it was not in memory.
+      """
+      p = self.cache.remove(page)
+      evicted = self.evicted.pop(page, None)
+      return evicted if p is None else p
+
+   def _snapshot_page(self, page, cls, version):
+      """
+      :synopsis: Returns the version of a page that a snapshot of 'version'
+                 sees.
+      """
+      with self.latch:
+         for p, superseded in self.versions.get(page, ()):
+            if p.version <= version < superseded:
+               return p
+         return self._page(page, cls)
+
+   def _publish(self):
+      """
+      :synopsis: Makes the changes since the last commit visible to new
+                 snapshots.
+      """
+      with self.latch:
+         self.root = (self.root[0] + 1, self.a, self.depth, self.index_root)
+         self._collect_versions()
+
+   def _collect_versions(self):
+      """
+      :synopsis: Drops the page versions that no snapshot can see any more.
+      """
+      horizon = min([self.root[0]] + self.snapshots.keys())
+      for page, chain in self.versions.items():
+         chain = [(p, superseded) for p, superseded in chain if superseded > horizon]
+         if chain:
+            self.versions[page] = chain
+         else:
+            del self.versions[page]
+      for page, version in self.page_versions.items():
+         if version <= horizon:
+            del self.page_versions[page]
+
+   def _release_snapshot(self, version):
+      with self.latch:
+         self.snapshots[version] -= 1
+         if not self.snapshots[version]:
+            del self.snapshots[version]
+         self._collect_versions()
+
+   def _key_page(self, page):
+      return self._page(page, KeyPage)
+
+   def _data_page(self, page):
+      return self._page(page, DataPage)
+
+   def _overflow_page(self, page):
+      return self._page(page, OverflowPage)
+
+   def _update_space(self, page, dp):
+      """
+      :synopsis: Keeps track of the data pages that are worth trying when a
+                 new value is stored. Pages that are nearly full are forgotten.
+      """
+      if dp.free_space() >= self.page_size / 8:
+         self.space[page] = dp.free_space()
+      else:
+         self.space.pop(page, None)
+
+   def _write_value(self, value):
+      """
+      :synopsis: Stores a value in a data page, chaining it through overflow
+                 pages if it is too large to share a page.
+      :returns: The value pointer.
+      """
+      codec = CODEC_NONE
+      if self.codec != CODEC_NONE and len(value) >= self.compress_threshold:
+         codec, value = compress(value, self.codec)
+
+      record = chr(VALUE_INLINE | (codec << CODEC_SHIFT)) + value
+      if len(record) > self.page_size / 4:
+         record = chr(VALUE_OVERFLOW | (codec << CODEC_SHIFT)) + \
+                  struct.pack(overflow_value_fmt, self._write_overflow(value), len(value))
+
+      limit = self.page_count if self.compaction is None else self.compaction[0]
+      slot = None
+      for page, free in self.space.iteritems():
+         if free >= len(record) and page < limit:
+            dp = self._writable(page, DataPage)
+            slot = dp.insert(record)
+            break
+      if slot is None:
+         page = self._allocate_pages(1)
+         dp = self._cache_page(page, DataPage(None, self.page_size))
+         dp.lsn = self._log(REC_DATA_PAGE, struct.pack(data_page_fmt, page))
+         slot = dp.insert(record)
+
+      dp.lsn = self._log(REC_VALUE_PUT, struct.pack(value_record_fmt, page, slot) + record)
+      self._update_space(page, dp)
+      return (page << SLOT_BITS) | slot
+
+   def _write_overflow(self, value):
+      """
+      :synopsis: Writes a value to a chain of overflow pages, last page first.
+      :returns: The first page of the chain.
+      """
+      capacity = OverflowPage.capacity(self.page_size)
+      next_page = 0
+      for start in reversed(range(0, len(value), capacity)):
+         page = self._allocate_pages(1)
+         op = OverflowPage(None, self.page_size, value[start:start + capacity], next_page)
+         op.lsn = self._log(REC_OVERFLOW_PAGE, struct.pack(page_image_fmt, page) + op.image())
+         op.dirty = True
+         self._cache_page(page, op)
+         next_page = page
+      return next_page
+
+   def _read_value(self, pointer, fetch=None):
+      """
+      :param fetch: The function that returns a page given its number and its
+                    class. Defaults to the current version of the page.
       """
-      self.d.seek(0)
-      header = self.d.read(struct.calcsize(header_read_fmt))
-      # print "signature + entry_count = %d" % len(header)
-      signature, num_entries = struct.unpack(header_read_fmt, header)
-      self.a.fromfile(self.d, num_entries)
-      check, header = self._create_header()
-      if check != signature:
-         raise IntegrityError()
+      return read_value(pointer, fetch or self._page)
 
-      self._load_index_pages()
+   def _free_value(self, pointer):
+      """
+      :synopsis: Removes a value, and releases its overflow pages and its data
+                 page once they are no longer used.
+      """
+      page, slot = pointer >> SLOT_BITS, pointer & ((1 << SLOT_BITS) - 1)
+      dp = self._writable(page, DataPage)
+      record = dp.get(slot)
+      dp.remove(slot)
+      dp.lsn = self._log(REC_VALUE_REMOVE, struct.pack(value_record_fmt, page, slot))
+      if dp.is_empty():
+         self._release_pages(page, 1)
+         self._drop_page(page)
+      else:
+         self._update_space(page, dp)
+
+      if ord(record[0]) & VALUE_STORAGE_MASK == VALUE_OVERFLOW:
+         overflow_page = struct.unpack(overflow_value_fmt, record[1:])[0]
+         while overflow_page:
+            next_page = self._overflow_page(overflow_page).next_page
+            self._release_pages(overflow_page, 1)
+            self._drop_page(overflow_page)
+            overflow_page = next_page
+
+   def _double_directory(self):
+      """
+      :synopsis: Doubles the directory. Entry i + 2^depth points to the same
+                 page as entry i, so no keys move.
+      """
+      self._writable_directory()
+      self.a.extend(self.a[:])
+      self.depth += 1
+
+   def _repoint_directory(self, index, bit, new_page):
+      """
+      :synopsis: Every entry that shares the low bits of 'index' below 'bit'
+                 pointed at the page that was split. The ones with 'bit' set
+                 now point at 'new_page'.
+      """
+      self._writable_directory()
+      for i in xrange(index & (bit - 1), len(self.a), bit):
+         if i & bit:
+            self.a[i] = new_page
 
-   def checkpoint(self):
+   def _move_directory(self, index, stride, new_page):
       """
-      :synopsis: Flushes all dirty pages to disk.
+      :synopsis: Points every 'stride'th entry, starting with the one that
+                 shares the low bits of 'index', at 'new_page'.
       """
-      self._flush_index_pages()
+      self._writable_directory()
+      for i in xrange(index & (stride - 1), len(self.a), stride):
+         self.a[i] = new_page
+
+   def _writable_directory(self):
+      if self.a is self.root[1]:
+         self.a = array.array(self.a.typecode, self.a)
+
+   def _log_key_page(self, page, kp):
+      kp.lsn = self._log(REC_KEY_PAGE, struct.pack(page_image_fmt, page) + kp.image())
+      kp.dirty = True
+
+   def _split(self, index):
+      """
+      :synopsis: Splits the key page referenced by directory entry 'index'.
+      """
+      page = self.a[index]
+      kp = self._writable(page, KeyPage)
+      if kp.depth == self.depth:
+         self._double_directory()
+         self._log(REC_DIRECTORY_DOUBLE)
+
+      kp.depth += 1
+      bit = 1 << (kp.depth - 1)
+      new_page = self._allocate_pages(1)
+      new_kp = KeyPage(None, self.page_size, kp.depth)
+      kp.decode()
+      for k in [k for k in kp.keys if key_hash(k) & bit]:
+         new_kp.keys[k] = kp.keys.pop(k)
+      self._cache_page(new_page, new_kp)
+
+      # A split is logged as the images of both pages.
+      self._log_key_page(page, kp)
+      self._log_key_page(new_page, new_kp)
+
+      self._repoint_directory(index, bit, new_page)
+      self._log(REC_DIRECTORY_SPLIT, struct.pack(directory_split_fmt, index, bit, new_page))
+
+   def _value_moves(self, pointer, limit):
+      """
+      :returns: True if any page of a value is at or above 'limit'.
+      """
+      page = pointer >> SLOT_BITS
+      if page >= limit:
+         return True
+      record = self._data_page(page).get(pointer & ((1 << SLOT_BITS) - 1))
+      if ord(record[0]) & VALUE_STORAGE_MASK == VALUE_OVERFLOW:
+         page = struct.unpack(overflow_value_fmt, record[1:])[0]
+         while page:
+            if page >= limit:
+               return True
+            page = self._overflow_page(page).next_page
+      return False
+
+   def _move_key_page(self, index, page):
+      """
+      :synopsis: Copies the key page referenced by directory entry 'index' to
+                 a lower page, and releases the old page.
+      """
+      new_page = self._allocate_pages(1)
+      if new_page > page:
+         self._release_pages(new_page, 1)
+         return
+
+      kp = self._key_page(page)
+      new_kp = self._cache_page(new_page, kp.copy())
+      self._log_key_page(new_page, new_kp)
+      stride = 1 << kp.depth
+      self._move_directory(index, stride, new_page)
+      self._log(REC_DIRECTORY_MOVE, struct.pack(directory_move_fmt, index, stride, new_page))
+      self._release_pages(page, 1)
+      self._drop_page(page)
+
+   def _compact_key_page(self, index, page, limit):
+      """
+      :synopsis: Moves the values of a key page, and then the key page itself,
+                 below 'limit'.
+      """
+      for key, pointer in self._key_page(page).items():
+         if self._value_moves(pointer, limit):
+            self._set(key, self._read_value(pointer))
+            self._operation_done()
+      if page >= limit:
+         self._move_key_page(index, page)
+         self._operation_done()
+
+   def _build_index(self):
+      """
+      :synopsis: Creates the ordered index and adds every key to it.
+      """
+      page = self._allocate_pages(1)
+      root = self._cache_page(page, IndexPage(None, self.page_size))
+      root.lsn = self._log(REC_INDEX_PAGE, struct.pack(page_image_fmt, page) + root.image())
+      root.dirty = True
+      self._set_index_root(page)
+
+      for page in sorted(set(self.a)):
+         kp = self._key_page(page)
+         kp.decode()
+         for key in kp.keys.keys():
+            self._index_insert(key)
+      self.commit()
+
+   def _set_index_root(self, page):
+      self.index_root = page
+      self._log(REC_INDEX_ROOT, struct.pack(index_root_fmt, page))
+
+   def _log_index_page(self, page, p):
+      p.lsn = self._log(REC_INDEX_PAGE, struct.pack(page_image_fmt, page) + p.image())
+      p.dirty = True
+
+   def _index_leaf(self, key, fetch, root):
+      """
+      :returns: The path of pages from the root of the index down to the leaf
+                that 'key' belongs in.
+      """
+      path = [root]
+      p = fetch(root, IndexPage)
+      while not p.leaf:
+         path.append(p.child(key))
+         p = fetch(path[-1], IndexPage)
+      return path
+
+   def _index_insert(self, key):
+      """
+      :synopsis: Adds a key to the ordered index, splitting pages up the path
+                 as they overflow.
+      """
+      path = self._index_leaf(key, self._page, self.index_root)
+      page = path.pop()
+      p = self._writable(page, IndexPage)
+      if not p.insert(key):
+         return
+      p.lsn = self._log(REC_INDEX_INSERT, struct.pack(index_insert_fmt, page, key, 0))
+
+      while len(p.keys) > p.capacity():
+         separator, right = p.split()
+         right_page = self._allocate_pages(1)
+         self._cache_page(right_page, right)
+         if p.leaf:
+            right.next_page = p.next_page
+            p.next_page = right_page
+         self._log_index_page(page, p)
+         self._log_index_page(right_page, right)
+
+         if not path:
+            # The root was split, so the tree grows a level.
+            root_page = self._allocate_pages(1)
+            root = self._cache_page(root_page, IndexPage(None, self.page_size, leaf=False))
+            root.keys = [separator]
+            root.children = [page, right_page]
+            self._log_index_page(root_page, root)
+            self._set_index_root(root_page)
+            break
+
+         page = path.pop()
+         p = self._writable(page, IndexPage)
+         p.insert(separator, right_page)
+         p.lsn = self._log(REC_INDEX_INSERT, struct.pack(index_insert_fmt, page, separator,
+                                                         right_page))
+
+   def _index_delete(self, key):
+      """
+      :synopsis: Removes a key from the ordered index. Pages are not merged,
+                 so a leaf may be left empty; iteration skips over it.
+      """
+      page = self._index_leaf(key, self._page, self.index_root)[-1]
+      p = self._writable(page, IndexPage)
+      if p.remove(key):
+         p.lsn = self._log(REC_INDEX_DELETE, struct.pack(index_delete_fmt, page, key))
+
+   def _range(self, lo, hi, fetch, root, get):
+      if not root:
+         raise ValueError("the data file has no ordered index")
+
+      if lo is None:
+         page = root
+         p = fetch(page, IndexPage)
+         while not p.leaf:
+            page = p.children[0]
+            p = fetch(page, IndexPage)
+      else:
+         page = self._index_leaf(lo, fetch, root)[-1]
+         p = fetch(page, IndexPage)
+
+      while True:
+         start = 0 if lo is None else bisect.bisect_left(p.keys, lo)
+         for key in p.keys[start:]:
+            if hi is not None and key >= hi:
+               return
+            yield key, get(key)
+         if not p.next_page:
+            return
+         p = fetch(p.next_page, IndexPage)
+
+   def _index(self, key):
+      return key_hash(key) & ((1 << self.depth) - 1)
+
+   def _may_contain(self, page, key):
+      """
+      :returns: False if the bloom filter of 'page' rules 'key' out. A page
+                whose filter is not known yet may hold any key.
+      """
+      f = self.filters.get(page)
+      return f is None or bloom_contains(f, key)
+
+   def _operation_done(self):
+      self.uncommitted += 1
+      if self.uncommitted >= self.group_commit:
+         self.commit()
+      else:
+         self._write_back()
+      self._spill()
+
+   def _begin_checkpoint(self):
+      """
+      :synopsis: Starts a fuzzy checkpoint of the pages that are dirty now.
+      """
+      self.commit()
+      with self.latch:
+         pages = [(page, p) for page, p in self.cache.iteritems() if p.dirty]
+         pages.extend((page, p) for page, p in self.evicted.iteritems() if p.dirty)
+      pages.sort(key=lambda entry: entry[0])
+      self.fuzzy = FuzzyCheckpoint(self, self.wal.next_lsn - 1, pages)
+
+   def _finish_checkpoint(self):
+      """
+      :synopsis: Completes the fuzzy checkpoint once its pages are durable, by
+                 writing a metadata snapshot that redoes from where it began.
+                 The snapshot describes the file as it is in memory, so this
+                 is only called right after a commit.
+      """
+      if self.fuzzy is None or not self.fuzzy.done():
+         return
+      fuzzy, self.fuzzy = self.fuzzy, None
+      fuzzy.wait()
+      self.checkpoint_lsn = fuzzy.redo_lsn
+      self._flush_metadata()
+      self.wal.discard(fuzzy.redo_lsn + 1)
+      self.l = self.wal.f
+
+   def _spill(self):
+      """
+      :synopsis: Checkpoints a shared file once the dirty pages that are
+                 waiting for a checkpoint would fill the cache again.
+      """
+      if self.lock is not None and len(self.evicted) > self.cache.capacity:
+         self.checkpoint()
+
+   @contextlib.contextmanager
+   def _exclusive(self):
+      """
+      :synopsis: Keeps reader processes out while pages are written.
+      """
+      if self.lock is None:
+         yield
+      else:
+         with self.lock.exclusive():
+            yield
+
+   def commit(self):
+      """
+      :synopsis: Makes every operation so far durable with one log write and
+                 one fsync.
+      """
+      lsn = self.wal.commit()
+      self.uncommitted = 0
+      self._write_back()
+      if lsn is not None:
+         self._publish()
+      self._finish_checkpoint()
+
+   def checkpoint(self, background=False):
+      """
+      :synopsis: Flushes all dirty pages to disk and truncates the log.
+      :param background: If True, start a fuzzy checkpoint instead: the pages
+                         are written by a background thread, and the
+                         checkpoint completes at a later commit. Does
+                         nothing if one is running already. A shared file is
+                         always checkpointed in the foreground.
+      """
+      if background and self.lock is None:
+         if self.fuzzy is None:
+            self._begin_checkpoint()
+         return
+
+      if self.fuzzy is not None:
+         # This checkpoint writes every page the fuzzy one would have.
+         self.fuzzy.wait()
+         self.fuzzy = None
+      self.commit()
+      with self._exclusive():
+         self._flush_pages()
+         self._sync()
+         self.checkpoint_lsn = self.wal.next_lsn - 1
+         self._flush_metadata()
+      self.wal.truncate()
+
+   def compact(self, steps=8):
+      """
+      :synopsis: Does a bounded amount of compaction. Call it repeatedly,
+                 between other operations, until it returns False.
+      :param steps: The number of key pages to visit.
+      :returns: True if the compaction pass is not finished yet. When it
+                finishes, the file is checkpointed, which truncates it.
+      """
+      if self.compaction is None:
+         limit = self.page_count - self.e.pages()
+         if self.e.tail(self.page_count) <= limit:
+            # Everything past the limit is free already.
+            self.checkpoint()
+            return False
+         self.compaction = [limit, 0, set()]
+
+      limit, index, visited = self.compaction
+      while index < len(self.a) and steps > 0:
+         page = self.a[index]
+         if page not in visited:
+            visited.add(page)
+            self._compact_key_page(index, page, limit)
+            visited.add(self.a[index])
+            steps -= 1
+         index += 1
+      self.compaction[1] = index
+      if index < len(self.a):
+         return True
+
+      # The snapshot written by the checkpoint is kept below the limit too.
+      self.checkpoint()
+      self.compaction = None
+      return False
+
+   def close(self):
+      """
+      :synopsis: Checkpoints and closes the data file.
+      """
+      self.checkpoint()
+      self.d.close()
+      self.l.close()
+      if self.lock is not None:
+         self.lock.close()
+
+   def size(self):
+      """
+      :returns: The size of the data file in bytes, counting the pages that
+                have been allocated but not written yet.
+      """
+      return self.page_count * self.page_size
+
+   def get(self, key, default=None):
+      """
+      :synopsis: Returns the value stored with 'key', or 'default' if there is
+                 none.
+      """
+      page = self.a[self._index(key)]
+      if not self._may_contain(page, key):
+         return default
+      pointer = self._key_page(page).get(key)
+      if pointer is None:
+         return default
+      return self._read_value(pointer)
+
+   def snapshot(self):
+      """
+      :synopsis: Takes a snapshot of the last committed version of the file.
+                 The snapshot must be closed when it is no longer needed.
+      """
+      with self.latch:
+         root = self.root
+         self.snapshots[root[0]] = self.snapshots.get(root[0], 0) + 1
+      return Snapshot(self, root)
+
+   def get_many(self, keys, default=None):
+      """
+      :synopsis: Looks up many keys at once. Each key page is probed once for
+                 all of its keys, and the values are then read in the order
+                 of their data pages in the file.
+      :returns: A list with the value of each key, or 'default' for the keys
+                that have none.
+      """
+      by_page = {}
+      count = 0
+      for i, key in enumerate(keys):
+         page = self.a[self._index(key)]
+         if self._may_contain(page, key):
+            by_page.setdefault(page, []).append((i, key))
+         count += 1
+
+      values = [default] * count
+      pointers = []
+      for page in sorted(by_page):
+         kp = self._key_page(page)
+         for i, key in by_page[page]:
+            pointer = kp.get(key)
+            if pointer is not None:
+               pointers.append((pointer, i))
+
+      pointers.sort()
+      for pointer, i in pointers:
+         values[i] = self._read_value(pointer)
+      return values
+
+   def range(self, lo=None, hi=None):
+      """
+      :synopsis: Iterates over the keys from 'lo' up to but not including 'hi',
+                 in order. Either bound may be None to leave that side open.
+                 The file must have an ordered index.
+      :returns: A generator of (key, value) pairs.
+      """
+      return self._range(lo, hi, self._page, self.index_root, self.get)
+
+   def _set(self, key, value):
+      pointer = self._write_value(value)
+      while True:
+         index = self._index(key)
+         page = self.a[index]
+         kp = self._writable(page, KeyPage)
+         old_pointer = kp.get(key)
+         if kp.set(key, pointer):
+            kp.lsn = self._log(REC_KEY_SET, struct.pack(key_set_fmt, page, key, pointer))
+            break
+         self._split(index)
+
+      if old_pointer is not None:
+         self._free_value(old_pointer)
+      elif self.index_root:
+         self._index_insert(key)
 
    def set(self, key, value):
       """
       :synopsis: Stores the value with the corresponding key.
+      :param key: A 64-bit integer key.
+      :param value: A string of bytes.
       """
-      index = key & self.mask
-      page = self.a[index]
-      kp = self.cache[page]
+      self._set(key, value)
+      self._operation_done()
 
+   def set_many(self, items):
+      """
+      :synopsis: Stores many values at once, and commits them together.
+      :param items: A dict, or a sequence of (key, value) pairs. If a key
+                    appears more than once, the last value wins.
 
+      The keys are stored grouped by their directory entry, so each key page
+      is updated for all of its keys in turn.
+      """
+      if isinstance(items, dict):
+         items = items.iteritems()
+      mask = (1 << self.depth) - 1
+      for key, value in sorted(items, key=lambda item: key_hash(item[0]) & mask):
+         self._set(key, value)
+      self.commit()
+      self._spill()
 
+   def delete(self, key):
+      """
+      :synopsis: Removes 'key'.
+      :returns: True if the key existed.
+      """
+      page = self.a[self._index(key)]
+      if not self._may_contain(page, key):
+         return False
+      kp = self._key_page(page)
+      pointer = kp.get(key)
+      if pointer is None:
+         return False
 
+      kp = self._writable(page, KeyPage)
+      kp.delete(key)
+      kp.lsn = self._log(REC_KEY_DELETE, struct.pack(key_delete_fmt, page, key))
+      self._free_value(pointer)
+      if self.index_root:
+         self._index_delete(key)
+      self._operation_done()
+      return True
+
+class Snapshot(object):
+   """
+   :synopsis: A read-only view of a DataFile as of the commit it was taken at.
+
+   A snapshot may be used from any thread, and does not see the changes that
+   are committed after it was taken. Close it when it is no longer needed, so
+   that the old page versions it sees can be reclaimed.
+   """
+   __slots__ = ["datafile", "version", "a", "depth", "index_root"]
+   def __init__(self, datafile, root):
+      self.datafile = datafile
+      self.version, self.a, self.depth, self.index_root = root
+
+   def _page(self, page, cls):
+      return self.datafile._snapshot_page(page, cls, self.version)
+
+   def get(self, key, default=None):
+      """
+      :synopsis: Returns the value stored with 'key', or 'default' if there is
+                 none.
+      """
+      page = self.a[key_hash(key) & ((1 << self.depth) - 1)]
+      pointer = self._page(page, KeyPage).get(key)
+      if pointer is None:
+         return default
+      return self.datafile._read_value(pointer, self._page)
+
+   def range(self, lo=None, hi=None):
+      """
+      :synopsis: Iterates over the keys from 'lo' up to but not including 'hi',
+                 in order, as DataFile.range() does.
+      """
+      return self.datafile._range(lo, hi, self._page, self.index_root, self.get)
+
+   def close(self):
+      if self.datafile is not None:
+         self.datafile._release_snapshot(self.version)
+         self.datafile = None
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+class FuzzyCheckpoint(object):
+   """
+   :synopsis: Writes the pages of a fuzzy checkpoint in a background thread.
+   """
+   __slots__ = ["redo_lsn", "thread", "error"]
+   def __init__(self, datafile, redo_lsn, pages):
+      """
+      :param redo_lsn: Every change up to this LSN is either on disk or in
+                       'pages'.
+      :param pages: The (page number, page) pairs to write, in page order.
+      """
+      self.redo_lsn = redo_lsn
+      self.error = None
+      self.thread = threading.Thread(target=self._run, args=(datafile, pages))
+      self.thread.daemon = True
+      self.thread.start()
+
+   def _run(self, datafile, pages):
+      try:
+         for page, p in pages:
+            datafile._write_checkpoint_page(page, p)
+         with datafile.latch:
+            datafile.d.flush()
+         os.fsync(datafile.d.fileno())
+      except Exception as e:
+         self.error = e
+
+   def done(self):
+      return not self.thread.is_alive()
+
+   def wait(self):
+      """
+      :synopsis: Waits for the pages to be written.
+      :raises: Whatever the thread failed with.
+      """
+      self.thread.join()
+      if self.error is not None:
+         raise self.error
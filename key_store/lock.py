@@ -0,0 +1,84 @@
+"""
+Locks that let several processes share a data file.
+
+A shared data file has a lock file next to it, and two byte-range locks are
+taken on it with fcntl:
+
+byte 0
+   The writer lock. The writer process holds it exclusively for as long as the
+   data file is open, so there is never more than one writer.
+
+byte 1
+   The checkpoint lock. Readers hold it shared while they read pages, and the
+   writer holds it exclusively while a checkpoint writes pages, so a reader
+   never sees a checkpoint half done.
+
+fcntl locks belong to a process, not to a thread or a file object, and are
+dropped when the process exits.
+"""
+
+import contextlib
+import fcntl
+import os
+
+WRITER_BYTE = 0
+CHECKPOINT_BYTE = 1
+
+
+class LockError(Exception):
+   def __init__(self, msg):
+      Exception.__init__(self, msg)
+
+
+class FileLock(object):
+   """
+   :synopsis: The writer and checkpoint locks of one data file.
+   """
+   __slots__ = ["filename", "fd"]
+   def __init__(self, filename):
+      """
+      :param filename: The lock file. It is created if it does not exist.
+      """
+      self.filename = filename
+      self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+
+   def acquire_writer(self):
+      """
+      :synopsis: Takes the writer lock.
+      :raises LockError: If another process already holds it.
+      """
+      try:
+         fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, WRITER_BYTE)
+      except IOError:
+         raise LockError("%s is locked by another writer" % self.filename)
+
+   @contextlib.contextmanager
+   def shared(self):
+      """
+      :synopsis: Holds the checkpoint lock shared, for a reader.
+      """
+      fcntl.lockf(self.fd, fcntl.LOCK_SH, 1, CHECKPOINT_BYTE)
+      try:
+         yield
+      finally:
+         fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, CHECKPOINT_BYTE)
+
+   @contextlib.contextmanager
+   def exclusive(self):
+      """
+      :synopsis: Holds the checkpoint lock exclusively, for the writer. Waits
+                 until no reader holds it.
+      """
+      fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, CHECKPOINT_BYTE)
+      try:
+         yield
+      finally:
+         fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, CHECKPOINT_BYTE)
+
+   def close(self):
+      """
+      :synopsis: Releases every lock.
+      """
+      if self.fd is not None:
+         os.close(self.fd)
+         self.fd = None
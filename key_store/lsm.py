@@ -0,0 +1,843 @@
+"""
+A log-structured merge tree key store.
+
+An LSMStore has the same interface as a DataFile, but never changes anything it
+has written. A write costs a log record and a dict insert, which suits tables
+that are written much more often than they are read.
+
+Changes go to the write-ahead log and to the memtable, a dict in memory. Once
+the memtable holds 'memtable_size' bytes it is frozen, and a background thread
+writes it out as a sorted table (an SSTable) while a new memtable takes the
+writes. The two memtables share one log: the records of the frozen memtable
+are discarded once its table is durable.
+
+The tables are kept in levels. Level 0 holds the tables written from
+memtables, newest first, and their keys can overlap. Every other level is a
+run of tables in key order whose keys do not overlap, and may hold
+'level_ratio' times as much as the level above it. When level 0 has
+'level0_limit' tables, or another level grows past its size, the background
+thread merges a table into the overlapping tables of the next level down. A
+table that overlaps nothing there is moved down without being rewritten.
+Deleted keys are kept as tombstones until they are merged into the last
+level.
+
+A key is looked up in the memtable, the frozen memtable, and then the levels
+from the top down. The first version found is the newest.
+
+Table file 'filename.N.sst':
+
++------------+-----+------------+-------+--------+--------+
+| data block | ... | data block | index | filter | footer |
++------------+-----+------------+-------+--------+--------+
+
+A data block holds about 'block_size' bytes of entries, in key order, and is
+compressed as a whole:
+
++-------+------------------------------------------------+
+| codec | entries ...                                    |
+| <B    | key <Q, type <B, value length <I, value ...    |
++-------+------------------------------------------------+
+
+The index has the first key, offset and length of every block (<QQI), so a
+lookup reads at most one block. The filter is a bloom filter of the table's
+keys with BLOOM_BITS bits per key. The footer is:
+
++--------------+--------+---------------+---------------+---------+---------+-------+-------+
+| index offset | blocks | filter offset | filter length | entries | max key | crc32 | magic |
+| <Q           | <Q     | <Q            | <Q            | <Q      | <Q      | <I    | 4s    |
++--------------+--------+---------------+---------------+---------+---------+-------+-------+
+
+The crc covers the index and the filter.
+
+The manifest 'filename' names the tables of every level:
+
++-------+---------+------------+-------------+--------+----------------------------+-------+
+| magic | version | next table | flushed lsn | levels | per level: count <I,       | crc32 |
+| 4s    | <I      | <Q         | <Q          | <I     | table numbers <Q ...       | <I    |
++-------+---------+------------+-------------+--------+----------------------------+-------+
+
+It is written to a temporary file and renamed over the old one after every
+flush and compaction, so a crash leaves one or the other. 'flushed lsn' is
+the last log record that is in a table. A table is only written in full,
+and synced, before the manifest names it, and it is unlinked once the
+manifest no longer does. Lookups that are still reading an unlinked table
+keep it open until they finish.
+"""
+
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from glob import glob
+
+from column_store.durability import sync_directory, sync_file
+from column_store.mq import Cache
+from compression import CODEC_NONE, CODECS, compress, decompress
+from datafile import IntegrityError, bloom_add, bloom_contains
+from wal import WriteAheadLog
+
+format_version = 1
+
+MANIFEST_MAGIC = "CQLM"
+TABLE_MAGIC = "CQLT"
+
+# magic, version, next table number, flushed lsn, level count
+manifest_header_fmt = "<4sIQQI"
+# table count
+manifest_level_fmt = "<I"
+# key, entry type, value length
+entry_fmt = "<QBI"
+entry_size = struct.calcsize(entry_fmt)
+# first key, offset, length
+index_entry_fmt = "<QQI"
+index_entry_size = struct.calcsize(index_entry_fmt)
+# index offset, block count, filter offset, filter length, entry count,
+# max key, crc32, magic
+footer_fmt = "<QQQQQQI4s"
+footer_size = struct.calcsize(footer_fmt)
+
+# entry types
+VALUE = 0
+TOMBSTONE = 1
+
+# log record types
+REC_SET = 1
+REC_DELETE = 2
+
+# key, followed by the value
+set_fmt = "<Q"
+# key
+delete_fmt = "<Q"
+
+# bits of a table's bloom filter per key
+BLOOM_BITS = 10
+
+# what a memtable entry costs besides its value, roughly
+MEMTABLE_OVERHEAD = 64
+
+_missing = object()
+
+
+def _ranked(entries, rank):
+   for key, value in entries:
+      yield key, rank, value
+
+
+def merge_entries(sources):
+   """
+   :synopsis: Merges sorted runs of (key, value) entries. A value of None is a
+              tombstone.
+   :param sources: The runs, newest first. Where they have the same key, the
+                   newest run wins.
+   :returns: A generator of (key, value) entries in key order.
+   """
+   last = _missing
+   for key, _, value in heapq.merge(*[_ranked(s, rank) for rank, s in enumerate(sources)]):
+      if key != last:
+         last = key
+         yield key, value
+
+
+class Table(object):
+   """
+   :synopsis: An SSTable. The file is mapped into memory and never changes.
+   """
+   __slots__ = ["number", "filename", "f", "m", "size", "first_keys", "blocks", "filter",
+                "entry_count", "min_key", "max_key"]
+   def __init__(self, filename, number):
+      """
+      :raises IntegrityError: If the file is not a complete table.
+      """
+      self.number = number
+      self.filename = filename
+      self.f = open(filename, "rb")
+      self.size = os.fstat(self.f.fileno()).st_size
+      if self.size < footer_size:
+         self.f.close()
+         raise IntegrityError()
+      self.m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+      index_offset, block_count, filter_offset, filter_length, self.entry_count, \
+         self.max_key, crc, magic = struct.unpack_from(footer_fmt, self.m, self.size - footer_size)
+      if magic != TABLE_MAGIC or \
+         zlib.crc32(self.m[index_offset:filter_offset + filter_length]) & 0xffffffff != crc:
+         self.close()
+         raise IntegrityError()
+
+      self.first_keys = []
+      self.blocks = []
+      for i in range(0, block_count):
+         key, offset, length = struct.unpack_from(index_entry_fmt, self.m,
+                                                  index_offset + i * index_entry_size)
+         self.first_keys.append(key)
+         self.blocks.append((offset, length))
+      self.filter = bytearray(self.m[filter_offset:filter_offset + filter_length])
+      self.min_key = self.first_keys[0]
+
+   def close(self):
+      self.m.close()
+      self.f.close()
+
+   def overlaps(self, lo, hi):
+      return self.min_key <= hi and self.max_key >= lo
+
+   def read_block(self, i):
+      """
+      :returns: The keys of block 'i' and their values, with None for the
+                tombstones, as two lists.
+      """
+      offset, length = self.blocks[i]
+      data = decompress(ord(self.m[offset]), self.m[offset + 1:offset + length])
+      keys = []
+      values = []
+      pos = 0
+      while pos < len(data):
+         key, entry_type, length = struct.unpack_from(entry_fmt, data, pos)
+         pos += entry_size
+         keys.append(key)
+         if entry_type == TOMBSTONE:
+            values.append(None)
+         else:
+            values.append(data[pos:pos + length])
+            pos += length
+      return keys, values
+
+   def find(self, key, cache):
+      """
+      :param cache: A cache of decoded blocks, by (table number, block).
+      :returns: The value of 'key', None if the table has a tombstone for it,
+                or _missing if the table does not have it.
+      """
+      if key < self.min_key or key > self.max_key or not bloom_contains(self.filter, key):
+         return _missing
+      i = bisect.bisect_right(self.first_keys, key) - 1
+      block = cache.get((self.number, i))
+      if block is None:
+         block = self.read_block(i)
+         cache.put((self.number, i), block)
+      keys, values = block
+      j = bisect.bisect_left(keys, key)
+      if j < len(keys) and keys[j] == key:
+         return values[j]
+      return _missing
+
+   def entries(self, lo=None):
+      """
+      :returns: A generator of the (key, value) entries from 'lo' on, in key
+                order, without going through the block cache.
+      """
+      start = 0 if lo is None else max(bisect.bisect_right(self.first_keys, lo) - 1, 0)
+      for i in range(start, len(self.blocks)):
+         keys, values = self.read_block(i)
+         for key, value in zip(keys, values):
+            if lo is None or key >= lo:
+               yield key, value
+
+
+class TableWriter(object):
+   """
+   :synopsis: Writes the entries of an SSTable, in key order.
+   """
+   __slots__ = ["filename", "number", "f", "block_size", "codec", "block", "block_bytes",
+                "first_key", "max_key", "index", "keys", "offset"]
+   def __init__(self, filename, number, block_size, codec):
+      self.filename = filename
+      self.number = number
+      self.f = open(filename, "wb")
+      self.block_size = block_size
+      self.codec = codec
+      self.block = []
+      self.block_bytes = 0
+      self.first_key = None
+      self.max_key = None
+      self.index = []
+      self.keys = []
+      self.offset = 0
+
+   def _write_block(self):
+      codec, data = compress("".join(self.block), self.codec)
+      data = chr(codec) + data
+      self.f.write(data)
+      self.index.append(struct.pack(index_entry_fmt, self.first_key, self.offset, len(data)))
+      self.offset += len(data)
+      self.block = []
+      self.block_bytes = 0
+
+   def add(self, key, value):
+      """
+      :param value: The value, or None for a tombstone.
+      """
+      if not self.block:
+         self.first_key = key
+      if value is None:
+         self.block.append(struct.pack(entry_fmt, key, TOMBSTONE, 0))
+         self.block_bytes += entry_size
+      else:
+         self.block.append(struct.pack(entry_fmt, key, VALUE, len(value)))
+         self.block.append(value)
+         self.block_bytes += entry_size + len(value)
+      self.keys.append(key)
+      self.max_key = key
+      if self.block_bytes >= self.block_size:
+         self._write_block()
+
+   def size(self):
+      return self.offset + self.block_bytes
+
+   def finish(self):
+      """
+      :synopsis: Writes the index, filter and footer, and syncs the file.
+      :returns: The Table.
+      """
+      if self.block:
+         self._write_block()
+      index = "".join(self.index)
+      f = bytearray(max((len(self.keys) * BLOOM_BITS + 7) // 8, 8))
+      for key in self.keys:
+         bloom_add(f, key)
+      f = str(f)
+      self.f.write(index)
+      self.f.write(f)
+      self.f.write(struct.pack(footer_fmt, self.offset, len(self.index), self.offset + len(index),
+                               len(f), len(self.keys), self.max_key,
+                               zlib.crc32(index + f) & 0xffffffff, TABLE_MAGIC))
+      sync_file(self.f)
+      self.f.close()
+      return Table(self.filename, self.number)
+
+
+class Version(object):
+   """
+   :synopsis: The tables of every level at some point. A version never
+              changes; the background thread installs a new one instead.
+   """
+   __slots__ = ["levels", "starts"]
+   def __init__(self, levels):
+      """
+      :param levels: A list of lists of tables. Level 0 is newest first, the
+                     others are in key order.
+      """
+      self.levels = levels
+      self.starts = [[t.min_key for t in level] for level in levels]
+
+   def tables(self):
+      return [t for level in self.levels for t in level]
+
+   def find(self, key, cache):
+      for table in self.levels[0]:
+         value = table.find(key, cache)
+         if value is not _missing:
+            return value
+      for level, starts in zip(self.levels[1:], self.starts[1:]):
+         i = bisect.bisect_right(starts, key) - 1
+         if i >= 0:
+            value = level[i].find(key, cache)
+            if value is not _missing:
+               return value
+      return _missing
+
+   def sources(self, lo):
+      """
+      :returns: A sorted run of entries for every table of level 0 and for
+                every other level, newest first.
+      """
+      runs = [t.entries(lo) for t in self.levels[0]]
+      for level, starts in zip(self.levels[1:], self.starts[1:]):
+         i = 0 if lo is None else max(bisect.bisect_right(starts, lo) - 1, 0)
+         runs.append(_chain_entries(level[i:], lo))
+      return runs
+
+
+def _chain_entries(tables, lo):
+   for table in tables:
+      for entry in table.entries(lo):
+         yield entry
+
+
+class LSMStore(object):
+   """
+   :synopsis: A key store made of a memtable and levels of SSTables.
+
+   Changes are durable once they have been committed. A commit happens
+   automatically after every 'group_commit' operations, and when commit(),
+   checkpoint() or close() is called.
+
+   Like a DataFile, the store has a single user thread. A background thread
+   writes frozen memtables out and compacts the levels. Writes wait for it
+   only when a second memtable fills up before the first has been written, or
+   when level 0 has fallen far behind. Blocks read by get() are kept in an MQ
+   cache of 'cache_size' bytes.
+   """
+   __slots__ = ["filename", "memtable_size", "table_size", "block_size", "level_ratio",
+                "level0_limit", "group_commit", "codec", "uncommitted", "memtable",
+                "memtable_bytes", "immutable", "immutable_lsn", "version", "next_table",
+                "flushed_lsn", "discarded_lsn", "compact_keys", "cache", "wal", "l",
+                "condition", "thread", "closing", "error"]
+   def __init__(self, filename, memtable_size=4 * 1024 * 1024, table_size=2 * 1024 * 1024,
+                block_size=4096, level_ratio=10, level0_limit=4, group_commit=128,
+                cache_size=32 * 1024 * 1024, compression=None):
+      """
+      :param filename: The name of the manifest. The tables are named
+                       filename.N.sst and the log filename.wal.
+      :param memtable_size: The size at which the memtable is frozen and
+                            written out.
+      :param table_size: The size at which compaction starts a new table.
+                         Level 1 may hold 'level_ratio' tables of this size.
+      :param block_size: The size of the blocks a table is read in.
+      :param compression: "lz4" or "zlib" to compress the blocks of the
+                          tables written from now on, or None.
+      """
+      self.filename = filename
+      self.memtable_size = memtable_size
+      self.table_size = table_size
+      self.block_size = block_size
+      self.level_ratio = level_ratio
+      self.level0_limit = level0_limit
+      self.group_commit = group_commit
+      self.codec = CODEC_NONE if compression is None else CODECS[compression]
+      self.uncommitted = 0
+      # The key -> value map of the changes since the last flush. A deleted
+      # key maps to None.
+      self.memtable = {}
+      self.memtable_bytes = 0
+      # The frozen memtable that the background thread is writing out, and
+      # the LSN of its last record.
+      self.immutable = None
+      self.immutable_lsn = 0
+      # The key each level last compacted up to, so the tables of a level
+      # take turns.
+      self.compact_keys = {}
+      self.cache = Cache(capacity=max(cache_size / block_size, 1))
+      self.condition = threading.Condition()
+      self.closing = False
+      # What the background thread failed with, raised by the next operation.
+      self.error = None
+
+      if os.path.exists(filename):
+         self._load()
+      else:
+         self.next_table = 1
+         self.flushed_lsn = 0
+         self._install(Version([[]]))
+
+      if os.path.exists(filename + ".wal"):
+         self.l = open(filename + ".wal", "r+b")
+      else:
+         self.l = open(filename + ".wal", "w+b")
+      self.wal = WriteAheadLog(self.l, self.flushed_lsn + 1)
+      self._replay()
+      self.discarded_lsn = self.flushed_lsn
+
+      self.thread = threading.Thread(target=self._run)
+      self.thread.daemon = True
+      self.thread.start()
+
+   def _table_filename(self, number):
+      return "%s.%d.sst" % (self.filename, number)
+
+   def _load(self):
+      """
+      :synopsis: Opens the tables named by the manifest, and removes any that
+                 a crash left behind.
+      :raises IntegrityError: If the manifest is corrupt.
+      """
+      with open(self.filename, "rb") as f:
+         data = f.read()
+      header_size = struct.calcsize(manifest_header_fmt)
+      if len(data) < header_size + 4 or \
+         zlib.crc32(data[:-4]) & 0xffffffff != struct.unpack_from("<I", data, len(data) - 4)[0]:
+         raise IntegrityError()
+      magic, version, self.next_table, self.flushed_lsn, level_count = \
+         struct.unpack_from(manifest_header_fmt, data)
+      if magic != MANIFEST_MAGIC or version != format_version:
+         raise IntegrityError()
+
+      levels = []
+      pos = header_size
+      for _ in range(0, level_count):
+         count = struct.unpack_from(manifest_level_fmt, data, pos)[0]
+         pos += struct.calcsize(manifest_level_fmt)
+         numbers = struct.unpack_from("<%dQ" % count, data, pos)
+         pos += 8 * count
+         levels.append([Table(self._table_filename(n), n) for n in numbers])
+      self.version = Version(levels)
+
+      named = set(t.filename for t in self.version.tables())
+      for filename in glob("%s.*.sst" % self.filename):
+         if filename not in named:
+            os.unlink(filename)
+
+   def _replay(self):
+      """
+      :synopsis: Rebuilds the memtable from the committed log records that are
+                 not in a table yet, writes it out, and empties the log.
+      """
+      for r in self.wal.records():
+         if r.lsn <= self.flushed_lsn:
+            continue
+         key = struct.unpack_from(set_fmt, r.payload)[0]
+         if r.record_type == REC_SET:
+            self.memtable[key] = r.payload[struct.calcsize(set_fmt):]
+         elif r.record_type == REC_DELETE:
+            self.memtable[key] = None
+         else:
+            raise IntegrityError()
+
+      if self.memtable:
+         self._flush_memtable(self.memtable, self.wal.next_lsn - 1)
+         self.memtable = {}
+      self.wal.truncate()
+
+   def _save_manifest(self, version, flushed_lsn):
+      out = [struct.pack(manifest_header_fmt, MANIFEST_MAGIC, format_version, self.next_table,
+                         flushed_lsn, len(version.levels))]
+      for level in version.levels:
+         out.append(struct.pack(manifest_level_fmt, len(level)))
+         out.append(struct.pack("<%dQ" % len(level), *[t.number for t in level]))
+      data = "".join(out)
+      data += struct.pack("<I", zlib.crc32(data) & 0xffffffff)
+
+      tmp_filename = self.filename + ".tmp"
+      with open(tmp_filename, "wb") as f:
+         f.write(data)
+         sync_file(f)
+      os.rename(tmp_filename, self.filename)
+      sync_directory(self.filename)
+
+   def _install(self, version, flushed_lsn=None, obsolete=()):
+      """
+      :synopsis: Makes 'version' current, first on disk and then for lookups,
+                 and unlinks the tables it replaced.
+      """
+      if flushed_lsn is None:
+         flushed_lsn = self.flushed_lsn
+      self._save_manifest(version, flushed_lsn)
+      self.version = version
+      self.flushed_lsn = flushed_lsn
+      for table in obsolete:
+         os.unlink(table.filename)
+
+   def _write_tables(self, entries, split=True):
+      """
+      :synopsis: Writes sorted entries to new tables of at most 'table_size'
+                 bytes each, or to a single table if not 'split'.
+      :returns: The list of tables.
+      """
+      tables = []
+      writer = None
+      for key, value in entries:
+         if writer is None:
+            writer = TableWriter(self._table_filename(self.next_table), self.next_table,
+                                 self.block_size, self.codec)
+            self.next_table += 1
+         writer.add(key, value)
+         if split and writer.size() >= self.table_size:
+            tables.append(writer.finish())
+            writer = None
+      if writer is not None:
+         tables.append(writer.finish())
+      return tables
+
+   def _flush_memtable(self, memtable, lsn):
+      """
+      :synopsis: Writes a memtable out as a new table of level 0.
+      :param lsn: The LSN of the memtable's last log record.
+      """
+      version = self.version
+      tables = self._write_tables(sorted(memtable.iteritems()), split=False)
+      self._install(Version([tables + version.levels[0]] + version.levels[1:]), lsn)
+
+   def _level_limit(self, level):
+      return self.table_size * self.level_ratio ** level
+
+   def _pick_compaction(self):
+      """
+      :returns: The level that most needs to be merged into the next, or None.
+      """
+      levels = self.version.levels
+      if len(levels[0]) >= self.level0_limit:
+         return 0
+      for level in range(1, len(levels)):
+         if sum(t.size for t in levels[level]) > self._level_limit(level):
+            return level
+      return None
+
+   def _compact(self, level):
+      """
+      :synopsis: Merges level 0, or the next table of another level in turn,
+                 into the tables of the next level that it overlaps.
+      """
+      version = self.version
+      levels = [list(tables) for tables in version.levels]
+      if level + 1 == len(levels):
+         levels.append([])
+      if level == 0:
+         inputs = levels[0]
+      else:
+         last_key = self.compact_keys.get(level)
+         inputs = [next((t for t in levels[level] if last_key is None or t.min_key > last_key),
+                        levels[level][0])]
+         self.compact_keys[level] = inputs[0].max_key
+      lo = min(t.min_key for t in inputs)
+      hi = max(t.max_key for t in inputs)
+      below = [t for t in levels[level + 1] if t.overlaps(lo, hi)]
+
+      if len(inputs) == 1 and not below:
+         outputs = inputs
+         obsolete = []
+      else:
+         sources = [t.entries() for t in inputs] + [_chain_entries(below, None)]
+         entries = merge_entries(sources)
+         if not any(levels[level + 2:]):
+            # Nothing older is left below, so tombstones have done their job.
+            entries = ((k, v) for k, v in entries if v is not None)
+         outputs = self._write_tables(entries)
+         obsolete = inputs + below
+
+      levels[level] = [t for t in levels[level] if t not in inputs]
+      levels[level + 1] = sorted([t for t in levels[level + 1] if t not in below] + outputs,
+                                 key=lambda t: t.min_key)
+      while len(levels) > 1 and not levels[-1]:
+         levels.pop()
+      self._install(Version(levels), obsolete=obsolete)
+
+   def _run(self):
+      """
+      :synopsis: The background thread: writes out frozen memtables first,
+                 and compacts when there is nothing to write.
+      """
+      try:
+         while True:
+            with self.condition:
+               while True:
+                  immutable = self.immutable
+                  if immutable is not None:
+                     break
+                  if self.closing:
+                     return
+                  level = self._pick_compaction()
+                  if level is not None:
+                     break
+                  self.condition.wait()
+
+            if immutable is not None:
+               self._flush_memtable(immutable, self.immutable_lsn)
+               with self.condition:
+                  self.immutable = None
+                  self.condition.notify_all()
+            else:
+               self._compact(level)
+               with self.condition:
+                  self.condition.notify_all()
+      except Exception as e:
+         with self.condition:
+            self.error = e
+            self.condition.notify_all()
+
+   def _check(self):
+      if self.error is not None:
+         raise self.error
+
+   def _wait(self, busy):
+      """
+      :synopsis: Waits, for the background thread, while busy() is True.
+      """
+      with self.condition:
+         while busy() and self.error is None:
+            self.condition.wait()
+      self._check()
+
+   def _freeze(self):
+      """
+      :synopsis: Hands the memtable to the background thread and starts a new
+                 one. Its records are committed first, so a table never holds
+                 a change that the log might lose.
+      """
+      self.commit()
+      # Level 0 is searched table by table, so writes stop before it grows
+      # far past the point where compaction starts.
+      self._wait(lambda: self.immutable is not None or
+                         len(self.version.levels[0]) >= 3 * self.level0_limit)
+      with self.condition:
+         self.immutable = self.memtable
+         self.immutable_lsn = self.wal.next_lsn - 1
+         self.condition.notify_all()
+      self.memtable = {}
+      self.memtable_bytes = 0
+
+   def _discard_log(self):
+      """
+      :synopsis: Drops the log records that the background thread has written
+                 to a table.
+      """
+      self._check()
+      lsn = self.flushed_lsn
+      if lsn > self.discarded_lsn:
+         self.commit()
+         self.wal.discard(lsn + 1)
+         self.l = self.wal.f
+         self.discarded_lsn = lsn
+
+   def _put(self, key, value):
+      if value is None:
+         self.wal.append(REC_DELETE, struct.pack(delete_fmt, key))
+      else:
+         self.wal.append(REC_SET, struct.pack(set_fmt, key) + value)
+      old = self.memtable.get(key, _missing)
+      if old is not _missing:
+         self.memtable_bytes -= MEMTABLE_OVERHEAD + len(old or "")
+      self.memtable[key] = value
+      self.memtable_bytes += MEMTABLE_OVERHEAD + len(value or "")
+
+   def _operation_done(self):
+      self.uncommitted += 1
+      if self.uncommitted >= self.group_commit:
+         self.commit()
+      if self.memtable_bytes >= self.memtable_size:
+         self._freeze()
+      self._discard_log()
+
+   def commit(self):
+      """
+      :synopsis: Makes every operation so far durable with one log write and
+                 one fsync.
+      """
+      self.wal.commit()
+      self.uncommitted = 0
+
+   def checkpoint(self):
+      """
+      :synopsis: Writes the memtable out to a table and empties the log.
+      """
+      self.commit()
+      if self.memtable:
+         self._freeze()
+      self._wait(lambda: self.immutable is not None)
+      self._discard_log()
+
+   def compact(self, steps=8):
+      """
+      :synopsis: Waits until the background thread has caught up with
+                 compaction. The store compacts itself; this exists so an
+                 LSMStore can stand in for a DataFile.
+      :param steps: Ignored.
+      :returns: False, as the compaction is finished.
+      """
+      self._wait(lambda: self.immutable is not None or self._pick_compaction() is not None)
+      return False
+
+   def close(self):
+      """
+      :synopsis: Checkpoints the store, stops the background thread, and
+                 closes the files. A compaction that is running is finished
+                 first; one that is due is left for the next time the store is
+                 opened.
+      """
+      self.checkpoint()
+      with self.condition:
+         self.closing = True
+         self.condition.notify_all()
+      self.thread.join()
+      self._check()
+      self.l.close()
+      for table in self.version.tables():
+         table.close()
+
+   def size(self):
+      """
+      :returns: The size of the tables in bytes.
+      """
+      return sum(t.size for t in self.version.tables())
+
+   def _lookup(self, key):
+      value = self.memtable.get(key, _missing)
+      if value is _missing:
+         # The frozen memtable is read before the version, as the background
+         # thread installs the table it writes before letting it go.
+         immutable = self.immutable
+         if immutable is not None:
+            value = immutable.get(key, _missing)
+         if value is _missing:
+            value = self.version.find(key, self.cache)
+      return value
+
+   def get(self, key, default=None):
+      """
+      :synopsis: Returns the value stored with 'key', or 'default' if there is
+                 none.
+      """
+      value = self._lookup(key)
+      if value is _missing or value is None:
+         return default
+      return value
+
+   def get_many(self, keys, default=None):
+      """
+      :returns: A list with the value of each key, or 'default' for the keys
+                that have none.
+      """
+      return [self.get(key, default) for key in keys]
+
+   def range(self, lo=None, hi=None):
+      """
+      :synopsis: Iterates over the keys from 'lo' up to but not including 'hi',
+                 in order. Either bound may be None to leave that side open.
+                 The memtables are read when the iteration starts, so later
+                 changes are not seen.
+      :returns: A generator of (key, value) pairs.
+      """
+      runs = []
+      immutable = self.immutable
+      for memtable in (self.memtable, immutable):
+         if memtable is not None:
+            runs.append(sorted((k, v) for k, v in memtable.iteritems()
+                               if (lo is None or k >= lo) and (hi is None or k < hi)))
+      runs.extend(self.version.sources(lo))
+      return self._range(runs, hi)
+
+   def _range(self, runs, hi):
+      for key, value in merge_entries(runs):
+         if hi is not None and key >= hi:
+            return
+         if value is not None:
+            yield key, value
+
+   def set(self, key, value):
+      """
+      :synopsis: Stores the value with the corresponding key.
+      :param key: A 64-bit integer key.
+      :param value: A string of bytes.
+      """
+      self._put(key, value)
+      self._operation_done()
+
+   def set_many(self, items):
+      """
+      :synopsis: Stores many values at once, and commits them together.
+      :param items: A dict, or a sequence of (key, value) pairs. If a key
+                    appears more than once, the last value wins.
+      """
+      if isinstance(items, dict):
+         items = items.iteritems()
+      for key, value in items:
+         self._put(key, value)
+      self.commit()
+      if self.memtable_bytes >= self.memtable_size:
+         self._freeze()
+      self._discard_log()
+
+   def delete(self, key):
+      """
+      :synopsis: Removes 'key'.
+      :returns: True if the key existed.
+      """
+      value = self._lookup(key)
+      if value is _missing or value is None:
+         return False
+      self._put(key, None)
+      self._operation_done()
+      return True
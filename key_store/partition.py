@@ -0,0 +1,242 @@
+"""
+A key store partitioned across many data files.
+
+Keys are hashed to one of a fixed number of partitions. Each partition is a
+sequence of segments, every one of them a DataFile. Writes go to the newest
+segment of a partition, and once it reaches the data file's size limit a new
+segment is started, so no file grows much past the limit. The older segments
+stay open for reading, and a key is removed from them once it has been written
+to the newest one and committed there.
+
+The segments of partition p are named 'basename.p.s', with s counting up from
+zero. A key that is found in more than one segment, because a crash came
+between writing the new copy and deleting the old one, is read from the
+newest.
+
+Batch operations, commits and checkpoints work on every partition they touch
+at the same time, in a pool of threads. A partition is only ever used by one
+thread at a time.
+"""
+
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from datafile import DataFile, key_hash
+
+_missing = object()
+
+
+class Partition(object):
+   """
+   :synopsis: The segments of one partition.
+   """
+   __slots__ = ["basename", "options", "segments", "deletes"]
+   def __init__(self, basename, options):
+      """
+      :param basename: The name of the partition. Segment s is basename.s.
+      :param options: The keyword arguments to open every DataFile with.
+      """
+      self.basename = basename
+      self.options = options
+      count = 0
+      while os.path.exists(self._filename(count)):
+         count += 1
+      self.segments = [DataFile(self._filename(s), **options) for s in range(0, max(count, 1))]
+      # The keys written to the newest segment since it last committed. They
+      # are removed from the older segments after it commits.
+      self.deletes = set()
+
+   def _filename(self, segment):
+      return "%s.%d" % (self.basename, segment)
+
+   def _roll(self):
+      """
+      :synopsis: Starts a new segment once the newest one is full.
+      """
+      current = self.segments[-1]
+      if current.size() >= current.file_size_limit:
+         self.commit()
+         self.segments.append(DataFile(self._filename(len(self.segments)), **self.options))
+
+   def get(self, key, default=None):
+      for segment in reversed(self.segments):
+         value = segment.get(key, _missing)
+         if value is not _missing:
+            return value
+      return default
+
+   def get_many(self, keys, default=None):
+      values = [default] * len(keys)
+      pending = range(0, len(keys))
+      for segment in reversed(self.segments):
+         if not pending:
+            break
+         found = segment.get_many([keys[i] for i in pending], _missing)
+         missing = []
+         for i, value in zip(pending, found):
+            if value is _missing:
+               missing.append(i)
+            else:
+               values[i] = value
+         pending = missing
+      return values
+
+   def _apply_deletes(self):
+      """
+      :synopsis: Removes the keys that the newest segment has committed from
+                 the older segments.
+      """
+      deletes, self.deletes = self.deletes, set()
+      for segment in self.segments[:-1]:
+         for key in deletes:
+            segment.delete(key)
+
+   def set(self, key, value):
+      newest = self.segments[-1]
+      newest.set(key, value)
+      if len(self.segments) > 1:
+         self.deletes.add(key)
+         # A crash could lose both copies if an older segment committed the
+         # delete first.
+         if newest.uncommitted == 0:
+            self._apply_deletes()
+      self._roll()
+
+   def set_many(self, items):
+      """
+      :synopsis: Stores the items in the newest segment and commits them, and
+                 only then removes their keys from the older segments.
+      """
+      items = dict(items)
+      self.segments[-1].set_many(items)
+      self.deletes.update(items)
+      self._apply_deletes()
+      for segment in self.segments[:-1]:
+         segment.commit()
+      self._roll()
+
+   def delete(self, key):
+      deleted = False
+      for segment in self.segments:
+         deleted = segment.delete(key) or deleted
+      return deleted
+
+   def commit(self):
+      self.segments[-1].commit()
+      self._apply_deletes()
+      for segment in self.segments[:-1]:
+         segment.commit()
+
+   def checkpoint(self):
+      self.commit()
+      for segment in self.segments:
+         segment.checkpoint()
+
+   def close(self):
+      self.commit()
+      for segment in self.segments:
+         segment.close()
+
+
+class PartitionedStore(object):
+   """
+   :synopsis: Hashes keys across 'partitions' partitions of data files.
+
+   The store has a single user thread, like a DataFile. get(), set() and
+   delete() work on one partition in the calling thread. The batch
+   operations, commit(), checkpoint() and close() run every partition in the
+   thread pool.
+   """
+   __slots__ = ["partitions", "pool"]
+   def __init__(self, basename, partitions=8, threads=None, **options):
+      """
+      :param basename: The prefix of the names of the data files.
+      :param partitions: The number of partitions. It can not be changed
+                         once the store has been created.
+      :param threads: The size of the thread pool. Defaults to one thread per
+                      partition.
+      :param options: Passed to every DataFile. file_size_limit is the size
+                      at which a partition starts a new segment.
+      """
+      existing = 0
+      while os.path.exists("%s.%d.0" % (basename, existing)):
+         existing += 1
+      if existing and existing != partitions:
+         raise ValueError("%s has %d partitions, not %d" % (basename, existing, partitions))
+
+      self.partitions = [Partition("%s.%d" % (basename, p), options)
+                         for p in range(0, partitions)]
+      self.pool = ThreadPool(threads or partitions)
+
+   def _index(self, key):
+      # The low bits of the hash select the directory entry in a data file,
+      # so the partition is chosen with the high bits.
+      return (key_hash(key) >> 32) % len(self.partitions)
+
+   def _partition(self, key):
+      return self.partitions[self._index(key)]
+
+   def _group(self, pairs):
+      """
+      :returns: A list of (partition, items) for the partitions that have any
+                of the (key, item) pairs.
+      """
+      groups = {}
+      for key, item in pairs:
+         groups.setdefault(self._index(key), []).append(item)
+      return [(self.partitions[i], entries) for i, entries in groups.iteritems()]
+
+   def _each(self, method):
+      self.pool.map(lambda p: getattr(p, method)(), self.partitions)
+
+   def get(self, key, default=None):
+      return self._partition(key).get(key, default)
+
+   def set(self, key, value):
+      self._partition(key).set(key, value)
+
+   def delete(self, key):
+      """
+      :returns: True if the key existed.
+      """
+      return self._partition(key).delete(key)
+
+   def get_many(self, keys, default=None):
+      """
+      :synopsis: Looks up the keys of each partition in parallel.
+      :returns: A list with the value of each key, or 'default' for the keys
+                that have none.
+      """
+      keys = list(keys)
+      groups = self._group((key, (i, key)) for i, key in enumerate(keys))
+      results = self.pool.map(
+         lambda group: group[0].get_many([key for _, key in group[1]], default), groups)
+      values = [default] * len(keys)
+      for (_, entries), found in zip(groups, results):
+         for (i, _), value in zip(entries, found):
+            values[i] = value
+      return values
+
+   def set_many(self, items):
+      """
+      :synopsis: Stores the items of each partition in parallel, and commits
+                 them. A batch is atomic within each partition, but not across
+                 partitions.
+      :param items: A dict, or a sequence of (key, value) pairs.
+      """
+      if isinstance(items, dict):
+         items = items.iteritems()
+      groups = self._group((key, (key, value)) for key, value in items)
+      self.pool.map(lambda group: group[0].set_many(group[1]), groups)
+
+   def commit(self):
+      self._each("commit")
+
+   def checkpoint(self):
+      self._each("checkpoint")
+
+   def close(self):
+      self._each("close")
+      self.pool.close()
+      self.pool.join()
@@ -0,0 +1,109 @@
+"""
+Read-only access to a shared data file from other processes.
+
+A DataFile opened with shared=True has one writer process. Any number of other
+processes can open a Reader on the same file. A reader maps the data file
+read-only and sees it as of the writer's last checkpoint: the writer keeps its
+dirty pages to itself between checkpoints, and holds the checkpoint lock
+while a checkpoint writes them.
+
+Every checkpoint rewrites one of the two header slots, so the header works as
+a generation counter. Before each read the reader compares the header slots
+with the ones it last loaded, and if they changed it maps the file again and
+reloads the directory.
+"""
+
+import array
+import mmap
+import os
+import struct
+
+from cStringIO import StringIO
+
+from datafile import FreePage, KeyPage, header_fmt, key_hash, read_newest_header, \
+   read_value, signature_fmt
+from lock import FileLock
+
+
+class Reader(object):
+   """
+   :synopsis: Reads a shared data file that another process writes.
+
+   A reader must only be used from one thread at a time, and not from the
+   writer's process: fcntl locks do not keep apart the users of a file within
+   one process.
+   """
+   __slots__ = ["filename", "page_size", "lock", "f", "m", "headers", "a", "depth"]
+   def __init__(self, filename, page_size=8192):
+      """
+      :param page_size: The page size the data file was created with.
+      """
+      self.filename = filename
+      self.page_size = page_size
+      self.lock = FileLock(filename + ".lock")
+      # Unbuffered, so that the header is read again on every check.
+      self.f = open(filename, "rb", 0)
+      self.m = None
+      # The raw header slots the directory was loaded from.
+      self.headers = None
+      self.a = None
+      self.depth = 0
+
+   def _header_slots(self):
+      size = struct.calcsize(signature_fmt) + struct.calcsize(header_fmt)
+      self.f.seek(0)
+      first = self.f.read(size)
+      self.f.seek(self.page_size / 2)
+      return first, self.f.read(size)
+
+   def _refresh(self):
+      """
+      :synopsis: Loads the newest checkpoint if the header changed since the
+                 last one was loaded. Called with the checkpoint lock held.
+      """
+      headers = self._header_slots()
+      if headers == self.headers:
+         return
+
+      if self.m is not None:
+         self.m.close()
+      self.m = mmap.mmap(self.f.fileno(), os.fstat(self.f.fileno()).st_size,
+                         access=mmap.ACCESS_READ)
+      (fields, metadata), _ = read_newest_header(self.m, self.page_size)
+      self.depth = fields[1]
+
+      metadata = StringIO(metadata)
+      FreePage(metadata, self.page_size)
+      self.a = array.array("L")
+      self.a.fromstring(metadata.read())
+      self.headers = headers
+
+   def _page(self, page, cls):
+      self.m.seek(self.page_size * page)
+      return cls(self.m, self.page_size)
+
+   def get(self, key, default=None):
+      """
+      :synopsis: Returns the value stored with 'key' at the last checkpoint, or
+                 'default' if there was none.
+      """
+      with self.lock.shared():
+         self._refresh()
+         page = self.a[key_hash(key) & ((1 << self.depth) - 1)]
+         pointer = self._page(page, KeyPage).get(key)
+         if pointer is None:
+            return default
+         return read_value(pointer, self._page)
+
+   def close(self):
+      if self.m is not None:
+         self.m.close()
+         self.m = None
+      self.f.close()
+      self.lock.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
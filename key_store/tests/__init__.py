@@ -27,6 +27,813 @@ class TestDataFile(unittest.TestCase):
       del df
       df = datafile.DataFile(self.filename)
 
+   def test_can_set_and_get(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename)
+      df.set(100, "500")
+      self.assertEqual(df.get(100), "500")
+      self.assertEqual(df.get(101), None)
+
+   def test_can_delete(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename)
+      df.set(100, "500")
+      self.assertTrue(df.delete(100))
+      self.assertFalse(df.delete(100))
+      self.assertEqual(df.get(100), None)
+
+   def test_pages_split(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256)
+      for key in range(0, 5000):
+         df.set(key, str(key * 2))
+
+      self.assertTrue(df.depth > 5)
+      for key in range(0, 5000):
+         self.assertEqual(df.get(key), str(key * 2))
+
+   def test_directory_persists(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256)
+      for key in range(0, 5000):
+         df.set(key * 7919, str(key))
+      depth = df.depth
+      df.close()
+      # The directory no longer fits in one page.
+      self.assertTrue(df.metadata_pages > 1)
+
+      df = datafile.DataFile(self.filename, page_size=256)
+      self.assertEqual(df.depth, depth)
+      for key in range(0, 5000):
+         self.assertEqual(df.get(key * 7919), str(key))
+
+   def test_committed_changes_survive_crash(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, group_commit=10)
+      for key in range(0, 1000):
+         df.set(key, str(key + 1))
+      df.delete(5)
+      df.commit()
+
+      # Reopen without closing, as if the process had died.
+      df = datafile.DataFile(self.filename, page_size=256)
+      self.assertEqual(df.get(5), None)
+      for key in range(6, 1000):
+         self.assertEqual(df.get(key), str(key + 1))
+
+   def test_background_checkpoint(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 32,
+                             group_commit=10)
+      for key in range(0, 1000):
+         df.set(key, str(key + 1))
+      df.checkpoint(background=True)
+      fuzzy = df.fuzzy
+      # Writes carry on while the pages are written.
+      for key in range(0, 1000, 3):
+         df.set(key, "new %d" % key)
+      df.delete(5)
+      fuzzy.thread.join()
+      df.set(2000, "last")
+      df.commit()
+      self.assertEqual(df.fuzzy, None)
+      self.assertEqual(df.checkpoint_lsn, fuzzy.redo_lsn)
+      self.assertTrue(df.metadata_lsn > fuzzy.redo_lsn)
+
+      def check(df):
+         self.assertEqual(df.get(5), None)
+         for key in range(6, 1000):
+            self.assertEqual(df.get(key), "new %d" % key if key % 3 == 0 else str(key + 1))
+         self.assertEqual(df.get(2000), "last")
+
+      check(df)
+      df.commit()
+      # Reopen without closing, so the log is replayed from the redo point.
+      df = datafile.DataFile(self.filename, page_size=256)
+      check(df)
+
+   def test_background_checkpoint_waits_for_commit(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, group_commit=100)
+      for key in range(0, 100):
+         df.set(key, "old")
+      df.commit()
+      df.checkpoint(background=True)
+      df.fuzzy.thread.join()
+
+      # The pages are written, but the batch must not be committed early to
+      # finish the checkpoint.
+      for key in range(0, 50):
+         df.set(key, "new")
+         with df.snapshot() as s:
+            self.assertEqual([s.get(k) for k in range(0, 100)], ["old"] * 100)
+      self.assertNotEqual(df.fuzzy, None)
+
+      df.commit()
+      self.assertEqual(df.fuzzy, None)
+      with df.snapshot() as s:
+         self.assertEqual([s.get(k) for k in range(0, 100)], ["new"] * 50 + ["old"] * 50)
+
+   def test_crash_during_background_checkpoint(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, group_commit=10)
+      for key in range(0, 1000):
+         df.set(key, str(key + 1))
+      df.checkpoint(background=True)
+      df.fuzzy.thread.join()
+      for key in range(0, 1000, 2):
+         df.delete(key)
+      df.commit()
+
+      # The pages were written, but the checkpoint was never completed.
+      df = datafile.DataFile(self.filename, page_size=256)
+      for key in range(0, 1000):
+         self.assertEqual(df.get(key), None if key % 2 == 0 else str(key + 1))
+
+   def test_page_released_during_background_checkpoint(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, group_commit=100)
+      df.set(1, "one")
+      with df.latch:
+         # The thread cannot write a page until the latch is released, so the
+         # data page of key 1 is released before it is ever written.
+         df.checkpoint(background=True)
+         fuzzy = df.fuzzy
+         df.delete(1)
+         df.commit()
+      fuzzy.thread.join()
+      # The page is used again before the checkpoint completes.
+      df.set(2, "two")
+      df.commit()
+      self.assertEqual(df.checkpoint_lsn, fuzzy.redo_lsn)
+
+      df = datafile.DataFile(self.filename, page_size=256)
+      self.assertEqual(df.get(1), None)
+      self.assertEqual(df.get(2), "two")
+
+   def test_uncommitted_changes_are_lost(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, group_commit=100)
+      df.set(1, "2")
+      df.commit()
+      df.set(3, "4")
+
+      df = datafile.DataFile(self.filename)
+      self.assertEqual(df.get(1), "2")
+      self.assertEqual(df.get(3), None)
+
+   def test_torn_log_tail_is_ignored(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename)
+      df.set(1, "2")
+      df.commit()
+      with open(self.wal_filename, "ab") as f:
+         f.write("\x01\x02\x03 torn record")
+
+      df = datafile.DataFile(self.filename)
+      self.assertEqual(df.get(1), "2")
+      df.close()
+      self.assertEqual(os.path.getsize(self.wal_filename), 0)
+
+   def test_values_of_any_size(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=512)
+      values = dict((key, "v" * (key * 37)) for key in range(0, 100))
+      for key, value in values.iteritems():
+         df.set(key, value)
+      df.close()
+
+      df = datafile.DataFile(self.filename, page_size=512)
+      for key, value in values.iteritems():
+         self.assertEqual(df.get(key), value)
+
+   def test_overwrite_reuses_space(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=512)
+      for _ in range(0, 50):
+         for key in range(0, 20):
+            df.set(key, "x" * 3000)
+            df.set(key + 100, "y" * 20)
+      page_count = df.page_count
+      for _ in range(0, 50):
+         for key in range(0, 20):
+            df.set(key, "x" * 3000)
+            df.set(key + 100, "y" * 20)
+      self.assertEqual(df.page_count, page_count)
+      self.assertEqual(df.get(7), "x" * 3000)
+
+   def test_compact(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=512, cache_size=512 * 16)
+      for key in range(0, 2000):
+         df.set(key, "value %d" % key * (1 + key % 40))
+      df.checkpoint()
+      size = os.path.getsize(self.filename)
+      for key in range(0, 2000):
+         if key % 5:
+            df.delete(key)
+
+      # Other operations can run between the steps.
+      steps = 0
+      while df.compact(steps=2):
+         steps += 1
+         df.set(100000 + steps, "during %d" % steps)
+      self.assertTrue(steps > 1)
+      self.assertTrue(os.path.getsize(self.filename) < size / 2)
+      self.assertEqual(os.path.getsize(self.filename), df.page_count * 512)
+
+      def check(df):
+         for key in range(0, 2000):
+            self.assertEqual(df.get(key), None if key % 5 else "value %d" % key * (1 + key % 40))
+         for step in range(1, steps + 1):
+            self.assertEqual(df.get(100000 + step), "during %d" % step)
+
+      check(df)
+      df.set(5000, "after")
+      df.commit()
+      # Reopen without closing, so the compacted file is replayed.
+      df = datafile.DataFile(self.filename, page_size=512)
+      check(df)
+      self.assertEqual(df.get(5000), "after")
+
+      # A second pass packs the file further.
+      page_count = df.page_count
+      while df.compact():
+         pass
+      self.assertTrue(df.page_count < page_count)
+      check(df)
+
+   def test_small_cache(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 8)
+      for key in range(0, 2000):
+         df.set(key, "value %d" % key)
+         self.assertTrue(len(df.cache) <= 8)
+      for key in range(0, 2000, 3):
+         df.delete(key)
+
+      # Reopen without closing, so evicted pages and the log both matter.
+      df.commit()
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 8)
+      for key in range(0, 2000):
+         self.assertEqual(df.get(key), None if key % 3 == 0 else "value %d" % key)
+
+   def test_missing_keys_skip_evicted_pages(self):
+      from key_store import datafile
+
+      class CountingFile(object):
+         def __init__(self, f):
+            self.f = f
+            self.reads = 0
+         def read(self, size):
+            self.reads += 1
+            return self.f.read(size)
+         def __getattr__(self, name):
+            return getattr(self.f, name)
+
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 8)
+      for key in range(0, 2000):
+         df.set(key * 2, "value %d" % key)
+      df.close()
+
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 8)
+      for key in range(0, 2000):
+         self.assertEqual(df.get(key * 2), "value %d" % key)
+      self.assertTrue(len(df.filters) > 8)
+
+      df.d = CountingFile(df.d)
+      for key in range(0, 2000):
+         self.assertEqual(df.get(key * 2 + 1), None)
+         self.assertFalse(df.delete(key * 2 + 1))
+      self.assertTrue(df.d.reads < 2000 * 0.1)
+
+   def test_set_many_and_get_many(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, group_commit=1000000)
+      df.set_many((key, "value %d" % key) for key in range(0, 3000))
+      df.set_many({5: "five", 6: "six"})
+      df.set_many([(7, "first"), (7, "last")])
+
+      # set_many() commits, so the batch survives a crash.
+      df = datafile.DataFile(self.filename, page_size=256)
+      keys = [7, 6, 5, 3001] + range(8, 3000)
+      values = df.get_many(keys, default="missing")
+      self.assertEqual(values[:4], ["last", "six", "five", "missing"])
+      self.assertEqual(values[4:], ["value %d" % key for key in range(8, 3000)])
+
+   def test_compression(self):
+      from key_store import datafile
+
+      values = dict((key, '{"id": %d, "name": "user %d", "tags": ["a", "b"]}' % (key, key) * 20)
+                    for key in range(0, 200))
+      sizes = {}
+      for compression in (None, "lz4", "zlib"):
+         if os.path.exists(self.filename):
+            os.unlink(self.filename)
+         df = datafile.DataFile(self.filename, page_size=1024, compression=compression)
+         for key, value in values.iteritems():
+            df.set(key, value)
+         df.set(1000, "short")
+         sizes[compression] = df.page_count
+         df.close()
+
+         # Values read back whatever codec the file is opened with.
+         df = datafile.DataFile(self.filename, page_size=1024)
+         for key, value in values.iteritems():
+            self.assertEqual(df.get(key), value)
+         self.assertEqual(df.get(1000), "short")
+         df.close()
+
+      self.assertTrue(sizes["lz4"] < sizes[None] / 4)
+      self.assertTrue(sizes["zlib"] < sizes[None] / 4)
+
+   def test_incompressible_values_are_stored_raw(self):
+      from key_store import datafile
+      import random
+
+      rng = random.Random(0)
+      value = "".join(chr(rng.randrange(256)) for _ in range(0, 2000))
+      df = datafile.DataFile(self.filename, page_size=1024, compression="lz4")
+      df.set(1, value)
+      self.assertEqual(df.get(1), value)
+
+      pointer = df._key_page(df.a[df._index(1)]).get(1)
+      record = df._data_page(pointer >> datafile.SLOT_BITS).get(
+         pointer & ((1 << datafile.SLOT_BITS) - 1))
+      self.assertEqual(ord(record[0]) >> datafile.CODEC_SHIFT, datafile.CODEC_NONE)
+
+   def test_snapshot_isolation(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256)
+      df.set_many((key, "old %d" % key) for key in range(0, 500))
+      snapshot = df.snapshot()
+      df.set_many((key, "new %d" % key) for key in range(0, 1000))
+      df.delete(7)
+      df.set(8, "x" * 1000)
+      df.commit()
+
+      for key in range(0, 1000):
+         self.assertEqual(snapshot.get(key), "old %d" % key if key < 500 else None)
+      with df.snapshot() as current:
+         self.assertEqual(current.get(7), None)
+         self.assertEqual(current.get(8), "x" * 1000)
+         self.assertEqual(current.get(999), "new 999")
+
+      snapshot.close()
+      self.assertEqual(df.versions, {})
+
+   def test_snapshots_while_writing(self):
+      import threading
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 16)
+      keys = range(0, 200)
+      errors = []
+
+      def write():
+         for n in range(0, 10):
+            value = ("round %d " % n) * (1 + n % 7 * 10)
+            df.set_many((key, value) for key in keys)
+
+      def read():
+         try:
+            while writer.is_alive():
+               with df.snapshot() as snapshot:
+                  values = set(snapshot.get(key) for key in keys)
+               if len(values) != 1:
+                  errors.append(values)
+         except Exception as e:
+            errors.append(e)
+
+      writer = threading.Thread(target=write)
+      readers = [threading.Thread(target=read) for _ in range(0, 3)]
+      writer.start()
+      for r in readers:
+         r.start()
+      writer.join()
+      for r in readers:
+         r.join()
+      self.assertEqual(errors, [])
+
+   def test_range(self):
+      import random
+      from key_store import datafile
+
+      keys = random.Random(0).sample(xrange(0, 1000000), 3000)
+      df = datafile.DataFile(self.filename, page_size=256, ordered_index=True)
+      for key in keys:
+         df.set(key, str(key))
+      for key in keys[:1000]:
+         df.delete(key)
+      df.set(keys[1000], "updated")
+
+      expected = sorted(keys[1000:])
+      self.assertEqual([k for k, _ in df.range()], expected)
+      self.assertEqual([k for k, _ in df.range(200000, 400000)],
+                       [k for k in expected if 200000 <= k < 400000])
+      self.assertEqual(list(df.range(keys[1000], keys[1000] + 1)), [(keys[1000], "updated")])
+      self.assertEqual(list(df.range(2000000)), [])
+
+      # Reopen without closing, so the index is rebuilt from the log.
+      df.commit()
+      df = datafile.DataFile(self.filename, page_size=256)
+      self.assertEqual([k for k, _ in df.range()], expected)
+      with df.snapshot() as snapshot:
+         df.set_many((key, "new") for key in range(0, 100))
+         self.assertEqual([k for k, _ in snapshot.range(None, 100)],
+                          [k for k in expected if k < 100])
+
+   def test_index_is_built_for_existing_file(self):
+      from key_store import datafile
+
+      df = datafile.DataFile(self.filename, page_size=256)
+      self.assertRaises(ValueError, list, df.range())
+      for key in range(0, 500):
+         df.set(key * 3, str(key))
+      df.close()
+
+      df = datafile.DataFile(self.filename, page_size=256, ordered_index=True)
+      self.assertEqual(list(df.range(30, 40)), [(30, "10"), (33, "11"), (36, "12"), (39, "13")])
+
+def _shared_reader(filename, conn):
+   """
+   Runs in a child process: tries to open the file as a second writer, then
+   reads the keys it is sent.
+   """
+   from key_store import datafile
+   from key_store.lock import LockError
+   from key_store.reader import Reader
+   try:
+      datafile.DataFile(filename, page_size=256, shared=True)
+      conn.send("opened")
+   except LockError:
+      conn.send("locked")
+
+   with Reader(filename, page_size=256) as r:
+      keys = conn.recv()
+      while keys is not None:
+         conn.send([r.get(key) for key in keys])
+         keys = conn.recv()
+
+class TestSharedDataFile(unittest.TestCase):
+   filename = "test.db"
+
+   def setUp(self):
+      for filename in (self.filename, self.filename + ".wal", self.filename + ".lock"):
+         if os.path.exists(filename):
+            os.unlink(filename)
+
+   def test_reader_process(self):
+      from key_store import datafile
+      import multiprocessing
+
+      df = datafile.DataFile(self.filename, page_size=256, cache_size=256 * 8, shared=True)
+      for key in range(0, 500):
+         df.set(key, "first %d" % key)
+      df.checkpoint()
+
+      conn, child_conn = multiprocessing.Pipe()
+      child = multiprocessing.Process(target=_shared_reader, args=(self.filename, child_conn))
+      child.start()
+
+      def recv():
+         # A reader that died would otherwise hang the test.
+         self.assertTrue(conn.poll(30))
+         return conn.recv()
+
+      try:
+         self.assertEqual(recv(), "locked")
+         keys = range(0, 1000)
+         conn.send(keys)
+         self.assertEqual(recv(), ["first %d" % key for key in range(0, 500)] + [None] * 500)
+
+         # Committed changes are only seen after the next checkpoint, even
+         # when the writer's cache overflows in between.
+         for key in range(0, 1000):
+            df.set(key, "second %d" % key)
+         df.commit()
+         conn.send(keys)
+         values = recv()
+         self.assertTrue(all(v in ("first %d" % key, "second %d" % key, None)
+                             for key, v in zip(keys, values)))
+         df.checkpoint()
+         conn.send(keys)
+         self.assertEqual(recv(), ["second %d" % key for key in keys])
+
+         df.set(0, "third")
+         df.commit()
+         conn.send([0])
+         self.assertEqual(recv(), ["second 0"])
+         df.checkpoint()
+         conn.send([0])
+         self.assertEqual(recv(), ["third"])
+
+         # The file shrinks under the reader.
+         for key in range(0, 1000, 2):
+            df.delete(key)
+         while df.compact():
+            pass
+         conn.send(keys)
+         self.assertEqual(recv(), [None if key % 2 == 0 else "second %d" % key
+                                   for key in keys])
+      finally:
+         conn.send(None)
+         child.join(30)
+      df.close()
+
+class TestPartitionedStore(unittest.TestCase):
+   basename = "test_partitioned"
+
+   def tearDown(self):
+      import glob
+      for filename in glob.glob(self.basename + ".*"):
+         os.unlink(filename)
+
+   def test_can_set_and_get(self):
+      from key_store.partition import PartitionedStore
+
+      store = PartitionedStore(self.basename, partitions=4, page_size=256,
+                               file_size_limit=256 * 64)
+      for key in range(0, 1000):
+         store.set(key, "value %d" % key)
+      store.set_many((key, "batch %d" % key) for key in range(500, 1500))
+      for key in range(0, 1500, 3):
+         store.delete(key)
+      self.assertTrue(any(len(p.segments) > 1 for p in store.partitions))
+
+      def check(store):
+         expected = [None if key % 3 == 0 or key >= 1500 else
+                     ("value %d" if key < 500 else "batch %d") % key for key in range(0, 1600)]
+         self.assertEqual(store.get_many(range(0, 1600)), expected)
+         for key in range(0, 1600, 7):
+            self.assertEqual(store.get(key), expected[key])
+
+      check(store)
+      store.commit()
+      # Reopen without closing, so every segment replays its log.
+      store = PartitionedStore(self.basename, partitions=4, page_size=256,
+                               file_size_limit=256 * 64)
+      check(store)
+      store.close()
+
+   def test_crash_keeps_old_or_new_value(self):
+      import signal
+      from key_store.partition import PartitionedStore
+
+      options = dict(partitions=1, page_size=256, file_size_limit=256 * 16, group_commit=10)
+      store = PartitionedStore(self.basename, **options)
+      for key in range(0, 300):
+         store.set(key, "old %d" % key)
+      self.assertTrue(len(store.partitions[0].segments) > 1)
+      store.close()
+
+      for kill_at in range(1, 300, 23):
+         pid = os.fork()
+         if pid == 0:
+            store = PartitionedStore(self.basename, **options)
+            for key in range(0, 300):
+               if key == kill_at:
+                  os.kill(os.getpid(), signal.SIGKILL)
+               store.set(key, "new %d" % key)
+            os._exit(0)
+         os.waitpid(pid, 0)
+
+         store = PartitionedStore(self.basename, **options)
+         for key in range(0, 300):
+            self.assertTrue(store.get(key) in ("old %d" % key, "new %d" % key))
+         store.close()
+
+   def test_partition_count_is_fixed(self):
+      from key_store.partition import PartitionedStore
+
+      PartitionedStore(self.basename, partitions=2).close()
+      self.assertRaises(ValueError, PartitionedStore, self.basename, partitions=3)
+
+class TestLSMStore(unittest.TestCase):
+   filename = "test.lsm"
+   options = dict(memtable_size=2048, table_size=1024, block_size=256, level0_limit=2,
+                  level_ratio=2)
+
+   def tearDown(self):
+      import glob
+      for filename in glob.glob(self.filename + "*"):
+         os.unlink(filename)
+
+   def test_can_set_and_get(self):
+      from key_store.lsm import LSMStore
+
+      store = LSMStore(self.filename, **self.options)
+      for key in range(0, 1000):
+         store.set(key, "value %d" % key)
+      store.set_many((key, "batch %d" % key) for key in range(500, 1500))
+      for key in range(0, 1500, 3):
+         self.assertTrue(store.delete(key))
+      self.assertFalse(store.delete(3))
+      store.compact()
+      self.assertTrue(len(store.version.levels) > 2)
+
+      expected = [None if key % 3 == 0 or key >= 1500 else
+                  ("value %d" if key < 500 else "batch %d") % key for key in range(0, 1600)]
+      self.assertEqual(store.get_many(range(0, 1600)), expected)
+      self.assertEqual(list(store.range(10, 20)),
+                       [(key, expected[key]) for key in range(10, 20) if key % 3])
+      store.close()
+
+      store = LSMStore(self.filename, **self.options)
+      self.assertEqual(store.get_many(range(0, 1600)), expected)
+      store.close()
+
+   def test_recovers_from_log(self):
+      from key_store.lsm import LSMStore
+
+      store = LSMStore(self.filename, group_commit=1000, **self.options)
+      store.set_many((key, "old %d" % key) for key in range(0, 300))
+      store.compact()
+      store.set(1, "new")
+      store.delete(2)
+      store.commit()
+      store.set(3, "uncommitted")
+
+      # Reopen without closing, so the memtable is rebuilt from the log.
+      store = LSMStore(self.filename, **self.options)
+      self.assertEqual(store.get(1), "new")
+      self.assertEqual(store.get(2), None)
+      self.assertEqual(store.get(3), "old 3")
+      self.assertEqual(store.get(299), "old 299")
+      store.close()
+
+   def test_tombstones_are_dropped(self):
+      from key_store.lsm import LSMStore
+
+      store = LSMStore(self.filename, **self.options)
+      store.set_many((key, "x" * 20) for key in range(0, 500))
+      for key in range(0, 500):
+         store.delete(key)
+      store.checkpoint()
+      store.compact()
+      self.assertEqual(list(store.range()), [])
+      # Merging into the last level dropped tombstones with their values.
+      self.assertTrue(sum(t.entry_count for t in store.version.tables()) < 1000)
+      store.close()
+
+   def test_open_store(self):
+      import key_store
+      from key_store.lsm import LSMStore
+
+      store = key_store.open_store(self.filename, engine="lsm")
+      self.assertTrue(isinstance(store, LSMStore))
+      store.set(1, "one")
+      store.close()
+      self.assertRaises(ValueError, key_store.open_store, self.filename, engine="btree")
+
+class TestBenchmark(unittest.TestCase):
+   def test_can_run(self):
+      from key_store import benchmark
+      results = list(benchmark.run(cardinality=300, queries=200, ratio=(40, 20, 20, 20)))
+      self.assertEqual(len(results), len(benchmark.STORES))
+      for r in results:
+         self.assertEqual(r["cardinality"], 300)
+         self.assertEqual(r["queries"], 200)
+         self.assertTrue(r["bytes_on_disk"] > 0)
+         self.assertTrue("p99" in r["update_latency_us"])
+      # Every store ran the same workload.
+      self.assertEqual(len(set(r["searches_found"] for r in results)), 1)
+
+   def test_runs_do_not_share_files(self):
+      import shutil
+      import tempfile
+      from key_store import benchmark
+      directory = tempfile.mkdtemp()
+      try:
+         first, second = [[r["bytes_on_disk"] for r in
+                           benchmark.run(cardinality=300, queries=200, stores=["datafile"],
+                                         directory=directory)] for _ in range(0, 2)]
+         self.assertEqual(first, second)
+      finally:
+         shutil.rmtree(directory)
+
+   def test_harness_files(self):
+      from key_store import benchmark
+      load = os.path.join(os.path.dirname(__file__), "..", "..", "res", "fdtree", "load")
+      self.assertEqual(list(benchmark.read_entries(os.path.join(load, "in.dat"))),
+                       [(1, 35432), (3, 236564), (7, 256523), (13, 1344), (14, 938243)])
+      queries = benchmark.read_queries(os.path.join(load, "query.dat"))
+      self.assertEqual(queries, [("s", 1), ("s", 14), ("i", 4, 32543), ("s", 3), ("d", 7),
+                                 ("u", 3, 34653)])
+      self.assertEqual(benchmark.parse_size("16M"), 16 << 20)
+
+class TestDataPage(unittest.TestCase):
+   def test_insert_and_get(self):
+      from key_store import datafile
+      dp = datafile.DataPage(None, 256)
+      slots = [dp.insert("value %d" % i) for i in range(0, 5)]
+      self.assertEqual(slots, range(0, 5))
+      for i in range(0, 5):
+         self.assertEqual(dp.get(i), "value %d" % i)
+
+   def test_insert_fails_when_full(self):
+      from key_store import datafile
+      dp = datafile.DataPage(None, 256)
+      self.assertEqual(dp.insert("x" * 300), None)
+      while dp.insert("y" * 20) is not None:
+         pass
+      self.assertTrue(dp.free_space() < 20)
+
+   def test_remove_and_compact(self):
+      from key_store import datafile
+      dp = datafile.DataPage(None, 256)
+      slots = [dp.insert(chr(65 + i) * 40) for i in range(0, 5)]
+      self.assertEqual(dp.insert("z" * 40), None)
+      dp.remove(slots[1])
+      dp.remove(slots[3])
+      # Neither hole is large enough on its own.
+      self.assertEqual(dp.insert("z" * 60), 1)
+      self.assertEqual(dp.get(1), "z" * 60)
+      for i in (0, 2, 4):
+         self.assertEqual(dp.get(i), chr(65 + i) * 40)
+
+   def test_image_roundtrip(self):
+      from cStringIO import StringIO
+      from key_store import datafile
+      dp = datafile.DataPage(None, 256)
+      dp.insert("one")
+      dp.insert("two")
+      dp.remove(0)
+      dp.lsn = 7
+
+      copy = datafile.DataPage(StringIO(dp.image()), 256)
+      self.assertEqual(copy.lsn, 7)
+      self.assertEqual(copy.get(1), "two")
+      self.assertEqual(copy.insert("three"), 0)
+
+class TestWriteAheadLog(unittest.TestCase):
+   filename = "test.wal"
+
+   def setUp(self):
+      if os.path.exists(self.filename):
+         os.unlink(self.filename)
+
+   def test_records_roundtrip(self):
+      from key_store import wal
+      with open(self.filename, "w+b") as f:
+         log = wal.WriteAheadLog(f)
+         self.assertEqual(log.append(1, "one"), 1)
+         self.assertEqual(log.append(2, "two"), 2)
+         self.assertEqual(log.commit(), 3)
+         self.assertEqual(log.commit(), None)
+
+      with open(self.filename, "r+b") as f:
+         log = wal.WriteAheadLog(f)
+         records = [(r.lsn, r.record_type, r.payload) for r in log.records()]
+         self.assertEqual(records, [(1, 1, "one"), (2, 2, "two")])
+         self.assertEqual(log.next_lsn, 4)
+
+   def test_uncommitted_records_are_not_replayed(self):
+      from key_store import wal
+      with open(self.filename, "w+b") as f:
+         log = wal.WriteAheadLog(f)
+         log.append(1, "one")
+         log.commit()
+         log.append(1, "lost")
+         # Write the record without its commit.
+         f.write("".join(log.buffer))
+
+         log = wal.WriteAheadLog(f)
+         self.assertEqual([r.payload for r in log.records()], ["one"])
+
+   def test_discard(self):
+      from key_store import wal
+      with open(self.filename, "w+b") as f:
+         log = wal.WriteAheadLog(f)
+         for i in range(0, 4):
+            log.append(1, "record %d" % i)
+            log.commit()
+         log.discard(5)
+         self.assertEqual([(r.lsn, r.payload) for r in log.records()],
+                          [(5, "record 2"), (7, "record 3")])
+         log.append(1, "after")
+         log.commit()
+         self.assertEqual([r.payload for r in log.records()],
+                          ["record 2", "record 3", "after"])
+         log.f.close()
+
 class TestKeyPage(unittest.TestCase):
    filename = "test.key_page"
 
@@ -106,6 +913,47 @@ class TestKeyPage(unittest.TestCase):
          kp.rollback()
          self.assertEqual(kp.get(100), 500)
 
+   def test_lookup_without_decoding(self):
+      from key_store import datafile
+      with open(self.filename, "w+b") as f:
+         kp = datafile.KeyPage(f, 8192)
+         for k in range(0, 400):
+            kp.set(k * 7, k)
+         f.seek(0)
+         kp.flush(f)
+
+      with open(self.filename, "r+b") as f:
+         kp = datafile.KeyPage(f, 8192)
+         for k in range(0, 400):
+            self.assertEqual(kp.get(k * 7), k)
+            self.assertEqual(kp.get(k * 7 + 1), None)
+         self.assertEqual(kp.keys, None)
+         self.assertEqual(len(kp), 400)
+
+         kp.set(3, 3)
+         self.assertEqual(kp.get(3), 3)
+         self.assertEqual(kp.get(14), 2)
+
+   def test_bloom_filter(self):
+      from key_store import datafile
+      with open(self.filename, "w+b") as f:
+         kp = datafile.KeyPage(f, 8192)
+         for k in range(0, 400):
+            kp.set(k * 7, k)
+         kp.delete(0)
+         f.seek(0)
+         kp.flush(f)
+
+      with open(self.filename, "r+b") as f:
+         kp = datafile.KeyPage(f, 8192)
+         for k in range(1, 400):
+            self.assertTrue(kp.may_contain(k * 7))
+         # The filter was rebuilt when the page was written.
+         self.assertFalse(kp.may_contain(0))
+         misses = [k for k in range(0, 10000) if k % 7 and kp.may_contain(k)]
+         self.assertTrue(len(misses) < 10000 * 0.05)
+         self.assertEqual(kp.keys, None)
+
 class TestFreePage(unittest.TestCase):
    filename = "test.free_page"
 
@@ -149,6 +997,102 @@ class TestFreePage(unittest.TestCase):
          start = fp.acquire(50)
          self.assertEqual(start, 100)
 
+   def test_best_fit(self):
+      from key_store import datafile
+      fp = datafile.FreePage(None, 8192)
+      fp.release(datafile.Extent(10, 109))
+      fp.release(datafile.Extent(200, 219))
+      fp.release(datafile.Extent(300, 329))
+      self.assertEqual(fp.acquire(25), 300)
+      self.assertEqual(fp.acquire(20), 200)
+      self.assertEqual(fp.acquire(101), None)
+      self.assertEqual(fp.acquire(100), 10)
+
+   def test_release_coalesces(self):
+      from key_store import datafile
+      fp = datafile.FreePage(None, 8192)
+      fp.release(datafile.Extent(10, 19))
+      fp.release(datafile.Extent(30, 39))
+      fp.release(datafile.Extent(20, 29))
+      self.assertEqual(len(fp), 1)
+      self.assertEqual(fp.acquire(30), 10)
+
+   def test_take(self):
+      from key_store import datafile
+      fp = datafile.FreePage(None, 8192)
+      fp.release(datafile.Extent(10, 19))
+      fp.release(datafile.Extent(30, 39))
+      fp.take(15, 20)
+      self.assertEqual([(e.start, e.end) for e in fp.extents()], [(10, 14), (35, 39)])
+
+   def test_matches_a_page_map(self):
+      import random
+      from key_store import datafile
+
+      rng = random.Random(2)
+      fp = datafile.FreePage(None, 8192)
+      free = set()
+      for _ in range(0, 2000):
+         if rng.random() < 0.5:
+            start = rng.randint(0, 400)
+            pages = set(range(start, start + rng.randint(1, 8)))
+            if pages & free:
+               continue
+            fp.release(datafile.Extent(min(pages), max(pages)))
+            free |= pages
+         elif rng.random() < 0.5:
+            count = rng.randint(1, 6)
+            start = fp.acquire(count)
+            if start is not None:
+               pages = set(range(start, start + count))
+               self.assertTrue(pages <= free)
+               free -= pages
+         else:
+            start = rng.randint(0, 400)
+            count = rng.randint(1, 10)
+            fp.take(start, count)
+            free -= set(range(start, start + count))
+         self.assertEqual(fp.pages(), len(free))
+      extents = [(e.start, e.end) for e in fp.extents()]
+      self.assertEqual(set(p for s, e in extents for p in range(s, e + 1)), free)
+      # Adjacent extents were always merged.
+      self.assertTrue(all(a[1] + 1 < b[0] for a, b in zip(extents, extents[1:])))
+
+   def test_acquire_below(self):
+      from key_store import datafile
+      fp = datafile.FreePage(None, 8192)
+      fp.release(datafile.Extent(10, 10))
+      fp.release(datafile.Extent(30, 39))
+      self.assertEqual(fp.pages(), 11)
+      self.assertEqual(fp.acquire(2, below=20), None)
+      self.assertEqual(fp.acquire(1, below=20), 10)
+      self.assertEqual(fp.acquire(1, below=20), None)
+
+   def test_trim(self):
+      from key_store import datafile
+      fp = datafile.FreePage(None, 8192)
+      fp.release(datafile.Extent(10, 19))
+      fp.release(datafile.Extent(30, 39))
+      self.assertEqual(fp.tail(50), 50)
+      self.assertEqual(fp.trim(50), 50)
+      self.assertEqual(fp.tail(40), 30)
+      self.assertEqual(fp.trim(40), 30)
+      self.assertEqual([(e.start, e.end) for e in fp.extents()], [(10, 19)])
+
+   def test_free_list_spills(self):
+      from key_store import datafile
+      with open(self.filename, "w+b") as f:
+         fp = datafile.FreePage(f, 256)
+         for page in range(0, 1000):
+            fp.release(datafile.Extent(page * 2, page * 2))
+         self.assertTrue(fp.size() > 256)
+         fp.flush(f)
+
+      with open(self.filename, "r+b") as f:
+         fp = datafile.FreePage(f, 256)
+         self.assertEqual(len(fp), 1000)
+         self.assertEqual(fp.acquire(1), 0)
+
 
 
 
@@ -0,0 +1,171 @@
+"""
+The write-ahead log.
+
+The log is a sequence of records. Each record has a log sequence number (LSN),
+a type and a payload, and is protected by a crc32:
+
++-------+-------+-------+----------------+-----------------+
+| crc32 | lsn   | type  | payload length | payload ...     |
+| <I    | <Q    | <B    | <I             |                 |
++-------+-------+-------+----------------+-----------------+
+
+Records are buffered in memory and only written, together with a COMMIT record,
+when the log is committed. A commit costs one write and one fsync no matter
+how many records it covers, which is what makes group commit cheap.
+
+A checkpoint that has written every page changed up to some LSN can discard
+the records before it. The records that are kept are copied to a new file,
+which is renamed over the log, so a crash leaves either the old log or the new
+one.
+
+When the log is replayed, records are only returned once the COMMIT that
+follows them has been read. A torn or corrupt record ends the log: it and
+everything after it were never committed.
+
+The meaning of the record types and their payloads belongs to the user of the
+log. Type 0 is reserved for COMMIT.
+"""
+
+import os
+import struct
+import zlib
+
+from column_store.durability import sync_directory
+
+# crc32 + lsn + record type + payload length
+record_header_fmt = "<IQBI"
+record_header_size = struct.calcsize(record_header_fmt)
+# everything after the crc
+record_body_fmt = "<QBI"
+
+COMMIT = 0
+
+
+class LogRecord(object):
+   __slots__ = ["lsn", "record_type", "payload"]
+   def __init__(self, lsn, record_type, payload):
+      self.lsn = lsn
+      self.record_type = record_type
+      self.payload = payload
+
+
+class WriteAheadLog(object):
+   """
+   :synopsis: Appends records to a log file and replays them.
+   """
+   __slots__ = ["f", "buffer", "next_lsn", "durable_lsn", "pending"]
+   def __init__(self, f, next_lsn=1):
+      """
+      :param f: The log file object, opened for reading and writing.
+      :param next_lsn: The LSN to give the next record. LSNs must keep growing
+                       across truncations, so the owner of the log persists
+                       this.
+      """
+      self.f = f
+      self.buffer = []
+      self.next_lsn = next_lsn
+      self.durable_lsn = next_lsn - 1
+      self.pending = 0
+
+   def append(self, record_type, payload=""):
+      """
+      :synopsis: Adds a record to the log buffer.
+      :returns: The LSN of the record.
+      """
+      lsn = self.next_lsn
+      self.next_lsn += 1
+      body = struct.pack(record_body_fmt, lsn, record_type, len(payload)) + payload
+      self.buffer.append(struct.pack("<I", zlib.crc32(body) & 0xffffffff))
+      self.buffer.append(body)
+      if record_type != COMMIT:
+         self.pending += 1
+      return lsn
+
+   def commit(self):
+      """
+      :synopsis: Writes every buffered record followed by a COMMIT record, and
+                 makes them durable with a single fsync.
+      :returns: The LSN of the COMMIT record, or None if there was nothing to
+                commit.
+      """
+      if not self.pending:
+         return None
+
+      lsn = self.append(COMMIT)
+      self.f.seek(0, 2)
+      self.f.write("".join(self.buffer))
+      self.f.flush()
+      os.fsync(self.f.fileno())
+      self.buffer = []
+      self.pending = 0
+      self.durable_lsn = lsn
+      return lsn
+
+   def records(self):
+      """
+      :synopsis: Reads the committed records in the log file.
+      :returns: A generator of LogRecords, in LSN order. COMMIT records are not
+                returned.
+      """
+      self.f.seek(0)
+      uncommitted = []
+      while True:
+         header = self.f.read(record_header_size)
+         if len(header) < record_header_size:
+            break
+         crc, lsn, record_type, length = struct.unpack(record_header_fmt, header)
+         payload = self.f.read(length)
+         if len(payload) < length:
+            break
+         if zlib.crc32(header[4:] + payload) & 0xffffffff != crc:
+            break
+
+         self.next_lsn = max(self.next_lsn, lsn + 1)
+         if record_type == COMMIT:
+            self.durable_lsn = lsn
+            for r in uncommitted:
+               yield r
+            uncommitted = []
+         else:
+            uncommitted.append(LogRecord(lsn, record_type, payload))
+
+   def truncate(self):
+      """
+      :synopsis: Discards the contents of the log file. Everything in it must
+                 already be reflected in the data file.
+      """
+      self.f.seek(0)
+      self.f.truncate()
+      self.f.flush()
+      os.fsync(self.f.fileno())
+
+   def discard(self, lsn):
+      """
+      :synopsis: Discards the records older than 'lsn'. Every buffered record
+                 must have been committed.
+      """
+      self.f.seek(0)
+      offset = 0
+      while True:
+         header = self.f.read(record_header_size)
+         if len(header) < record_header_size:
+            break
+         record_lsn, length = struct.unpack(record_header_fmt, header)[1::2]
+         if record_lsn >= lsn:
+            break
+         offset += record_header_size + length
+         self.f.seek(offset)
+      if not offset:
+         return
+
+      self.f.seek(offset)
+      kept = self.f.read()
+      name = self.f.name
+      with open(name + ".tmp", "wb") as f:
+         f.write(kept)
+         f.flush()
+         os.fsync(f.fileno())
+      os.rename(name + ".tmp", name)
+      sync_directory(name)
+      self.f.close()
+      self.f = open(name, "r+b")
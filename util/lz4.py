@@ -7,7 +7,7 @@ implementations at http://code.google.com/p/lz4/
 
 class LZ4Exception(Exception):
    def __init__(self, msg):
-      Exception.__init__(msg)
+      Exception.__init__(self, msg)
 
 
 # Constants
@@ -50,8 +50,8 @@ def common_bytes(b, o1, o2, limit):
    return count
 
 def common_bytes_backward(b, o1, o2, l1, l2):
-   count = 0; o1 -= 1; o2 -= 1
-   while (o1 > l1 and o2 > l2 and b[o1] == b[o2]):
+   count = 0
+   while (o1 > l1 and o2 > l2 and b[o1 - 1] == b[o2 - 1]):
       count += 1
       o1 -= 1
       o2 -= 1
@@ -73,7 +73,7 @@ def last_literals(src, s_offset, src_length, dst, d_offset, dst_end):
       d_offset += 1
 
    # copy literals
-   src[s_offset:s_offset + run_length] = dst[d_offset:d_offset + run_length]
+   dst[d_offset:d_offset + run_length] = src[s_offset:s_offset + run_length]
    d_offset += run_length
    return d_offset
 
@@ -87,6 +87,18 @@ def write_len(length, dst, d_offset):
    d_offset += 1
    return d_offset
 
+def read_len(length, src, s_offset):
+   """
+   Reads the extra length bytes that follow a token field that is saturated.
+   :returns: The full length and the offset after it.
+   """
+   while True:
+      b = src[s_offset]
+      s_offset += 1
+      length += b
+      if b != 0xFF:
+         return length, s_offset
+
 class Compressor(object):
    """
    **************************************
@@ -105,12 +117,15 @@ class Compressor(object):
         This could improve compression a bit, but will be slower on incompressible data
         The default value (6) is recommended
         2 is the minimum value.
+
+   The output is an LZ4 block: a sequence of tokens, each holding a run of
+   literals and a match, ending with a run of literals.
    """
 
 
    def __init__(self, compression_level=14, not_compressible_confirmation=6):
-      self.compression_level = min(4, compression_level)
-      self.skip_strength = min(not_compressible_confirmation, 2)
+      self.compression_level = min(max(compression_level, 8), 20)
+      self.skip_strength = max(not_compressible_confirmation, 2)
 
    def max_compressed_length(self, uncompressed_length):
       """
@@ -126,59 +141,39 @@ class Compressor(object):
 
    def _compress(self, src, src_offset, src_len, dst, dst_offset, max_dest_len):
       dst_end = dst_offset + max_dest_len
-
-      # If less than 64k go into small mode compressor.
-      # TODO
-
       src_end = src_offset + src_len
+      # The last match must start at least MF_LIMIT bytes before the end, and
+      # end at least LAST_LITERALS bytes before it.
       mf_limit = src_end - MF_LIMIT
       src_limit = src_end - LAST_LITERALS
       s_offset = src_offset
       d_offset = dst_offset
       anchor = src_offset
-      src_offset += 1
-
-      hash_size = 1 << self.compression_level
-      hash_table = [anchor for _ in range(0, hash_size)]
 
-      while True:
-         forward_offset = s_offset
-         find_match_attempts = (1 << self.skip_strength) + 3
-
-         while True:
-            s_offset = forward_offset
-            forward_offset += find_match_attempts >> self.skip_strength
-            find_match_attempts += 1
-
-            if forward_offset > mf_limit:
-               break
-
-            h = self._get_hash(src, s_offset)
-            ref = hash_table[h]
-            back = s_offset - ref
-            hash_table[h] = s_offset
+      hash_table = [-1] * (1 << self.compression_level)
 
-            if back < MAX_DISTANCE or read_int_eq(ref, s_offset, src):
-               break
-
-         # Repeat this test to break out of the outer loop as well.
-         if forward_offset > mf_limit:
-            break
+      while s_offset < mf_limit:
+         h = self._get_hash(src, s_offset)
+         ref = hash_table[h]
+         hash_table[h] = s_offset
+         if ref < 0 or s_offset - ref > MAX_DISTANCE or not read_int_eq(ref, s_offset, src):
+            # The longer we go without a match, the further we skip.
+            s_offset += 1 + ((s_offset - anchor) >> self.skip_strength)
+            continue
 
          excess = common_bytes_backward(src, ref, s_offset, src_offset, anchor)
          s_offset -= excess
          ref -= excess
 
-         # sequence == refsequence
          run_length = s_offset - anchor
+         match_length = common_bytes(src, ref + MIN_MATCH, s_offset + MIN_MATCH, src_limit)
+         if d_offset + run_length + (2 + 1 + LAST_LITERALS) + (run_length >> 8) + \
+               (match_length >> 8) > dst_end:
+            raise LZ4Exception("max_dest_len is too small")
 
          # encode literal length
          token_offset = d_offset
          d_offset += 1
-
-         if d_offset + run_length + (2 + 1 + LAST_LITERALS) + (run_length >> 8) > dst_end:
-            raise LZ4Exception("maximum_dest_len is too small")
-
          if run_length >= RUN_MASK:
             token = RUN_MASK << ML_BITS
             d_offset = write_len(run_length - RUN_MASK, dst, d_offset)
@@ -189,57 +184,24 @@ class Compressor(object):
          dst[d_offset:d_offset + run_length] = src[anchor:anchor + run_length]
          d_offset += run_length
 
-         while True:
-            # encode offset
-            dst[d_offset] = back; d_offset += 1
-            dst[d_offset] = (back >> 8); d_offset += 1
-
-            # count nb matches
-            s_offset += MIN_MATCH
-            match_length = common_bytes(src, ref + MIN_MATCH, s_offset, src_limit)
-            if d_offset + (1 + LAST_LITERALS) + (match_length >> 8) > dst_end:
-               raise LZ4Exception("max_dest_len is too small")
-
-            s_offset += match_length;
-
-            # encode match len
-            if match_length >= ML_MASK:
-               token |= ML_MASK
-               d_offset = write_len(match_length - ML_MASK, dst, d_offset);
-            else:
-               token |= match_length
-            dst[token_offset] = token
-
-            # test end of chunk
-            if s_offset > mf_limit:
-               anchor = s_offset
-               break
-
-            # fill table
-            hash_table[self._get_hash(src, s_offset - 2)] = s_offset - 2;
-
-            # test next position
-            h = self._get_hash(src, s_offset)
-            ref = hash_table[h]
-            hash_table[h] = s_offset
-            back = s_offset - ref
-
-            if back >= MAX_DISTANCE or not read_int_eq(ref, s_offset, src):
-               break
-
-            token_offset = d_offset
-            d_offset += 1
-            token = 0
-
-         # repeat end of chunk test to break out of outer loop
-         if s_offset > mf_limit:
-            break
+         # encode offset
+         back = s_offset - ref
+         dst[d_offset] = back & 0xFF; d_offset += 1
+         dst[d_offset] = back >> 8; d_offset += 1
+
+         # encode match length
+         if match_length >= ML_MASK:
+            token |= ML_MASK
+            d_offset = write_len(match_length - ML_MASK, dst, d_offset)
+         else:
+            token |= match_length
+         dst[token_offset] = token
 
-         # prepare next loop
+         s_offset += MIN_MATCH + match_length
          anchor = s_offset
-         s_offset += 1
+         if s_offset < mf_limit:
+            hash_table[self._get_hash(src, s_offset - 2)] = s_offset - 2
 
-      # end of while loop
       d_offset = last_literals(src, anchor, src_end - anchor, dst, d_offset, dst_end)
       return d_offset - dst_offset
 
@@ -256,77 +218,71 @@ class Decompressor(object):
       pass
 
    def decompress(self, data, uncompressed_size):
+      """
+      :returns: A bytearray of 'uncompressed_size' bytes.
+      """
       out = bytearray(uncompressed_size)
-      return self._decompress(data, 0, out, 0, uncompressed_size)
+      try:
+         self._decompress(bytearray(data), 0, out, 0, uncompressed_size)
+      except IndexError:
+         raise LZ4Exception("Truncated input")
+      return out
 
    def _decompress(self, src, src_offset, dst, dst_offset, dst_len):
-      if dst_len == 0:
-         if src[src_offset] != 0:
-            raise LZ4Exception("Malformed input at %d" % src_offset)
-         return 1
-
+      """
+      :returns: The number of bytes of 'src' that were read.
+      """
       dest_end = dst_offset + dst_len
+      src_end = len(src)
 
       s_offset = src_offset
       d_offset = dst_offset
 
       while True:
-         token = src[s_offset] & 0xFF
+         if s_offset >= src_end:
+            raise LZ4Exception("Malformed input at %d" % s_offset)
+         token = src[s_offset]
          s_offset += 1
 
          # literals
          literal_len = token >> ML_BITS
          if literal_len == RUN_MASK:
-            length = src[s_offset]
-            while length == 0xFF:
-               s_offset += 1
-               literal_len += 0xFF
-               length = src[s_offset]
-
-            literal_len += length & 0xFF
-
-            literal_copy_end = d_offset + literal_len
-            if literal_copy_end > dest_end - COPY_LENGTH:
-               if literal_copy_end != dest_end:
-                  raise LZ4Exception("Malformed input at %d" % s_offset)
-               else:
-                  dst[d_offset:d_offset + literal_len] = src[s_offset:s_offset + literal_len]
-                  s_offset += literal_len
-                  break  # EOF
-
-      dst[d_offset:d_offset + literal_len] = src[s_offset:s_offset + literal_len]
-      s_offset += literal_len
-      d_offset = literal_copy_end
-
-      # matchs
-      match_dec = (src[s_offset] & 0xFF) | ((src[s_offset + 1] & 0xFF) << 8)
-      s_offset += 2
-      match_off = d_offset - match_dec;
-
-      if match_off < dst_offset:
-         raise LZ4Exception("Malformed input at %d" + s_offset)
-
-      match_len = token & ML_MASK
-      if match_len == ML_MASK:
-         length = src[s_offset]
-         s_offset += 1
-         while length == 0xFF:
-            match_len += 0xFF
+            literal_len, s_offset = read_len(literal_len, src, s_offset)
+         if d_offset + literal_len > dest_end or s_offset + literal_len > src_end:
+            raise LZ4Exception("Malformed input at %d" % s_offset)
+         dst[d_offset:d_offset + literal_len] = src[s_offset:s_offset + literal_len]
+         s_offset += literal_len
+         d_offset += literal_len
 
-         match_len += length & 0xFF
-      match_len += MIN_MATCH;
+         # The last sequence only has literals.
+         if s_offset == src_end:
+            break
+
+         # matches
+         match_dec = src[s_offset] | (src[s_offset + 1] << 8)
+         s_offset += 2
+         match_off = d_offset - match_dec
+         if match_dec == 0 or match_off < dst_offset:
+            raise LZ4Exception("Malformed input at %d" % s_offset)
 
-      match_copy_end = d_offset + match_len
+         match_len = token & ML_MASK
+         if match_len == ML_MASK:
+            match_len, s_offset = read_len(match_len, src, s_offset)
+         match_len += MIN_MATCH
 
-      if match_copy_end > dest_end - COPY_LENGTH:
+         match_copy_end = d_offset + match_len
          if match_copy_end > dest_end:
             raise LZ4Exception("Malformed input at %d" % s_offset)
-         dst[d_offset:d_offset + match_len] = dst[match_off:match_off + match_len]
-      else:
-         length = match_copy_end - match_off
-         dst[d_offset:d_offset + length] = dst[match_off:match_copy_end]
-      d_offset = match_copy_end
+         if match_dec >= match_len:
+            dst[d_offset:match_copy_end] = dst[match_off:match_off + match_len]
+         else:
+            # The match overlaps the bytes it produces, so it repeats them.
+            for i in range(0, match_len):
+               dst[d_offset + i] = dst[match_off + i]
+         d_offset = match_copy_end
 
+      if d_offset != dest_end:
+         raise LZ4Exception("Malformed input at %d" % s_offset)
       return s_offset - src_offset
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+"""
+A sorted set kept in a skip list.
+
+Every key is in the bottom list, and each list above holds about a quarter of
+the keys of the list below it, so adding, removing and finding the keys next
+to a value all take O(log n) expected time. The levels of the nodes come from
+a generator with a fixed seed, so a set built by the same operations always
+has the same shape.
+"""
+
+import random
+
+MAX_LEVEL = 32
+
+
+class _Node(object):
+   __slots__ = ["key", "forward"]
+   def __init__(self, key, level):
+      self.key = key
+      self.forward = [None] * level
+
+
+class SortedSet(object):
+   """
+   :synopsis: A set of mutually comparable keys that can be walked in order.
+   """
+   __slots__ = ["head", "level", "count", "rng"]
+   def __init__(self, keys=()):
+      self.head = _Node(None, MAX_LEVEL)
+      self.level = 1
+      self.count = 0
+      self.rng = random.Random(0)
+      for key in keys:
+         self.add(key)
+
+   def __len__(self):
+      return self.count
+
+   def __iter__(self):
+      node = self.head.forward[0]
+      while node is not None:
+         yield node.key
+         node = node.forward[0]
+
+   def __contains__(self, key):
+      node = self._before(key)[0].forward[0]
+      return node is not None and node.key == key
+
+   def _random_level(self):
+      level = 1
+      while level < MAX_LEVEL and self.rng.random() < 0.25:
+         level += 1
+      return level
+
+   def _before(self, key):
+      """
+      :returns: The last node before 'key' on every level, bottom first.
+      """
+      update = [self.head] * MAX_LEVEL
+      node = self.head
+      for i in range(self.level - 1, -1, -1):
+         while node.forward[i] is not None and node.forward[i].key < key:
+            node = node.forward[i]
+         update[i] = node
+      return update
+
+   def add(self, key):
+      """
+      :synopsis: Adds 'key'. Adding a key that is already there does nothing.
+      """
+      update = self._before(key)
+      node = update[0].forward[0]
+      if node is not None and node.key == key:
+         return
+      level = self._random_level()
+      self.level = max(self.level, level)
+      node = _Node(key, level)
+      for i in range(0, level):
+         node.forward[i] = update[i].forward[i]
+         update[i].forward[i] = node
+      self.count += 1
+
+   def remove(self, key):
+      """
+      :raises KeyError: If 'key' is not in the set.
+      """
+      update = self._before(key)
+      node = update[0].forward[0]
+      if node is None or node.key != key:
+         raise KeyError(key)
+      for i in range(0, len(node.forward)):
+         update[i].forward[i] = node.forward[i]
+      while self.level > 1 and self.head.forward[self.level - 1] is None:
+         self.level -= 1
+      self.count -= 1
+
+   def ceiling(self, key):
+      """
+      :returns: The smallest key that is not less than 'key', or None.
+      """
+      node = self._before(key)[0].forward[0]
+      return None if node is None else node.key
+
+   def floor(self, key):
+      """
+      :returns: The largest key that is not greater than 'key', or None.
+      """
+      node = self.head
+      for i in range(self.level - 1, -1, -1):
+         while node.forward[i] is not None and node.forward[i].key <= key:
+            node = node.forward[i]
+      return node.key
+
+   def last(self):
+      """
+      :returns: The largest key, or None if the set is empty.
+      """
+      node = self.head
+      for i in range(self.level - 1, -1, -1):
+         while node.forward[i] is not None:
+            node = node.forward[i]
+      return node.key
+
+   def iter_from(self, key):
+      """
+      :returns: A generator of the keys from 'key' on, in order.
+      """
+      node = self._before(key)[0].forward[0]
+      while node is not None:
+         yield node.key
+         node = node.forward[0]
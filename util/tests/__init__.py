@@ -31,6 +31,13 @@ class TestFreePage(unittest.TestCase):
       s = varint.encode(-900)
       self.assertEqual(varint.decode(s), -900)
 
+   def test_can_decode_from_offset(self):
+      from util import varint
+      s = "xx" + varint.encode(-900) + varint.encode(5)
+      v, offset = varint.decode_from(s, 2)
+      self.assertEqual(v, -900)
+      self.assertEqual(varint.decode_from(s, offset), (5, len(s)))
+
    def test_can_stream_encode(self):
       from util import varint
       from cStringIO import StringIO
@@ -62,6 +69,60 @@ class TestFreePage(unittest.TestCase):
       self.assertEqual(varint.decode_stream(st), -900)
 
 
+class TestLZ4(unittest.TestCase):
+   def test_can_roundtrip(self):
+      import random
+      from util.lz4 import Compressor, Decompressor
+      c = Compressor()
+      d = Decompressor()
+      rng = random.Random(0)
+      values = ["", "a", "abcdefghijklmnopqrstuvwxyz", "A" * 1000,
+                '{"id": 1, "tags": ["x", "y"]}' * 100]
+      values += ["".join(chr(rng.randrange(alphabet)) for _ in range(rng.randint(0, 3000)))
+                 for alphabet in (2, 16, 256)]
+      for value in values:
+         self.assertEqual(str(d.decompress(c.compress(value), len(value))), value)
+
+   def test_compresses_repetitive_data(self):
+      from util.lz4 import Compressor
+      value = '{"id": 1, "tags": ["x", "y"]}' * 100
+      self.assertTrue(len(Compressor().compress(value)) < len(value) / 10)
+
+   def test_rejects_truncated_input(self):
+      from util.lz4 import Compressor, Decompressor, LZ4Exception
+      value = "abcdefgh" * 100
+      out = Compressor().compress(value)
+      self.assertRaises(LZ4Exception, Decompressor().decompress, out[:len(out) / 2], len(value))
+
+class TestSortedSet(unittest.TestCase):
+   def test_matches_a_sorted_list(self):
+      import bisect
+      import random
+      from util.skiplist import SortedSet
+
+      rng = random.Random(1)
+      s = SortedSet()
+      model = []
+      for _ in range(0, 3000):
+         key = rng.randint(0, 500)
+         if key in model:
+            s.remove(key)
+            model.remove(key)
+         else:
+            s.add(key)
+            bisect.insort(model, key)
+         probe = rng.randint(-10, 510)
+         i = bisect.bisect_left(model, probe)
+         self.assertEqual(s.ceiling(probe), model[i] if i < len(model) else None)
+         i = bisect.bisect_right(model, probe)
+         self.assertEqual(s.floor(probe), model[i - 1] if i else None)
+      self.assertEqual(list(s), model)
+      self.assertEqual(len(s), len(model))
+      self.assertEqual(s.last(), model[-1])
+      self.assertEqual(list(s.iter_from(250)), [k for k in model if k >= 250])
+      self.assertRaises(KeyError, s.remove, 1000)
+      self.assertTrue(model[0] in s)
+
 
 def get_suite():
    "Return a unittest.TestSuite."
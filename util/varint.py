@@ -28,6 +28,23 @@ def decode(s, offset=0):
   v = (v>>1) ^ (-(v&1))
   return v
     
+def decode_from(s, offset=0):
+  """
+  Decodes the varint at 'offset' in 's'. Returns the value and the offset of
+  the first byte after it.
+  """
+  v = 0; shift = 0
+  while True:
+    b = ord(s[offset])
+    offset+=1
+    v |= (b& 0x7f)<<shift
+    if b & 0x80:
+      shift+=7
+      continue
+    break
+  v = (v>>1) ^ (-(v&1))
+  return v, offset
+
 def encode_stream(v, f):
   values = []
   v = (v<<1) ^ (v>>63)
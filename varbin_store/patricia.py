@@ -69,24 +69,518 @@ it may be useful to occasionally re-write the store like this:
 
 This organization makes it more likely that an element with a high probability
 of being used next (a sibling or immediate child) will be close by in memory.
+
+The store is implemented as two files. 'filename' holds a header followed by
+the entries, and 'filename.keys.N' is the value store of key fragments, which
+only grows until the store is re-written. The header is:
+
++-------+---------+-------------+-----------+----------------+
+| magic | version | root offset | key count | keys file (N)  |
+| 4s    | <I      | <Q          | <Q        | <Q             |
++-------+---------+-------------+-----------+----------------+
+
+An entry is identified by its offset in the file. It is a varint giving the
+size of its slot, followed by varints for the fragment start and length, the
+flags, the value (only for a LEAF), the offset of the first child and the
+offset of the next sibling. An offset of zero means there is none. The root
+entry has an empty fragment, and its children are the top-level sibling list.
+Each key maps to an integer value, such as a row id.
+
+An entry that still fits in its slot when it changes is rewritten in place.
+One that has grown is moved to the end of the file and the entry that points
+at it is updated, which may move that one in turn. The slots left behind are
+the fragmentation mentioned above.
+
+Entries are written as they change, and read through an MQ cache. The header
+is written by flush(). The trie is an index that can be rebuilt from the data
+it indexes, so a crash between flushes is not guarded against.
+
+relayout() re-writes the store in the order above. Tombstones that lead
+nowhere are dropped, an entry that only joins one child is merged with it,
+and the fragments are copied to a new value store in the same order. The new
+entry file names the new value store, and is renamed over the old one, so a
+crash leaves either the old store or the new one.
 '''
 
+import os
+import struct
+
+from glob import glob
+
+from column_store.durability import sync_directory, sync_file
+from column_store.mq import Cache
 from util import varint
 
+format_version = 2
+
+MAGIC = "CQLP"
+
+# magic, version, root offset, key count, keys file
+header_fmt = "<4sIQQQ"
+header_size = struct.calcsize(header_fmt)
+
+# Entry flags. An entry with neither only joins its children.
+LEAF = 1
+TOMBSTONE = 2
+
+# Enough to read most entries in one go.
+ENTRY_READ_SIZE = 64
+
+
+class PatriciaError(Exception):
+   pass
+
+
+def common_prefix_length(a, b, start=0):
+   """
+   :returns: The length of the common prefix of 'a' and 'b[start:]'.
+   """
+   n = min(len(a), len(b) - start)
+   i = 0
+   while i < n and a[i] == b[start + i]:
+      i += 1
+   return i
+
+
 class Entry(object):
-   __slots__ = ["size", "key_frag_start", "key_frag_length", "children", "next"]
+   __slots__ = ["offset", "size", "key_frag_start", "key_frag_length", "fragment", "flags",
+                "value", "child", "next"]
    def __init__(self, key_frag_start, key_frag_length, next=None):
+      self.offset = 0
       self.size = None
-      self.children = []
-      self.next = next
+      self.fragment = None
+      self.flags = 0
+      self.value = None
+      self.child = 0
+      self.next = next or 0
       self.key_frag_start = key_frag_start
       self.key_frag_length = key_frag_length
 
    def load(self, f):
-      entry_start = f.tell()
-      self.key_frag_start = varint.decode_stream(f)
-      self.key_frag_length = varint.decode_stream(f)
-      child_count = varint.decode_stream(f)
-      for i in range(0, child_count):
-         pass
+      """
+      :synopsis: Reads the entry at the current position of 'f'. The fragment
+                 is not read.
+      """
+      self.offset = f.tell()
+      data = f.read(ENTRY_READ_SIZE)
+      self.size, pos = varint.decode_from(data)
+      if pos + self.size > len(data):
+         data += f.read(pos + self.size - len(data))
+      self.key_frag_start, pos = varint.decode_from(data, pos)
+      self.key_frag_length, pos = varint.decode_from(data, pos)
+      self.flags, pos = varint.decode_from(data, pos)
+      if self.flags & LEAF:
+         self.value, pos = varint.decode_from(data, pos)
+      self.child, pos = varint.decode_from(data, pos)
+      self.next, pos = varint.decode_from(data, pos)
+
+   def encode(self):
+      """
+      :returns: The fields of the entry, without the slot size.
+      """
+      fields = [self.key_frag_start, self.key_frag_length, self.flags]
+      if self.flags & LEAF:
+         fields.append(self.value)
+      fields.append(self.child)
+      fields.append(self.next)
+      return "".join(varint.encode(v) for v in fields)
+
+
+class PatriciaTrie(object):
+   """
+   :synopsis: Maps variable length binary keys to integers.
+
+   Keys are byte strings and come back in lexicographical order. The trie
+   has a single user thread.
+   """
+   __slots__ = ["filename", "f", "keys_file", "root", "count", "end", "keys_end", "generation",
+                "cache"]
+   def __init__(self, filename, cache_entries=65536):
+      """
+      :param filename: The entry file. The key fragments are kept in
+                       filename.keys.N.
+      :param cache_entries: The number of entries to keep in memory.
+      :raises PatriciaError: If the file is not a trie of this version.
+      """
+      self.filename = filename
+      self.cache = Cache(capacity=cache_entries)
+      if os.path.exists(filename):
+         self.f = open(filename, "r+b")
+         magic, version, self.root, self.count, self.generation = \
+            struct.unpack(header_fmt, self.f.read(header_size))
+         if magic != MAGIC or version != format_version:
+            raise PatriciaError("%s is not a version %d patricia trie" % (filename, format_version))
+         self.keys_file = open(self._keys_filename(self.generation), "r+b")
+         # Whatever a relayout that did not finish left behind.
+         for name in glob(self._keys_filename("*")) + glob(filename + ".tmp"):
+            if name != self.keys_file.name:
+               os.unlink(name)
+         self.f.seek(0, 2)
+         self.end = self.f.tell()
+         self.keys_file.seek(0, 2)
+         self.keys_end = self.keys_file.tell()
+      else:
+         self.f = open(filename, "w+b")
+         self.generation = 0
+         self.keys_file = open(self._keys_filename(self.generation), "w+b")
+         self.count = 0
+         self.end = header_size
+         self.keys_end = 0
+         root = Entry(0, 0)
+         root.fragment = ""
+         self._append(root)
+         self.root = root.offset
+         self.flush()
+
+   def _keys_filename(self, generation):
+      return "%s.keys.%s" % (self.filename, generation)
+
+   def _write_header(self):
+      self.f.seek(0)
+      self.f.write(struct.pack(header_fmt, MAGIC, format_version, self.root, self.count,
+                               self.generation))
+
+   def _entry(self, offset):
+      """
+      :synopsis: Returns the entry at 'offset'. Only a load counts as an access
+                 to the cache; the entries that a search descends into are
+                 counted by _siblings().
+      """
+      entry = self.cache.peek(offset)
+      if entry is None:
+         self.f.seek(offset)
+         entry = Entry(0, 0)
+         entry.load(self.f)
+         self.keys_file.seek(entry.key_frag_start)
+         entry.fragment = self.keys_file.read(entry.key_frag_length)
+         self.cache.put(offset, entry)
+      return entry
+
+   def _new_entry(self, fragment):
+      """
+      :synopsis: Creates an entry for a fragment that is not in the value
+                 store yet, and adds it there.
+      """
+      entry = Entry(self.keys_end, len(fragment))
+      entry.fragment = fragment
+      self.keys_file.seek(self.keys_end)
+      self.keys_file.write(fragment)
+      self.keys_end += len(fragment)
+      return entry
+
+   def _append(self, entry):
+      """
+      :synopsis: Writes 'entry' to a new slot at the end of the file.
+      """
+      if entry.offset:
+         self.cache.remove(entry.offset)
+      body = entry.encode()
+      entry.offset = self.end
+      entry.size = len(body)
+      data = varint.encode(entry.size) + body
+      self.f.seek(self.end)
+      self.f.write(data)
+      self.end += len(data)
+      self.cache.put(entry.offset, entry)
+
+   def _store(self, entry, refs):
+      """
+      :synopsis: Writes a changed entry. If it no longer fits in its slot it is
+                 moved, and the entry that points at it is stored in turn.
+      :param refs: The (entry, attribute) pairs that lead from the root to
+                   'entry', each naming the pointer that leads to the next.
+                   The list is used up.
+      """
+      while True:
+         body = entry.encode()
+         if entry.offset and len(body) <= entry.size:
+            self.f.seek(entry.offset)
+            self.f.write(varint.encode(entry.size) + body + "\0" * (entry.size - len(body)))
+            return
+         self._append(entry)
+         if not refs:
+            self.root = entry.offset
+            return
+         parent, attribute = refs.pop()
+         setattr(parent, attribute, entry.offset)
+         entry = parent
+
+   def _siblings(self, parent, byte):
+      """
+      :returns: The pointers that lead through the children of 'parent' to
+                the first child whose fragment starts at or after 'byte', and
+                that child, or None.
+      """
+      refs = [(parent, "child")]
+      offset = parent.child
+      while offset:
+         entry = self._entry(offset)
+         if entry.fragment[0] >= byte:
+            self.cache.get(offset)
+            return refs, entry
+         refs.append((entry, "next"))
+         offset = entry.next
+      return refs, None
+
+   def _children(self, parent):
+      children = []
+      offset = parent.child
+      while offset:
+         entry = self._entry(offset)
+         children.append(entry)
+         offset = entry.next
+      return children
+
+   def _find(self, key):
+      """
+      :returns: The entry that ends exactly at the end of 'key', and the
+                pointers that lead to it, or (None, None).
+      """
+      entry = self._entry(self.root)
+      refs = []
+      pos = 0
+      while pos < len(key):
+         siblings, entry = self._siblings(entry, key[pos])
+         if entry is None or not key.startswith(entry.fragment, pos):
+            return None, None
+         refs.extend(siblings)
+         pos += entry.key_frag_length
+      return entry, refs
+
+   def _split(self, entry, length, refs):
+      """
+      :synopsis: Cuts the fragment of 'entry' after 'length' bytes. The rest
+                 of it, with the entry's flags and children, becomes its only
+                 child. No key bytes are copied.
+      """
+      tail = Entry(entry.key_frag_start + length, entry.key_frag_length - length)
+      tail.fragment = entry.fragment[length:]
+      tail.flags = entry.flags
+      tail.value = entry.value
+      tail.child = entry.child
+      self._append(tail)
+
+      entry.key_frag_length = length
+      entry.fragment = entry.fragment[:length]
+      entry.flags = 0
+      entry.value = None
+      entry.child = tail.offset
+      self._store(entry, refs)
+
+   def __len__(self):
+      return self.count
+
+   def __contains__(self, key):
+      return self.get(key) is not None
+
+   def get(self, key, default=None):
+      """
+      :returns: The value stored with 'key', or 'default' if there is none.
+      """
+      entry, _ = self._find(key)
+      if entry is None or not entry.flags & LEAF:
+         return default
+      return entry.value
+
+   def set(self, key, value):
+      """
+      :synopsis: Stores 'value' with 'key'. Only the part of the key that
+                 does not share a fragment with the keys already in the trie
+                 is added to the value store.
+      :param key: A string of bytes.
+      :param value: An integer.
+      """
+      entry = self._entry(self.root)
+      refs = []
+      pos = 0
+      while pos < len(key):
+         siblings, child = self._siblings(entry, key[pos])
+         if child is None or child.fragment[0] != key[pos]:
+            leaf = self._new_entry(key[pos:])
+            leaf.flags = LEAF
+            leaf.value = value
+            leaf.next = child.offset if child is not None else 0
+            self._store(leaf, refs + siblings)
+            self.count += 1
+            return
+
+         length = common_prefix_length(child.fragment, key, pos)
+         if length < child.key_frag_length:
+            self._split(child, length, refs + siblings)
+         refs.extend(siblings)
+         entry = child
+         pos += length
+
+      if not entry.flags & LEAF:
+         self.count += 1
+      entry.flags = LEAF
+      entry.value = value
+      self._store(entry, refs)
+
+   def delete(self, key):
+      """
+      :synopsis: Removes 'key' by turning its entry into a tombstone.
+      :returns: True if the key existed.
+      """
+      entry, refs = self._find(key)
+      if entry is None or not entry.flags & LEAF:
+         return False
+      entry.flags = TOMBSTONE
+      entry.value = None
+      self._store(entry, refs)
+      self.count -= 1
+      return True
+
+   def items(self, prefix=""):
+      """
+      :synopsis: Iterates over the keys that start with 'prefix', in order.
+                 The trie must not be changed during the iteration.
+      :returns: A generator of (key, value) pairs.
+      """
+      entry = self._entry(self.root)
+      pos = 0
+      while pos < len(prefix):
+         _, entry = self._siblings(entry, prefix[pos])
+         if entry is None or \
+            common_prefix_length(entry.fragment, prefix, pos) < min(entry.key_frag_length,
+                                                                    len(prefix) - pos):
+            return
+         pos += entry.key_frag_length
+
+      # The prefix may end inside the fragment of the last entry.
+      stack = [(entry, prefix[:pos - entry.key_frag_length] + entry.fragment)]
+      while stack:
+         entry, key = stack.pop()
+         if entry.flags & LEAF:
+            yield key, entry.value
+         for child in reversed(self._children(entry)):
+            stack.append((child, key + child.fragment))
+
+   def keys(self, prefix=""):
+      """
+      :returns: A generator of the keys that start with 'prefix', in order.
+      """
+      for key, _ in self.items(prefix):
+         yield key
+
+   def flush(self):
+      """
+      :synopsis: Writes the header and makes both files durable.
+      """
+      self._write_header()
+      for f in (self.keys_file, self.f):
+         f.flush()
+         os.fsync(f.fileno())
+
+   def _pruned(self):
+      """
+      :returns: The live trie as nested [fragment, flags, value, children]
+                lists. Tombstones without live children are dropped, and an
+                entry that only joins one child is merged with it.
+      """
+      # An explicit stack of [entry, children, next child, pruned children],
+      # as keys can be deeper than the recursion limit.
+      root = self._entry(self.root)
+      stack = [[root, self._children(root), 0, []]]
+      while True:
+         frame = stack[-1]
+         if frame[2] < len(frame[1]):
+            child = frame[1][frame[2]]
+            frame[2] += 1
+            stack.append([child, self._children(child), 0, []])
+            continue
+
+         entry, _, _, children = stack.pop()
+         flags = entry.flags & LEAF
+         if not stack:
+            return [entry.fragment, flags, entry.value, children]
+         if not flags and not children:
+            continue
+         if not flags and len(children) == 1:
+            child = children[0]
+            stack[-1][3].append([entry.fragment + child[0]] + child[1:])
+         else:
+            stack[-1][3].append([entry.fragment, flags, entry.value if flags else None, children])
+
+   def relayout(self):
+      """
+      :synopsis: Re-writes the store breadth first, one sibling list at a
+                 time, so that the entries a search reads next are close by,
+                 and swaps it in atomically. Moved-out slots, dead tombstones
+                 and unused fragments are not copied. The live trie is held in
+                 memory while the store is written.
+      """
+      # Every sibling list follows the lists of the entries before its
+      # parent, which is the order set out in the module documentation.
+      order = [self._pruned()]
+      for node in order:
+         order.extend(node[3])
+
+      entries = []
+      keys_end = 0
+      for node in order:
+         fragment, flags, value, _ = node
+         entry = Entry(keys_end, len(fragment))
+         entry.fragment = fragment
+         entry.flags = flags
+         entry.value = value
+         keys_end += len(fragment)
+         entries.append(entry)
+      index = dict((id(node), i) for i, node in enumerate(order))
+
+      # A slot must hold the entry's pointers, which are not known until
+      # every slot has a size. Sizing the slots for pointers as large as the
+      # file settles after a round or two.
+      bound = self.end
+      while True:
+         for entry, node in zip(entries, order):
+            entry.child = bound if node[3] else 0
+            entry.next = bound
+            entry.size = len(entry.encode())
+         end = header_size + sum(len(varint.encode(e.size)) + e.size for e in entries)
+         if end <= bound:
+            break
+         bound = end
+
+      offset = header_size
+      for entry in entries:
+         entry.offset = offset
+         entry.next = 0
+         offset += len(varint.encode(entry.size)) + entry.size
+      for entry, node in zip(entries, order):
+         children = [entries[index[id(child)]] for child in node[3]]
+         entry.child = children[0].offset if children else 0
+         for a, b in zip(children, children[1:]):
+            a.next = b.offset
+
+      generation = self.generation + 1
+      with open(self._keys_filename(generation), "wb") as f:
+         for entry in entries:
+            f.write(entry.fragment)
+         sync_file(f)
+      tmp_filename = self.filename + ".tmp"
+      with open(tmp_filename, "wb") as f:
+         f.write(struct.pack(header_fmt, MAGIC, format_version, entries[0].offset, self.count,
+                             generation))
+         for entry in entries:
+            body = entry.encode()
+            f.write(varint.encode(entry.size) + body + "\0" * (entry.size - len(body)))
+         sync_file(f)
+      os.rename(tmp_filename, self.filename)
+      sync_directory(self.filename)
+
+      self.f.close()
+      self.keys_file.close()
+      os.unlink(self._keys_filename(self.generation))
+      self.generation = generation
+      self.f = open(self.filename, "r+b")
+      self.keys_file = open(self._keys_filename(generation), "r+b")
+      self.root = entries[0].offset
+      self.end = offset
+      self.keys_end = keys_end
+      self.cache = Cache(capacity=self.cache.capacity)
 
+   def close(self):
+      self.flush()
+      self.f.close()
+      self.keys_file.close()
@@ -0,0 +1,153 @@
+import os
+import unittest
+
+class TestPatriciaTrie(unittest.TestCase):
+   filename = "test.patricia"
+
+   def tearDown(self):
+      import glob
+      for filename in glob.glob(self.filename + "*"):
+         os.unlink(filename)
+
+   def test_can_set_and_get(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      for i, key in enumerate(["happy", "happens", "haphazard", "manna", "apple", "hap", ""]):
+         t.set(key, i)
+      self.assertEqual(len(t), 7)
+      self.assertEqual(t.get("happens"), 1)
+      self.assertEqual(t.get("hap"), 5)
+      self.assertEqual(t.get(""), 6)
+      self.assertEqual(t.get("ha"), None)
+      self.assertEqual(t.get("happiest"), None)
+      t.set("happy", 10)
+      self.assertEqual(t.get("happy"), 10)
+      self.assertEqual(len(t), 7)
+
+   def test_fragments_are_shared(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      t.set("happy", 0)
+      t.set("happens", 1)
+      t.set("haphazard", 2)
+      # Only the unmatched part of each key reaches the value store.
+      self.assertEqual(t.keys_end, len("happy") + len("ens") + len("hazard"))
+
+   def test_delete(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      t.set("happy", 0)
+      t.set("happens", 1)
+      self.assertTrue(t.delete("happy"))
+      self.assertFalse(t.delete("happy"))
+      self.assertFalse(t.delete("hap"))
+      self.assertEqual(t.get("happy"), None)
+      self.assertEqual(t.get("happens"), 1)
+      self.assertEqual(len(t), 1)
+      t.set("happy", 2)
+      self.assertEqual(t.get("happy"), 2)
+
+   def test_prefix_iteration(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      keys = ["happy", "happens", "haphazard", "manna", "apple", "hap", "\xff", "\x00"]
+      for i, key in enumerate(keys):
+         t.set(key, i)
+      t.delete("manna")
+      self.assertEqual(list(t.keys()), sorted(k for k in keys if k != "manna"))
+      self.assertEqual(list(t.items("happ")), [("happens", 1), ("happy", 0)])
+      self.assertEqual(list(t.keys("hap")), ["hap", "haphazard", "happens", "happy"])
+      self.assertEqual(list(t.keys("happ")), ["happens", "happy"])
+      self.assertEqual(list(t.keys("hx")), [])
+      self.assertEqual(list(t.keys("happiest")), [])
+
+   def test_persists(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      expected = {}
+      for i in range(0, 2000):
+         key = "key %d" % (i * 7919 % 3001)
+         t.set(key, i)
+         expected[key] = i
+      for key in sorted(expected)[::3]:
+         t.delete(key)
+         del expected[key]
+      t.close()
+
+      # A small cache makes most lookups read their entries back.
+      t = PatriciaTrie(self.filename, cache_entries=16)
+      self.assertEqual(len(t), len(expected))
+      self.assertEqual(list(t.items()), sorted(expected.items()))
+      for key, value in expected.iteritems():
+         self.assertEqual(t.get(key), value)
+      t.close()
+
+   def test_relayout(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      expected = {}
+      for i in range(0, 3000):
+         key = "%x" % (i * 2654435761 % (1 << 32))
+         t.set(key, i)
+         expected[key] = i
+      for key in sorted(expected)[::4]:
+         t.delete(key)
+         del expected[key]
+
+      def pages_read(t):
+         pages = 0
+         for key in sorted(expected)[:500]:
+            entry, refs = t._find(key)
+            pages += len(set(e.offset >> 12 for e, _ in refs) | set([entry.offset >> 12]))
+         return pages
+
+      size = os.path.getsize(self.filename)
+      before = pages_read(t)
+      t.relayout()
+      self.assertTrue(pages_read(t) < before / 2)
+      self.assertTrue(os.path.getsize(self.filename) < size)
+      self.assertEqual(list(t.items()), sorted(expected.items()))
+
+      # The store can be changed and re-written again, and survives a reopen.
+      t.set("f00d", 1)
+      t.delete(sorted(expected)[0])
+      del expected[sorted(expected)[0]]
+      expected["f00d"] = 1
+      t.relayout()
+      t.close()
+      self.assertFalse(os.path.exists(self.filename + ".keys.0"))
+      t = PatriciaTrie(self.filename, cache_entries=16)
+      self.assertEqual(len(t), len(expected))
+      self.assertEqual(list(t.items()), sorted(expected.items()))
+      t.close()
+
+   def test_unfinished_relayout_is_ignored(self):
+      from varbin_store.patricia import PatriciaTrie
+
+      t = PatriciaTrie(self.filename)
+      t.set("happy", 1)
+      t.close()
+      for name in (self.filename + ".tmp", self.filename + ".keys.1"):
+         with open(name, "wb") as f:
+            f.write("partial")
+
+      t = PatriciaTrie(self.filename)
+      self.assertEqual(t.get("happy"), 1)
+      self.assertFalse(os.path.exists(self.filename + ".tmp"))
+      self.assertFalse(os.path.exists(self.filename + ".keys.1"))
+      t.close()
+
+
+def get_suite():
+   "Return a unittest.TestSuite."
+   import varbin_store.tests
+
+   loader = unittest.TestLoader()
+   suite = loader.loadTestsFromModule(varbin_store.tests)
+   return suite
@@ -0,0 +1,12 @@
+# RUNME as 'python -m varbin_store.tests.__main__'
+import unittest
+import varbin_store.tests
+
+def main():
+   "Run all of the tests when run as a module with -m."
+   suite = varbin_store.tests.get_suite()
+   runner = unittest.TextTestRunner()
+   runner.run(suite)
+
+if __name__ == '__main__':
+   main()